@@ -601,3 +601,28 @@
 # with a base language of Chinese.
 # Example: east_asian_base_language = 'ja'
 east_asian_base_language = ''
+
+#: Store numeric and date book data in compact columns
+# By default, calibre keeps the data for every book in memory as one python
+# object per book per column. For very large libraries with many custom
+# columns this can use a lot of memory. Setting this tweak to True makes
+# calibre store integer, floating point, yes/no and date columns, as well as
+# the links from books to series, publishers and other single value columns,
+# as compact typed arrays indexed by book id. This uses much less memory at the
+# cost of slightly slower access to individual values. calibre must be
+# restarted for changes to this tweak to take effect.
+use_columnar_storage_for_book_data = False
+
+#: Speed up opening large libraries
+# When a library is opened, calibre reads the data for all books from
+# metadata.db into memory, one column after another. Setting
+# library_load_threads to a number larger than one makes calibre read the
+# columns concurrently, using that many threads, each with its own read only
+# connection to metadata.db. Setting use_library_load_snapshot to True makes
+# calibre save a snapshot of the data it read in the file
+# metadata_db_snapshot.bin next to metadata.db. The next time the library is
+# opened, the snapshot is used instead of reading metadata.db, provided
+# metadata.db has not been changed since. This is most useful for content
+# servers that serve many large libraries which change rarely.
+library_load_threads = 1
+use_library_load_snapshot = False
@@ -6,6 +6,7 @@
 
 import os
 import re
+import shutil
 import time
 from collections import defaultdict
 from contextlib import contextmanager, suppress
@@ -256,6 +257,161 @@ def cdb_recursive_find(root, single_book_per_directory=True, compiled_rules=()):
         yield from cdb_find_in_dir(dirpath[0], single_book_per_directory, compiled_rules)
 
 
+# The number of times the worker pool is restarted in a row after failures
+# that are not caused by a particular book, before giving up
+MAX_POOL_RESTARTS = 3
+
+
+def bulk_import(db, file_groups, add_duplicates=False, callback=None, num_workers=None, batch_size=500):
+    '''
+    Add many books to the library. ``file_groups`` is an iterable of lists of
+    paths, each list being the formats of a single book, as generated by
+    :func:`cdb_recursive_find`. Metadata and covers are read in a pool of
+    worker processes, which also run the file type plugins. The books are
+    written to the database ``batch_size`` at a time, each batch in a single
+    transaction, with the files copied into the library concurrently.
+
+    Unless ``add_duplicates`` is True, books with the same title and authors
+    as a book already in the library, or earlier in this import, are not
+    added.
+
+    :param callback: Called after every batch with the number of books
+        processed so far, the number added and the number of books processed
+        per second. If it returns True, the import is stopped.
+
+    :return: ``(added_ids, duplicates, errors)``. ``duplicates`` is a list of
+        ``(mi, paths)`` and ``errors`` of ``(paths, traceback)`` for books
+        whose metadata could not be read. These are still added, with the
+        title taken from the file name, unless reading their metadata crashed
+        the worker process.
+    '''
+    from io import BytesIO
+    from queue import Empty
+
+    from calibre.db.utils import fuzzy_title
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.opf2 import OPF
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.ipc.pool import Failure, Pool
+
+    db = getattr(db, 'new_api', db)
+    file_groups = enumerate(file_groups)
+    added_ids, duplicates, errors = [], [], []
+    outstanding, pending, pending_keys = {}, [], set()
+    num_done, start = 0, time.monotonic()
+
+    def flush():
+        # Write the pending books to the db, then delete the covers and files
+        # created by the import plugins for them
+        ids = db.add_books(((mi, fmap) for mi, fmap, group_id in pending), add_duplicates=True, run_hooks=False, batch_size=batch_size)[0]
+        added_ids.extend(ids)
+        for mi, fmap, group_id in pending:
+            if mi.cover:
+                with suppress(OSError):
+                    os.remove(mi.cover)
+            shutil.rmtree(os.path.join(tdir, str(group_id)), ignore_errors=True)
+        del pending[:]
+        pending_keys.clear()
+        if callable(callback):
+            return callback(num_done, len(added_ids), num_done / max(0.001, time.monotonic() - start))
+
+    def process_result(group_id, paths, result):
+        if result.err:
+            errors.append((paths, result.traceback))
+            mi, has_cover = Metadata(_('Unknown')), False
+        else:
+            paths, opf, has_cover, __ = result.value
+            try:
+                mi = OPF(BytesIO(opf), basedir=tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+            except Exception:
+                import traceback
+                errors.append((paths, traceback.format_exc()))
+                mi, has_cover = Metadata(_('Unknown')), False
+        if mi.is_null('title'):
+            mi.title = os.path.splitext(os.path.basename(paths[0]))[0]
+        if mi.application_id == '__calibre_dummy__':
+            mi.application_id = None
+        if not add_duplicates:
+            key = fuzzy_title(mi.title), frozenset(map(icu_lower, mi.authors))
+            if key in pending_keys or db.find_duplicate_books(mi):
+                duplicates.append((mi, paths))
+                return
+            pending_keys.add(key)
+        if has_cover:
+            mi.cover = os.path.join(tdir, f'{group_id}.cdata')
+        pending.append((mi, create_format_map(paths), group_id))
+
+    def submit(group_id, paths):
+        try:
+            pool(group_id, 'calibre.ebooks.metadata.worker', 'read_metadata', paths, group_id, tdir)
+        except Failure:
+            # The pool has failed, the book is re-run by restart()
+            pass
+
+    def restart():
+        # The pool cannot be used after a worker crashes, keep the results
+        # that arrived before the crash and re-run the other books in a new
+        # pool
+        nonlocal pool, num_done, restarts
+        tf = pool.terminal_failure
+        pool.join(5)
+        while True:
+            try:
+                wr = pool.results.get_nowait()
+            except Empty:
+                break
+            if not wr.is_terminal_failure and wr.id in outstanding:
+                num_done += 1
+                process_result(wr.id, outstanding.pop(wr.id), wr.result)
+        if tf.job_id in outstanding:
+            num_done += 1
+            errors.append((outstanding.pop(tf.job_id), tf.tb))
+        else:
+            # Not caused by a particular book, for instance, a worker process
+            # could not be started
+            restarts += 1
+            if restarts > MAX_POOL_RESTARTS:
+                raise Failure(tf)
+        pool.shutdown()
+        pool = Pool(max_workers=num_workers, name='BulkImport')
+        for group_id, paths in outstanding.items():
+            submit(group_id, paths)
+
+    restarts = 0
+    with TemporaryDirectory('_bulk_import') as tdir:
+        pool = Pool(max_workers=num_workers, name='BulkImport')
+        try:
+            while True:
+                if pool.failed:
+                    restart()
+                    continue
+                while len(outstanding) < 2 * pool.max_workers:
+                    group_id, paths = next(file_groups, (None, None))
+                    if paths is None:
+                        break
+                    outstanding[group_id] = paths
+                    submit(group_id, paths)
+                if not outstanding:
+                    break
+                try:
+                    wr = pool.results.get(timeout=0.1)
+                except Empty:
+                    continue
+                if wr.is_terminal_failure:
+                    restart()
+                    continue
+                restarts = 0
+                num_done += 1
+                process_result(wr.id, outstanding.pop(wr.id), wr.result)
+                if len(pending) >= batch_size and flush():
+                    break
+            if pending:
+                flush()
+        finally:
+            pool.shutdown()
+    return added_ids, duplicates, errors
+
+
 def add_catalog(cache, path, title, dbapi=None):
     from calibre.ebooks.metadata.book.base import Metadata
     from calibre.ebooks.metadata.meta import get_metadata
@@ -8,20 +8,22 @@
 # Imports {{{
 import errno
 import hashlib
+import hmac
 import json
 import os
+import pickle
 import shutil
 import stat
 import sys
 import time
 import uuid
 from contextlib import closing, suppress
-from functools import partial
+from functools import lru_cache, partial
 
 import apsw
 
 from calibre import as_unicode, force_unicode, isbytestring, prints
-from calibre.constants import filesystem_encoding, iswindows, plugins, preferred_encoding
+from calibre.constants import cache_dir, filesystem_encoding, iswindows, numeric_version, plugins, preferred_encoding
 from calibre.db import SPOOL_SIZE, FTSQueryError
 from calibre.db.annotations import annot_db_data, unicode_normalize
 from calibre.db.constants import (
@@ -30,6 +32,7 @@
     DEFAULT_TRASH_EXPIRY_TIME_SECONDS,
     METADATA_FILE_NAME,
     NOTES_DIR_NAME,
+    TABLES_SNAPSHOT_NAME,
     TRASH_DIR_NAME,
     TrashEntry,
 )
@@ -81,6 +84,27 @@
 WINDOWS_RESERVED_NAMES = frozenset('CON PRN AUX NUL COM1 COM2 COM3 COM4 COM5 COM6 COM7 COM8 COM9 LPT1 LPT2 LPT3 LPT4 LPT5 LPT6 LPT7 LPT8 LPT9'.split())
 
 
+@lru_cache
+def tables_snapshot_key():
+    ''' The key used to authenticate the snapshots of the tables. Snapshots are
+    pickles, so they must not be loaded unless they were written by this user,
+    which is why the key is kept in the cache directory, outside the library. '''
+    path = os.path.join(cache_dir(), 'tables-snapshot.key')
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+    except FileNotFoundError:
+        key = b''
+    if len(key) < 32:
+        key = os.urandom(32)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tpath = f'{path}.{os.getpid()}.tmp'
+        with open(os.open(tpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(key)
+        atomic_rename(tpath, path)
+    return key
+
+
 class DynamicFilter:  # {{{
 
     'No longer used, present for legacy compatibility'
@@ -365,11 +389,14 @@ class Connection(apsw.Connection):  # {{{
 
     BUSY_TIMEOUT = 10000  # milliseconds
 
-    def __init__(self, path):
+    def __init__(self, path, read_only=False):
         from calibre.utils.localization import get_lang
         from calibre_extensions.sqlite_extension import set_ui_language
         set_ui_language(get_lang())
-        super().__init__(path)
+        if read_only:
+            super().__init__(path, flags=apsw.SQLITE_OPEN_READONLY)
+        else:
+            super().__init__(path)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
 
@@ -1190,6 +1217,13 @@ def executemany(self, sql, sequence_of_bindings):
             with self.conn:  # Disable autocommit mode, for performance
                 return self.conn.cursor().executemany(sql, sequence_of_bindings)
 
+    def insert_many(self, sql, sequence_of_bindings):
+        ''' Run the INSERT statement sql, which must end with RETURNING id, for
+        every item in sequence_of_bindings in a single transaction. Returns
+        the list of ids of the inserted rows, in order. '''
+        with self.conn:
+            return [r[0] for r in self.conn.cursor().executemany(sql, sequence_of_bindings)]
+
     def get(self, *args, **kw):
         ans = self.execute(*args)
         if kw.get('all', True):
@@ -1594,14 +1628,150 @@ def read_tables(self):
         '''
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
-            for table in itervalues(self.tables):
-                try:
-                    table.read(self)
-                except Exception:
-                    prints('Failed to read table:', table.name)
-                    import pprint
-                    pprint.pprint(table.metadata)
-                    raise
+            # Once something has been read, the transaction holds a shared
+            # lock on the db, preventing other connections from committing
+            # changes, unless the db is in WAL mode.
+            self.conn.get('SELECT id FROM books LIMIT 1')
+            stamp = self.db_change_stamp()
+            use_snapshot = stamp is not None and tweaks['use_library_load_snapshot'] and (
+                os.path.basename(self.dbpath) == 'metadata.db')
+            if use_snapshot:
+                stamp = self.tables_snapshot_stamp(stamp)
+                if self.load_tables_snapshot(stamp):
+                    return
+            initial_attributes = {name: frozenset(vars(table)) for name, table in iteritems(self.tables)}
+            num_threads = tweaks['library_load_threads']
+            if stamp is not None and num_threads > 1:
+                self.read_tables_in_parallel(num_threads)
+            else:
+                for table in itervalues(self.tables):
+                    self.read_table(table, self)
+            if use_snapshot:
+                self.save_tables_snapshot(stamp, initial_attributes)
+
+    def read_table(self, table, conn):
+        try:
+            table.read(conn)
+        except Exception:
+            prints('Failed to read table:', table.name)
+            import pprint
+            pprint.pprint(table.metadata)
+            raise
+
+    def read_tables_in_parallel(self, num_threads):
+        ''' Read the tables concurrently, using a separate read only connection
+        in every thread. Must be called with the main connection holding a
+        shared lock so that all connections see the same data. '''
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import Lock, local
+        tl, lock, connections, retry = local(), Lock(), [], []
+
+        def read(table):
+            conn = getattr(tl, 'conn', None)
+            if conn is None:
+                conn = tl.conn = Connection(self.dbpath, read_only=True)
+                with lock:
+                    connections.append(conn)
+            try:
+                table.read(conn)
+            except Exception:
+                # Either a writer is waiting for the lock (BusyError), the
+                # table needs to clean up bad data while reading
+                # (ReadOnlyError) or reading failed. Read this table again
+                # using the main connection, which already holds a shared
+                # lock, reporting any errors.
+                with lock:
+                    retry.append(table)
+
+        try:
+            with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='ReadTables') as executor:
+                for x in executor.map(read, tuple(itervalues(self.tables))):
+                    pass
+        finally:
+            for conn in connections:
+                conn.close()
+        for table in retry:
+            self.read_table(table, self)
+
+    def db_change_stamp(self):
+        ''' Return a value that changes whenever metadata.db is changed, or
+        None if there is no way to tell, as in WAL mode, where commits do not
+        update the header of the db file. '''
+        try:
+            with open(self.dbpath, 'rb') as f:
+                header = f.read(100)
+            st = os.stat(self.dbpath)
+        except OSError:
+            return None
+        if len(header) < 100 or header[18] == 2:
+            return None
+        # The file change counter, incremented by every commit
+        return header[24:28], st.st_size, st.st_mtime_ns
+
+    TABLES_SNAPSHOT_VERSION = 2
+    TABLES_SNAPSHOT_MAGIC = b'calibre-tables-snapshot\n'
+    TABLES_SNAPSHOT_DIGEST = 'sha256'
+
+    @property
+    def tables_snapshot_path(self):
+        return os.path.join(os.path.dirname(self.dbpath), TABLES_SNAPSHOT_NAME)
+
+    def tables_snapshot_stamp(self, db_change_stamp):
+        return (self.TABLES_SNAPSHOT_VERSION, numeric_version, db_change_stamp,
+                tweaks['use_columnar_storage_for_book_data'],
+                tuple(sorted((name, table.__class__.__name__) for name, table in iteritems(self.tables))))
+
+    def load_tables_snapshot(self, stamp):
+        ''' Populate the tables from the snapshot saved by
+        :meth:`save_tables_snapshot`, if it matches stamp. Returns True on
+        success. '''
+        import mmap
+        try:
+            with open(self.tables_snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m.read(len(self.TABLES_SNAPSHOT_MAGIC)) != self.TABLES_SNAPSHOT_MAGIC:
+                    return False
+                mac = hmac.new(tables_snapshot_key(), digestmod=self.TABLES_SNAPSHOT_DIGEST)
+                digest = m.read(mac.digest_size)
+                with memoryview(m) as data:
+                    mac.update(data[m.tell():])
+                if not hmac.compare_digest(digest, mac.digest()):
+                    return False
+                if pickle.load(m) != stamp:
+                    return False
+                state = pickle.load(m)
+        except (OSError, ValueError):  # mmap raises ValueError for empty files
+            return False
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return False
+        for name, table in iteritems(self.tables):
+            for attr, val in iteritems(state[name]):
+                setattr(table, attr, val)
+        return True
+
+    def save_tables_snapshot(self, stamp, initial_attributes):
+        ''' Save the data read from the db by the tables, that is, the
+        attributes they did not have before reading. '''
+        state = {name: {attr: val for attr, val in iteritems(vars(table)) if attr not in initial_attributes[name]}
+                 for name, table in iteritems(self.tables)}
+        path = self.tables_snapshot_path
+        try:
+            data = pickle.dumps(stamp, protocol=pickle.HIGHEST_PROTOCOL), pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+            mac = hmac.new(tables_snapshot_key(), digestmod=self.TABLES_SNAPSHOT_DIGEST)
+            for x in data:
+                mac.update(x)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(self.TABLES_SNAPSHOT_MAGIC)
+                f.write(mac.digest())
+                for x in data:
+                    f.write(x)
+            atomic_rename(path + '.tmp', path)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            with suppress(OSError):
+                os.remove(path + '.tmp')
 
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
@@ -1940,6 +2110,15 @@ def add_format(self, book_id, fmt, stream, title, author, path, current_name, mt
 
         return size, fname
 
+    def add_format_file(self, book_id, fmt, src, title, author, path, copy_function):
+        ''' Add the file src as a format of a book that does not have it, using
+        copy_function(src, dest) to place it in the book folder, which must exist. '''
+        fmt = ('.' + fmt.lower()) if fmt else ''
+        fname = self.construct_file_name(book_id, title, author, len(fmt))
+        dest = make_long_path_useable(os.path.join(self.library_path, path, fname + fmt))
+        copy_function(make_long_path_useable(src), dest)
+        return os.path.getsize(dest), fname
+
     def update_path(self, book_id, title, author, path_field, formats_field):
         current_path = path_field.for_book(book_id, default_value='')
         path = self.construct_path_name(book_id, title, author)
@@ -2140,7 +2319,7 @@ def rename_extra_file(self, relpath, newrelpath, book_path, replace=True):
             os.replace(src, dest)
         return True
 
-    def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=False):
+    def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=False, copy_function=shutil.copy2):
         bookdir = os.path.join(self.library_path, book_path)
         dest = os.path.abspath(os.path.join(bookdir, relpath))
         if not self.normpath(dest).startswith(self.normpath(bookdir)):
@@ -2161,10 +2340,10 @@ def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=F
                 num += 1
         if isinstance(stream, str):
             try:
-                shutil.copy2(make_long_path_useable(stream), make_long_path_useable(dest))
+                copy_function(make_long_path_useable(stream), make_long_path_useable(dest))
             except FileNotFoundError:
                 os.makedirs(make_long_path_useable(os.path.dirname(dest)), exist_ok=True)
-                shutil.copy2(make_long_path_useable(stream), make_long_path_useable(dest))
+                copy_function(make_long_path_useable(stream), make_long_path_useable(dest))
         else:
             try:
                 d = open(make_long_path_useable(dest), 'wb')
@@ -2193,6 +2372,7 @@ def write_backup(self, path, raw):
                 del exc_info
             with open(path, 'wb') as f:
                 f.write(raw)
+        return path
 
     def read_backup(self, path):
         path = os.path.abspath(os.path.join(self.library_path, path, METADATA_FILE_NAME))
@@ -2420,6 +2600,10 @@ def dirty_books(self, book_ids):
     def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
+    def mark_books_as_clean(self, book_ids):
+        with self.conn:
+            self.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+
     def get_ids_for_custom_book_data(self, name):
         return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
@@ -2651,7 +2835,7 @@ def map_data(x):
     def get_top_level_move_items(self, all_paths):
         items = set(os.listdir(self.library_path))
         paths = set(all_paths)
-        paths.update({'metadata.db', 'full-text-search.db', 'metadata_db_prefs_backup.json', NOTES_DIR_NAME})
+        paths.update({'metadata.db', 'full-text-search.db', 'metadata_db_prefs_backup.json', NOTES_DIR_NAME, TABLES_SNAPSHOT_NAME})
         path_map = {x:x for x in paths}
         if not self.is_case_sensitive:
             for x in items:
@@ -5,13 +5,21 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import os
 import sys
 import traceback
 import weakref
-from threading import Event, Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import monotonic
 
+from calibre import detect_ncpus
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 
+RATE_WINDOW = 60  # seconds
+MAX_RETRY_DELAY = 600  # seconds
+
 
 def prints(*a, **kw):
     kw['file'] = sys.stderr
@@ -22,21 +30,48 @@ class Abort(Exception):
     pass
 
 
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        # The book folder was moved or deleted after the file was written,
+        # which dirties the book again
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class MetadataBackup(Thread):
     '''
     Continuously backup changed metadata into OPF files
     in the book directory. This class runs in its own
     thread.
+
+    If batch_size is larger than one, up to that many changed books are
+    backed up per round, by a pool of num_threads threads. The files written
+    in a round are flushed to disk together and then all the books in the
+    round are marked as clean in a single transaction. Books whose backup
+    fails are retried after a delay that doubles with every failure, so that
+    they do not hold up the books behind them.
     '''
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=1, num_threads=0):
         Thread.__init__(self)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
         self.stop_running = Event()
         self.interval = interval
         self.scheduling_interval = scheduling_interval
+        self.batch_size = batch_size
+        self.num_threads = num_threads or detect_ncpus()
         self.check_dirtied_annotations = 0
+        self.total_backed_up = 0
+        self.history = deque()
+        self.history_lock = Lock()
+        # Map of book id to (number of failures, time of next retry)
+        self.failures = {}
 
     @property
     def db(self):
@@ -52,15 +87,43 @@ def wait(self, interval):
         if self.stop_running.wait(interval):
             raise Abort()
 
+    @property
+    def queue_depth(self):
+        ' The number of books whose metadata is waiting to be backed up '
+        try:
+            return self.db.dirty_queue_length()
+        except Abort:
+            return 0
+
+    @property
+    def drain_rate(self):
+        ' The number of books backed up per second, over the last minute '
+        now = monotonic()
+        with self.history_lock:
+            while self.history and now - self.history[0][0] > RATE_WINDOW:
+                self.history.popleft()
+            if not self.history:
+                return 0
+            return sum(count for st, count in self.history) / max(now - self.history[0][0], 1)
+
+    def record_progress(self, start_time, count):
+        if count:
+            with self.history_lock:
+                self.history.append((start_time, count))
+                self.total_backed_up += count
+
     def run(self):
         while not self.stop_running.is_set():
             try:
                 self.wait(self.interval)
-                self.do_one()
+                if self.batch_size > 1:
+                    self.do_batches()
+                else:
+                    self.do_one()
             except Abort:
                 break
 
-    def do_one(self):
+    def check_annotations(self):
         self.check_dirtied_annotations += 1
         if self.check_dirtied_annotations > 2:
             self.check_dirtied_annotations = 0
@@ -68,8 +131,92 @@ def do_one(self):
                 self.db.check_dirtied_annotations()
             except Exception:
                 if self.stop_running.is_set() or self.db.is_closed:
-                    return
+                    return False
                 traceback.print_exc()
+        return True
+
+    def do_batches(self):
+        if not self.check_annotations():
+            return
+        with ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='MetadataBackup') as pool:
+            while self.do_batch(pool):
+                # Give the GUI thread a chance to do something between rounds
+                self.wait(self.scheduling_interval)
+
+    def do_batch(self, pool):
+        try:
+            book_ids = self.db.get_dirtied_books(self.batch_size, exclude=self.books_to_skip())
+        except Abort:
+            raise
+        except Exception:
+            # Happens during interpreter shutdown
+            return 0
+        if not book_ids:
+            return 0
+        st = monotonic()
+        done, written = {}, []
+        for book_id, result in zip(book_ids, pool.map(self.backup_one, book_ids)):
+            if result is None:
+                self.record_failure(book_id)
+            else:
+                self.failures.pop(book_id, None)
+                done[book_id], path = result
+                if path:
+                    written.append(path)
+        self.wait(0)
+        # Ensure the OPF files are on disk before the books are marked as
+        # clean, so that a crash cannot lose the only record of a change
+        tuple(pool.map(fsync_path, written))
+        count = self.db.clear_dirtied_books(done) if done else 0
+        self.record_progress(st, count)
+        return len(book_ids)
+
+    def books_to_skip(self):
+        now = monotonic()
+        return {book_id for book_id, (count, retry_at) in self.failures.items() if retry_at > now}
+
+    def record_failure(self, book_id):
+        if self.stop_running.is_set():
+            return
+        count = self.failures.get(book_id, (0, 0))[0] + 1
+        self.failures[book_id] = count, monotonic() + min(MAX_RETRY_DELAY, self.interval * 2 ** count)
+
+    def report_failure(self, msg, book_id):
+        # Only print the traceback the first time a book fails, it is retried
+        # repeatedly
+        if book_id not in self.failures:
+            prints(msg, book_id)
+            traceback.print_exc()
+
+    def backup_one(self, book_id):
+        # Runs in the pool. Returns None if the backup failed and should be
+        # retried, otherwise the dirtied sequence number of the book and the
+        # path to the written OPF file, if any.
+        if self.stop_running.is_set():
+            return None
+        db = self.db
+        try:
+            mi, sequence = db.get_metadata_for_dump(book_id)
+        except Exception:
+            self.report_failure('Failed to get backup metadata for id:', book_id)
+            return None
+        if mi is None:
+            return sequence, None
+        try:
+            raw = metadata_to_opf(mi)
+        except Exception:
+            prints('Failed to convert to opf for id:', book_id)
+            traceback.print_exc()
+            return sequence, None
+        try:
+            return sequence, db.write_backup(book_id, raw)
+        except Exception:
+            self.report_failure('Failed to write backup metadata for id:', book_id)
+            return None
+
+    def do_one(self):
+        if not self.check_annotations():
+            return
 
         try:
             book_id = self.db.get_a_dirtied_book()
@@ -82,6 +229,7 @@ def do_one(self):
             return
 
         self.wait(0)
+        st = monotonic()
 
         try:
             mi, sequence = self.db.get_metadata_for_dump(book_id)
@@ -129,6 +277,7 @@ def do_one(self):
                 return
 
         self.db.clear_dirtied(book_id, sequence)
+        self.record_progress(st, 1)
 
     def break_cycles(self):
         # Legacy compatibility
@@ -17,12 +17,13 @@
 from collections.abc import Iterable, MutableSet, Set
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
+from itertools import islice
 from queue import Queue
 from threading import Lock
 from time import mktime, monotonic, sleep, time
 from typing import NamedTuple
 
-from calibre import as_unicode, detect_ncpus, isbytestring
+from calibre import detect_ncpus, isbytestring
 from calibre.constants import iswindows, preferred_encoding
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
@@ -37,7 +38,7 @@
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.search import Search
 from calibre.db.tables import VirtualTable
-from calibre.db.utils import type_safe_sort_key_function
+from calibre.db.utils import DuplicatesIndex, type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import author_to_author_sort, string_to_authors, title_sort
@@ -51,7 +52,7 @@
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
-from polyglot.builtins import cmp, iteritems, itervalues, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, string_or_bytes
 
 
 class ExtraFile(NamedTuple):
@@ -167,6 +168,7 @@ def __init__(self, backend, library_database_instance=None):
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
         self.vls_cache_lock = Lock()
+        self.duplicates_index = None
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
@@ -270,19 +272,43 @@ def initialize_template_cache(self):
     @write_api
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
+        for field in itervalues(self.composites):
+            field.clear_dependencies()
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        ''' Clear the cached values of composite columns. If changed_fields is
+        specified, only columns whose templates could read one of those fields
+        are cleared. '''
         for field in itervalues(self.composites):
+            if changed_fields is not None:
+                deps = field.dependencies(self.fields, self.field_metadata)
+                if deps is not None and deps.isdisjoint(changed_fields):
+                    continue
             field.clear_caches(book_ids=book_ids)
 
     @write_api
     def clear_search_caches(self, book_ids=None):
         self.clear_search_cache_count += 1
         self._search_api.update_or_clear(self, book_ids)
+        for field in itervalues(self.fields):
+            field.update_category_index(book_ids)
+        self._update_duplicates_index(book_ids)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
+    def _update_duplicates_index(self, book_ids=None):
+        if self.duplicates_index is not None:
+            if book_ids is None:
+                self.duplicates_index = None
+            else:
+                self.duplicates_index.update(book_ids)
+
+    def _get_duplicates_index(self):
+        if self.duplicates_index is None:
+            self.duplicates_index = DuplicatesIndex(self.fields)
+        return self.duplicates_index
+
     @write_api
     def clear_extra_files_cache(self, book_id=None):
         if book_id is None:
@@ -1458,64 +1484,31 @@ def skf(book_id):
                 return skf
             return func
 
-        # Sort only once on any given field
-        fields = uniq(fields, operator.itemgetter(0))
-
-        if len(fields) == 1:
-            keyfunc = sort_key_func(fields[0][0])
-            reverse = not fields[0][1]
+        def sort_on_field(ids, field, ascending):
+            keyfunc = sort_key_func(field)
+            reverse = not ascending
             try:
-                return sorted(ids_to_sort, key=keyfunc, reverse=reverse)
+                return sorted(ids, key=keyfunc, reverse=reverse)
             except Exception as err:
-                print('Failed to sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
+                print('Failed to sort database on field:', field, 'with error:', err, file=sys.stderr)
                 try:
-                    return sorted(ids_to_sort, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
+                    return sorted(ids, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
                 except Exception as err:
-                    print('Failed to type-safe sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                    return sorted(ids_to_sort, reverse=reverse)
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey:
-
-            __slots__ = 'book_id', 'sort_key'
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def compare_to_other(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-            def __eq__(self, other):
-                return self.compare_to_other(other) == 0
-
-            def __ne__(self, other):
-                return self.compare_to_other(other) != 0
-
-            def __lt__(self, other):
-                return self.compare_to_other(other) < 0
+                    print('Failed to type-safe sort database on field:', field, 'with error:', err, file=sys.stderr)
+                    return sorted(ids, reverse=reverse)
 
-            def __le__(self, other):
-                return self.compare_to_other(other) <= 0
-
-            def __gt__(self, other):
-                return self.compare_to_other(other) > 0
-
-            def __ge__(self, other):
-                return self.compare_to_other(other) >= 0
+        # Sort only once on any given field
+        fields = uniq(fields, operator.itemgetter(0))
 
-        return sorted(ids_to_sort, key=SortKey)
+        # Python's sort is stable, so sorting on each field in turn, starting
+        # with the least significant one, is equivalent to sorting on all the
+        # keys at once. This lets each pass compare keys directly in C rather
+        # than through a python comparison function. The expensive collation
+        # keys are cached by the fields across sorts.
+        ans = list(ids_to_sort)
+        for field, ascending in reversed(fields):
+            ans = sort_on_field(ans, field, ascending)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
@@ -1534,17 +1527,20 @@ def search(self, query, restriction='', virtual_fields=None, book_ids=None):
 
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None):
-        ' Return the set of books in the specified virtual library '
+        ''' Return the set of books in the specified virtual library as a
+        :class:`calibre.db.utils.BookIdSet`, or, if there is neither a virtual
+        library nor a restriction, the frozenset of all books. '''
         vl = self._pref('virtual_libraries', {}).get(vl) if vl else None
         if not vl and not search_restriction:
-            return self.all_book_ids()
-        # We utilize the search restriction cache to speed this up
-        srch = partial(self._search, virtual_fields=virtual_fields)
+            return self._all_book_ids()
+        # We utilize the search restriction cache to speed this up, the
+        # results are returned as bitmaps so intersecting them is cheap
+        srch = partial(self._search_api.book_id_set, self, virtual_fields=virtual_fields)
         if vl:
             if search_restriction:
-                return frozenset(srch('', vl) & srch('', search_restriction))
-            return frozenset(srch('', vl))
-        return frozenset(srch('', search_restriction))
+                return srch(vl, search_restriction)
+            return srch(vl)
+        return srch(search_restriction)
 
     @read_api
     def number_of_books_in_virtual_library(self, vl=None, search_restriction=None):
@@ -1570,19 +1566,21 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
-                self._clear_composite_caches(book_ids)
+                if changed_fields is not None:
+                    changed_fields = frozenset(changed_fields) | {'last_modified'}
+                self._clear_composite_caches(book_ids, changed_fields=changed_fields)
             self._clear_search_caches(book_ids)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1654,9 +1652,13 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
 
         if dirtied:
+            changed_fields = {name}
+            if is_series:
+                changed_fields.add(f.name + '_index')
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+                changed_fields.add('path')
+            self._mark_as_dirty(dirtied, changed_fields=changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
@@ -1681,6 +1683,11 @@ def get_a_dirtied_book(self):
             return random.choice(tuple(self.dirtied_cache))
         return None
 
+    @read_api
+    def get_dirtied_books(self, limit=None, exclude=()):
+        ''' Return up to limit dirtied book ids, not in exclude, in the order they were dirtied '''
+        return tuple(islice((book_id for book_id in self.dirtied_cache if book_id not in exclude), limit))
+
     def _metadata_as_object_for_dump(self, book_id):
         mi = self._get_metadata(book_id)
         # Always set cover to cover.jpg. Even if cover doesn't exist,
@@ -1719,14 +1726,32 @@ def clear_dirtied(self, book_id, sequence):
             self.backend.mark_book_as_clean(book_id)
             self.dirtied_cache.pop(book_id, None)
 
+    @write_api
+    def clear_dirtied_books(self, book_id_sequence_map):
+        ''' Clear the dirtied indicator for many books at once, in a single
+        transaction. Books that have been dirtied again since sequence was
+        read are left alone. '''
+        clean = []
+        for book_id, sequence in book_id_sequence_map.items():
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                clean.append(book_id)
+        if clean:
+            self.backend.mark_books_as_clean(clean)
+            for book_id in clean:
+                self.dirtied_cache.pop(book_id, None)
+        return len(clean)
+
     @write_api
     def write_backup(self, book_id, raw):
+        ''' Write the OPF metadata backup for the book, returning the path to
+        the written file or None if the book does not exist. '''
         try:
             path = self._field_for('path', book_id).replace('/', os.sep)
         except Exception:
             return
 
-        self.backend.write_backup(path, raw)
+        return self.backend.write_backup(path, raw)
 
     @read_api
     def dirty_queue_length(self):
@@ -1933,7 +1958,7 @@ def protected_set_field(name, val):
             raise
         return dirtied
 
-    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
+    def _format_location(self, book_id):
         path = self._field_for('path', book_id)
         if path is None:
             # Theoretically, this should never happen, but apparently it
@@ -1947,7 +1972,10 @@ def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
             author = self._field_for('authors', book_id, default_value=(_('Unknown'),))[0]
         except IndexError:
             author = _('Unknown')
+        return path, title, author
 
+    def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
+        path, title, author = self._format_location(book_id)
         size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime)
         return size, fname
 
@@ -2012,6 +2040,77 @@ def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True,
         self.queue_next_fts_job()
         return True
 
+    @write_api
+    def add_formats_to_new_books(self, books, num_threads=0, copy_function=None):
+        '''
+        Add formats to books that have just been created and so have no formats
+        yet. ``books`` is a list of ``(book_id, format_map)`` as for
+        :meth:`add_books`. The files are copied into the library using
+        ``num_threads`` threads, by default the number of CPUs, which is much
+        faster than adding them one by one with :meth:`add_format` for large
+        numbers of books. File type plugins are not run.
+
+        If ``copy_function`` is specified, files specified as paths are placed
+        in the library by calling ``copy_function(src, dest)``, for example, to
+        hard link them instead of copying.
+
+        Returns a mapping of book id to the formats that were added, as
+        ``{fmt: path}``.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        jobs, ans = [], {}
+        for book_id, format_map in books:
+            if not self._has_id(book_id):
+                raise NoSuchBook(book_id)
+            ans[book_id] = {}
+            if format_map:
+                path, title, author = self._format_location(book_id)
+                # Create the folder here as the threads would race to do so
+                os.makedirs(make_long_path_useable(os.path.join(self.backend.library_path, path)), exist_ok=True)
+                for fmt, stream_or_path in format_map.items():
+                    jobs.append((book_id, (fmt or '').upper(), stream_or_path, title, author, path))
+
+        def copy(job):
+            # Only touches the filesystem, the tables are updated by the
+            # calling thread, which holds the write lock
+            book_id, fmt, stream_or_path, title, author, path = job
+            try:
+                if hasattr(stream_or_path, 'read'):
+                    return self.backend.add_format(book_id, fmt, stream_or_path, title, author, path, None)
+                if copy_function is not None:
+                    return self.backend.add_format_file(book_id, fmt, stream_or_path, title, author, path, copy_function)
+                with open(make_long_path_useable(stream_or_path), 'rb') as stream:
+                    return self.backend.add_format(book_id, fmt, stream, title, author, path, None)
+            except Exception as e:
+                return e
+
+        num_threads = min(len(jobs), num_threads or detect_ncpus())
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='AddFormats') as executor:
+                results = tuple(executor.map(copy, jobs))
+        else:
+            results = tuple(map(copy, jobs))
+
+        error, sizes, table = None, {}, self.fields['formats'].table
+        with self.backend.conn:
+            for (book_id, fmt, stream_or_path, title, author, path), result in zip(jobs, results):
+                if isinstance(result, Exception):
+                    error = error or result
+                    continue
+                size, fname = result
+                self.format_metadata_cache[book_id].pop(fmt, None)
+                sizes[book_id] = table.update_fmt(book_id, fmt, fname, size, self.backend)
+                ans[book_id][fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
+        if sizes:
+            self.fields['size'].table.update_sizes(sizes)
+            self._update_last_modified(tuple(sizes))
+            for book_id, fmts in ans.items():
+                for fmt in fmts:
+                    self.event_dispatcher(EventType.format_added, book_id, fmt.upper())
+        if error is not None:
+            raise error
+        return ans
+
     @write_api
     def remove_formats(self, formats_map, db_only=False):
         '''
@@ -2102,11 +2201,7 @@ def data_for_has_book(self):
         ''' Return data suitable for use in :meth:`has_book`. This can be used for an
         implementation of :meth:`has_book` in a worker process without access to the
         db. '''
-        try:
-            return {icu_lower(title) for title in itervalues(self.fields['title'].table.book_col_map)}
-        except TypeError:
-            # Some non-unicode titles in the db
-            return {icu_lower(as_unicode(title)) for title in itervalues(self.fields['title'].table.book_col_map)}
+        return set(self._get_duplicates_index().titles)
 
     @read_api
     def has_book(self, mi):
@@ -2117,12 +2212,20 @@ def has_book(self, mi):
         if title:
             if isbytestring(title):
                 title = title.decode(preferred_encoding, 'replace')
-            q = icu_lower(title).strip()
-            for title in itervalues(self.fields['title'].table.book_col_map):
-                if q == icu_lower(title):
-                    return True
+            return icu_lower(title).strip() in self._get_duplicates_index().titles
         return False
 
+    @read_api
+    def find_duplicate_books(self, mi, match_identifiers=False):
+        ''' Return the ids of books that have the same title (fuzzy matched)
+        and a superset of the authors of the passed in Metadata object. This
+        is the same test as :meth:`find_identical_books` but it uses an index
+        that is kept up to date as the library changes, so it is fast enough
+        to be used for every book when adding many books. If match_identifiers
+        is True, books that share an ISBN or other identifier with mi are also
+        returned. '''
+        return self._get_duplicates_index().find(mi, match_identifiers=match_identifiers)
+
     @read_api
     def has_id(self, book_id):
         ' Return True iff the specified book_id exists in the db '
@@ -2188,30 +2291,68 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
 
         return book_id
 
+    @write_api
+    def create_book_entries(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False):
+        '''
+        Create entries for many books in a single transaction, which is much
+        faster than calling :meth:`create_book_entry` for each of them.
+        ``books`` is an iterable of Metadata objects. Returns a list with the id of
+        the created book for every Metadata object, or None if it was a duplicate.
+        '''
+        try:
+            with self.backend.conn:
+                return [self._create_book_entry(
+                    mi, add_duplicates=add_duplicates, apply_import_tags=apply_import_tags, preserve_uuid=preserve_uuid)
+                    for mi in books]
+        except Exception:
+            # sqlite has rolled back the entire transaction, so re-read
+            # everything from the db to ensure the db and Cache are in sync
+            self._reload_from_db()
+            raise
+
     @api
-    def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None):
+    def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve_uuid=False, run_hooks=True, dbapi=None, batch_size=100):
         '''
         Add the specified books to the library. Books should be an iterable of
         2-tuples, each 2-tuple of the form :code:`(mi, format_map)` where mi is a
         Metadata object and format_map is a dictionary of the form :code:`{fmt: path_or_stream}`,
         for example: :code:`{'EPUB': '/path/to/file.epub'}`.
 
+        The books are added ``batch_size`` at a time, the entries for each batch
+        are created in a single transaction. When ``run_hooks`` is False the
+        files for a batch are copied into the library concurrently, see
+        :meth:`add_formats_to_new_books`.
+
         Returns a pair of lists: :code:`ids, duplicates`. ``ids`` contains the book ids for all newly created books in the
         database. ``duplicates`` contains the :code:`(mi, format_map)` for all books that already exist in the database
         as per the simple duplicate detection heuristic used by :meth:`has_book`.
         '''
         duplicates, ids = [], []
-        for mi, format_map in books:
-            book_id = self.create_book_entry(mi, add_duplicates=add_duplicates, apply_import_tags=apply_import_tags, preserve_uuid=preserve_uuid)
-            if book_id is None:
-                duplicates.append((mi, format_map))
+        books = iter(books)
+        while batch := tuple(islice(books, max(1, batch_size))):
+            book_ids = self.create_book_entries(
+                (mi for mi, format_map in batch), add_duplicates=add_duplicates, apply_import_tags=apply_import_tags,
+                preserve_uuid=preserve_uuid)
+            added = []
+            for (mi, format_map), book_id in zip(batch, book_ids):
+                if book_id is None:
+                    duplicates.append((mi, format_map))
+                else:
+                    ids.append(book_id)
+                    added.append((book_id, format_map))
+            if run_hooks:
+                fmt_maps = {}
+                for book_id, format_map in added:
+                    fmt_map = fmt_maps[book_id] = {}
+                    for fmt, stream_or_path in format_map.items():
+                        if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks):
+                            fmt_map[fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
             else:
-                fmt_map = {}
-                ids.append(book_id)
-                for fmt, stream_or_path in format_map.items():
-                    if self.add_format(book_id, fmt, stream_or_path, dbapi=dbapi, run_hooks=run_hooks):
-                        fmt_map[fmt.lower()] = getattr(stream_or_path, 'name', stream_or_path) or '<stream>'
-                run_plugins_on_postadd(dbapi or self, book_id, fmt_map)
+                fmt_maps = self.add_formats_to_new_books(added)
+                if added:
+                    self.queue_next_fts_job()
+            for book_id, format_map in added:
+                run_plugins_on_postadd(dbapi or self, book_id, fmt_maps[book_id])
         return ids, duplicates
 
     @write_api
@@ -2243,6 +2384,9 @@ def remove_books(self, book_ids, permanent=False):
             else:
                 table.remove_books(book_ids, self.backend)
         self._search_api.discard_books(book_ids)
+        for field in itervalues(self.fields):
+            field.update_category_index(book_ids)
+        self._update_duplicates_index(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
@@ -2354,7 +2498,7 @@ def rename_items(self, field, item_id_to_new_name_map, change_index=True, restri
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, changed_fields={field, 'path'} if field == 'authors' else {field})
             self._clear_link_map_cache(affected_books)
         self.event_dispatcher(EventType.items_renamed, field, affected_books, id_map)
         return affected_books, id_map
@@ -2374,7 +2518,7 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
             else:
-                self._mark_as_dirty(affected_books)
+                self._mark_as_dirty(affected_books, changed_fields={field.name})
             self._clear_link_map_cache(affected_books)
         self.event_dispatcher(EventType.items_removed, field, affected_books, item_ids)
         return affected_books
@@ -9,6 +9,7 @@
 from collections import OrderedDict
 from functools import partial
 
+from calibre.db.fields import CategoryRestriction, RatingIndex
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.icu import collation_order, sort_key
@@ -225,6 +226,10 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
 
     categories = OrderedDict()
     book_ids = frozenset(book_ids) if book_ids else book_ids
+    # Restricted counts are computed by intersecting the per item book sets
+    # maintained by the fields with the restriction
+    book_id_set = None if book_ids is None else CategoryRestriction(book_ids)
+    rating_index = RatingIndex(dbcache.fields['rating'], book_rating_map)
     pm_cache = {}
 
     def get_metadata(book_id):
@@ -249,15 +254,15 @@ def get_metadata(book_id):
             cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
         else:
             cat = fm[category]
-            brm = book_rating_map
+            ri = rating_index
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    ri = RatingIndex(dbcache.fields[category], dbcache.fields[category].book_value_map)
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
             cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+                tag_class, ri, lang_map, book_id_set)
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
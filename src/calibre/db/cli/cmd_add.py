@@ -8,7 +8,15 @@
 from optparse import OptionGroup, OptionValueError
 
 from calibre import prints
-from calibre.db.adding import cdb_find_in_dir, cdb_recursive_find, compile_rule, create_format_map, run_import_plugins, run_import_plugins_before_metadata
+from calibre.db.adding import (
+    bulk_import,
+    cdb_find_in_dir,
+    cdb_recursive_find,
+    compile_rule,
+    create_format_map,
+    run_import_plugins,
+    run_import_plugins_before_metadata,
+)
 from calibre.db.utils import find_identical_books
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover, serialize_cover
@@ -212,7 +220,7 @@ def add_ctx():
 def do_add(
     dbctx, paths, one_book_per_directory, recurse, add_duplicates, otitle, oauthors,
     oisbn, otags, oseries, oseries_index, ocover, oidentifiers, olanguages,
-    compiled_rules, oautomerge
+    compiled_rules, oautomerge, workers=0
 ):
     request_id = uuid4()
     with add_ctx():
@@ -246,6 +254,21 @@ def do_add(
 
         dir_dups = []
         scanner = cdb_recursive_find if recurse else cdb_find_in_dir
+        if dirs and workers > 0 and not dbctx.is_remote and oautomerge == 'disabled':
+            def report(num_done, num_added, rate):
+                prints(_('Processed {0} books, added {1} [{2:.1f} books per second]').format(num_done, num_added, rate))
+
+            ids, dups, errors = bulk_import(
+                dbctx.db, (formats for dpath in dirs for formats in scanner(dpath, one_book_per_directory, compiled_rules)),
+                add_duplicates, callback=report, num_workers=workers)
+            # Write the metadata backups for the new books, as do_adding() does
+            dbctx.db.new_api.dump_metadata()
+            added_ids |= set(ids)
+            dir_dups.extend((mi.title, formats) for mi, formats in dups)
+            for formats, tb in errors:
+                prints(_('Failed to read metadata from:'), ', '.join(formats), file=sys.stderr)
+                prints(tb, file=sys.stderr)
+            dirs = ()
         for dpath in dirs:
             for formats in scanner(dpath, one_book_per_directory, compiled_rules):
                 cover_data = None
@@ -447,6 +470,16 @@ def fadd(opt, action, help):
             ' even if they are not of a known e-book file type. Can be specified multiple times for multiple patterns.'
         )
     )
+    g.add_option(
+        '--workers',
+        type=int,
+        default=0,
+        help=_(
+            'Read the metadata of the books found in folders using the specified number of worker processes'
+            ' and add them to the library in large batches. Much faster when adding very many books. Only'
+            ' works with local libraries and not with the {} option.'
+        ).format('--automerge')
+    )
     parser.add_option_group(g)
 
     return parser
@@ -471,6 +504,6 @@ def main(opts, args, dbctx):
     do_add(
         dbctx, args, opts.one_book_per_directory, opts.recurse, opts.duplicates,
         opts.title, aut, opts.isbn, tags, opts.series, opts.series_index, opts.cover,
-        identifiers, lcodes, opts.filters, opts.automerge
+        identifiers, lcodes, opts.filters, opts.automerge, workers=opts.workers
     )
     return 0
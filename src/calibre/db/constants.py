@@ -10,6 +10,7 @@
 TRASH_DIR_NAME = '.caltrash'
 NOTES_DIR_NAME = '.calnotes'
 NOTES_DB_NAME = 'notes.db'
+TABLES_SNAPSHOT_NAME = 'metadata_db_snapshot.bin'
 DATA_DIR_NAME = 'data'
 DATA_FILE_PATTERN = f'{DATA_DIR_NAME}/**/*'
 BOOK_ID_PATH_TEMPLATE = ' ({})'
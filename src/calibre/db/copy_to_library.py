@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 # License: GPL v3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
 
+import errno
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from calibre.db.utils import find_identical_books
+from calibre import detect_ncpus
+from calibre.customize.ui import run_plugins_on_postadd
+from calibre.db.constants import COVER_FILE_NAME
+from calibre.db.utils import find_identical_books, fuzzy_title
 from calibre.utils.config import tweaks
 from calibre.utils.date import now
+from calibre.utils.filenames import copyfile, hardlink_file, reflink_file
+from calibre.utils.icu import lower as icu_lower
 from polyglot.builtins import iteritems
 
 
@@ -94,11 +105,10 @@ def copy_one_book(
                 'action': 'add', 'new_book_id': None
         }
         if duplicate_action != 'add':
-            # Scanning for dupes can be slow on a large library so
-            # only do it if the option is set
             if identical_books_data is None:
-                identical_books_data = identical_books_data = newdb.data_for_find_identical_books()
-            identical_book_list = find_identical_books(mi, identical_books_data)
+                identical_book_list = newdb.find_duplicate_books(mi)
+            else:
+                identical_book_list = find_identical_books(mi, identical_books_data)
             if identical_book_list:  # books with same author and nearly same title exist in newdb
                 if duplicate_action == 'add_formats_to_existing':
                     new_book_id = automerge_book(automerge_action, book_id, mi, identical_book_list, newdb, format_map, extra_file_map)
@@ -121,3 +131,257 @@ def copy_one_book(
         postprocess_copy(book_id, new_book_id, new_authors, db, newdb, identical_books_data, duplicate_action)
         return_data['new_book_id'] = new_book_id
         return return_data
+
+
+def read_journal(path):
+    ''' Return the records in the journal file at path, as a mapping of book
+    id in the source library to record. Later records for a book replace
+    earlier ones. '''
+    ans = {}
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return ans
+    with f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue  # A record truncated by an interruption
+            ans[r['book_id']] = r
+    return ans
+
+
+class LibraryFileCopier:
+
+    '''
+    Copy files from one library to another. When both libraries are on the
+    same device, files are reflinked if the filesystem supports it and,
+    if allow_hardlinks is True, hard linked otherwise, falling back to a normal
+    copy. Hard links are not used by default, because calibre changes some
+    files in the library, such as covers, in place, which would change them
+    in both libraries.
+    '''
+
+    def __init__(self, src_library_path, dest_library_path, allow_hardlinks=False):
+        try:
+            same_device = os.stat(src_library_path).st_dev == os.stat(dest_library_path).st_dev
+        except OSError:
+            same_device = False
+        self.use_reflinks = same_device
+        self.use_hardlinks = same_device and allow_hardlinks
+
+    def __call__(self, src, dest):
+        if self.use_reflinks:
+            try:
+                return reflink_file(src, dest)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # Not supported by the filesystem, dont try again
+                self.use_reflinks = False
+        if self.use_hardlinks:
+            try:
+                return hardlink_file(src, dest)
+            except FileNotFoundError:
+                raise
+            except OSError as err:
+                if err.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+                    self.use_hardlinks = False
+        copyfile(src, dest)
+
+
+def copy_books(
+    book_ids, src_db, dest_db, duplicate_action='add', automerge_action='overwrite', preserve_date=True,
+    preserve_uuid=False, allow_hardlinks=False, journal_path=None, batch_size=100, num_threads=0, notify=None, abort=None
+):
+    '''
+    Copy many books from src_db to dest_db, the same way as calling
+    :func:`copy_one_book` for each of them, but much faster. The entries for
+    the new books are created ``batch_size`` at a time, in a single transaction,
+    and their files are placed in the destination library using ``num_threads``
+    threads, by default the number of CPUs, see :class:`LibraryFileCopier`.
+    Books that are duplicates of books in the destination library are handled
+    by :func:`copy_one_book` after the batch they are in.
+
+    :param journal_path: The file that the per-book records are appended to.
+        Books that have a successful record in it are skipped. The id of every
+        new book is also written to it as soon as its entry is created, so
+        that if the copy is interrupted, the partially copied books are
+        removed and copied again when it is resumed.
+    :param notify: Called with every record as it is written.
+    :param abort: Called before every batch, the copy stops if it returns True.
+
+    Returns a mapping of book id to record, for all books in the journal,
+    including those copied by earlier runs. Records are as returned by
+    :func:`copy_one_book`, with the added keys ``error`` and ``traceback``.
+    '''
+    db = src_db.new_api
+    newdb = dest_db.new_api
+    records = {} if journal_path is None else read_journal(journal_path)
+    book_ids = iter([book_id for book_id in book_ids if records.get(book_id, {}).get('error', True) is not None])
+    notify = notify or (lambda record: None)
+    copier = LibraryFileCopier(db.backend.library_path, newdb.backend.library_path, allow_hardlinks=allow_hardlinks)
+    num_threads = num_threads or detect_ncpus()
+    journal = None if journal_path is None else open(journal_path, 'a+b')
+
+    def write(r):
+        if journal is not None:
+            journal.write(json.dumps(r).encode('utf-8') + b'\n')
+            journal.flush()
+
+    def record(book_id, return_data, error=None, tb=None):
+        r = return_data.copy() if return_data else {'book_id': book_id, 'title': None, 'authors': [], 'author': '', 'action': 'add', 'new_book_id': None}
+        r['error'], r['traceback'] = error, tb
+        records[book_id] = r
+        write(r)
+        notify(r)
+
+    def created(return_data, new_book_id):
+        # Replaced by the record for the book once it is completely copied
+        write(dict(return_data, new_book_id=new_book_id, error=_('Copying was interrupted'), traceback=None, pending=True))
+
+    def failed(book_id, return_data, err):
+        record(book_id, return_data, str(err), ''.join(traceback.format_exception(err)))
+
+    try:
+        if journal is not None and journal.tell():
+            # Start on a new line if the last run was interrupted while writing
+            journal.seek(-1, os.SEEK_END)
+            if journal.read(1) != b'\n':
+                journal.write(b'\n')
+            remove_interrupted_copies(records, newdb, write)
+        while batch := tuple(islice(book_ids, max(1, batch_size))):
+            if abort is not None and abort():
+                break
+            with db.safe_read_lock, newdb.write_lock:
+                deferred = copy_batch(
+                    batch, db, newdb, duplicate_action, preserve_date, preserve_uuid, copier, num_threads, record, failed, created)
+            for book_id in deferred:
+                try:
+                    return_data = copy_one_book(
+                        book_id, src_db, dest_db, duplicate_action=duplicate_action, automerge_action=automerge_action,
+                        preserve_date=preserve_date, preserve_uuid=preserve_uuid)
+                except Exception as err:
+                    failed(book_id, None, err)
+                else:
+                    record(book_id, return_data)
+    finally:
+        if journal is not None:
+            journal.close()
+    return records
+
+
+def remove_interrupted_copies(records, newdb, write):
+    # Remove the books whose entries were created by a copy that was
+    # interrupted before they were completely copied, so that they are
+    # copied again instead of being duplicated
+    interrupted = [r for r in records.values() if r.get('pending')]
+    if not interrupted:
+        return
+    newdb.remove_books({
+        r['new_book_id'] for r in interrupted if newdb.has_id(r['new_book_id']) and newdb.field_for('title', r['new_book_id']) == r['title']
+    }, permanent=True)
+    for r in interrupted:
+        del r['pending']
+        r['new_book_id'] = None
+        write(r)
+
+
+def copy_batch(batch, db, newdb, duplicate_action, preserve_date, preserve_uuid, copier, num_threads, record, failed, created):
+    # Copy the books in batch that are not duplicates, returning the ids of
+    # the duplicates. Must be called with the source library read locked and
+    # the destination library write locked.
+    books, deferred, pending_keys = [], [], set()
+    for book_id in batch:
+        try:
+            mi = db.get_metadata(book_id)
+            if not preserve_date:
+                mi.timestamp = now()
+            if duplicate_action != 'add':
+                key = fuzzy_title(mi.title), frozenset(map(icu_lower, mi.authors))
+                if key in pending_keys or newdb.find_duplicate_books(mi):
+                    deferred.append(book_id)
+                    continue
+                pending_keys.add(key)
+            format_map = {}
+            for fmt in db.formats(book_id, verify_formats=False):
+                path = db.format_abspath(book_id, fmt)
+                if path:
+                    format_map[fmt.upper()] = path
+            return_data = {
+                'book_id': book_id, 'title': mi.title, 'authors': mi.authors, 'author': mi.format_field('authors')[1],
+                'action': 'add', 'new_book_id': None
+            }
+            books.append((
+                book_id, mi, format_map, db.format_abspath(book_id, '__COVER_INTERNAL__'),
+                tuple((ef.relpath, ef.file_path) for ef in db.list_extra_files(book_id)),
+                {k for k, v in iteritems(newdb.get_item_ids('authors', mi.authors)) if v is None}, return_data))
+        except Exception as err:
+            failed(book_id, None, err)
+    if not books:
+        return deferred
+
+    try:
+        new_book_ids = newdb.create_book_entries(
+            (b[1] for b in books), add_duplicates=True, apply_import_tags=tweaks['add_new_book_tags_when_importing_books'],
+            preserve_uuid=preserve_uuid)
+    except Exception as err:
+        for b in books:
+            failed(b[0], b[-1], err)
+        return deferred
+    for new_book_id, b in zip(new_book_ids, books):
+        created(b[-1], new_book_id)
+    errors = {}
+    try:
+        newdb.add_formats_to_new_books(
+            [(new_book_id, b[2]) for new_book_id, b in zip(new_book_ids, books)], num_threads=num_threads, copy_function=copier)
+    except Exception as err:
+        # Find the books whose formats were not all added
+        for new_book_id, b in zip(new_book_ids, books):
+            if set(b[2]) - set(newdb.formats(new_book_id, verify_formats=False)):
+                errors[new_book_id] = err
+
+    def copy_files(job):
+        # Runs in a worker thread, so must not use the locked db API
+        new_book_id, nbp, cover, extra_files = job
+        try:
+            if cover:
+                copier(cover, os.path.join(newdb.backend.library_path, nbp, COVER_FILE_NAME))
+            for relpath, src_path in extra_files:
+                newdb.backend.add_extra_file(relpath, src_path, nbp, copy_function=copier)
+        except Exception as err:
+            return err
+
+    jobs = [(new_book_id, newdb.field_for('path', new_book_id), b[3], b[4]) for new_book_id, b in zip(new_book_ids, books) if b[3] or b[4]]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), num_threads)), thread_name_prefix='CopyBooks') as executor:
+        for job, err in zip(jobs, executor.map(copy_files, jobs)):
+            if err is not None:
+                errors.setdefault(job[0], err)
+    covers = {new_book_id: 1 for new_book_id, b in zip(new_book_ids, books) if b[3] and new_book_id not in errors}
+    if covers:
+        newdb.set_field('cover', covers)
+    for new_book_id, b in zip(new_book_ids, books):
+        if new_book_id not in errors:
+            try:
+                postprocess_copy(b[0], new_book_id, b[5], db, newdb, None, duplicate_action)
+            except Exception as err:
+                errors[new_book_id] = err
+    # Remove the partially copied books, so that they are copied again on resume
+    if errors:
+        newdb.remove_books(errors, permanent=True)
+
+    copied = False
+    for new_book_id, b in zip(new_book_ids, books):
+        book_id, return_data = b[0], b[-1]
+        if new_book_id in errors:
+            failed(book_id, return_data, errors[new_book_id])
+        else:
+            # As for books added with add_books()
+            run_plugins_on_postadd(newdb, new_book_id, {fmt.lower(): path for fmt, path in b[2].items()})
+            copied = True
+            return_data['new_book_id'] = new_book_id
+            record(book_id, return_data)
+    if copied:
+        newdb.queue_next_fts_job()
+    return deferred
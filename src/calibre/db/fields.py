@@ -9,10 +9,11 @@
 from collections import Counter, defaultdict
 from collections.abc import Iterable
 from functools import partial
+from itertools import chain
 from threading import Lock
 
 from calibre.db.tables import MANY_MANY, MANY_ONE, ONE_ONE, null
-from calibre.db.utils import atof, force_to_bool
+from calibre.db.utils import BookIdSet, atof, force_to_bool
 from calibre.db.write import Writer
 from calibre.ebooks.metadata import author_to_author_sort, rating_to_stars, title_sort
 from calibre.utils.config_base import tweaks
@@ -51,6 +52,142 @@ def IDENTITY(x):
     return x
 
 
+class SortKeyCache:
+
+    ''' Memoize an expensive sort key function, such as an ICU collation key,
+    by value. Since the cache is keyed on values rather than on books or
+    items, it never holds stale entries and can be kept across sorts. '''
+
+    __slots__ = ('cache', 'func', 'limit')
+
+    def __init__(self, func, limit=1 << 20):
+        self.func, self.limit = func, limit
+        self.cache = {}
+
+    def __call__(self, val):
+        try:
+            return self.cache[val]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable value
+            return self.func(val)
+        ans = self.func(val)
+        if len(self.cache) >= self.limit:
+            self.cache.clear()
+        self.cache[val] = ans
+        return ans
+
+    def clear(self):
+        self.cache.clear()
+
+
+class CategoryIndex:
+
+    '''
+    The books linked to every item of a field, built from the col_book_map of
+    the field's table. Items linked to many books are stored as a
+    :class:`BookIdSet` bitmap and the rest as frozensets, since a bitmap takes
+    one bit per possible book id and a set about 32 bytes per member. The tag
+    browser counts and ratings for a restricted set of books are computed by
+    intersecting these with the restriction, see :class:`CategoryRestriction`.
+    The index is kept up to date via :meth:`update` which is called with the
+    ids of books that were changed. '''
+
+    # Items with more than max_book_id / dense_factor books are stored as bitmaps
+    dense_factor = 256
+
+    def __init__(self, table, is_many_many):
+        self.table = table
+        self.is_many_many = is_many_many
+        self.max_book_id = max(table.book_col_map, default=0)
+        self.item_map = {item_id: self.item_set(book_ids) for item_id, book_ids in
+                         iteritems(table.col_book_map) if book_ids}
+        self.book_items = {book_id: self.items_for_book(book_id) for book_id in table.book_col_map}
+
+    def item_set(self, book_ids):
+        if len(book_ids) * self.dense_factor > self.max_book_id:
+            return book_ids if isinstance(book_ids, BookIdSet) else BookIdSet(book_ids)
+        return book_ids if isinstance(book_ids, frozenset) else frozenset(book_ids)
+
+    def items_for_book(self, book_id):
+        ans = self.table.book_col_map.get(book_id)
+        if ans is None:
+            return frozenset()
+        return frozenset(ans) if self.is_many_many else frozenset((ans,))
+
+    def update(self, book_ids):
+        added, removed = defaultdict(set), defaultdict(set)
+        for book_id in book_ids:
+            self.max_book_id = max(self.max_book_id, book_id)
+            old = self.book_items.pop(book_id, frozenset())
+            new = self.items_for_book(book_id)
+            if new:
+                self.book_items[book_id] = new
+            for item_id in new - old:
+                added[item_id].add(book_id)
+            for item_id in old - new:
+                removed[item_id].add(book_id)
+        empty = frozenset()
+        for item_id in set(added) | set(removed):
+            item_book_ids = (self.item_map.get(item_id, empty) | added.get(item_id, empty)) - removed.get(item_id, empty)
+            if item_book_ids:
+                self.item_map[item_id] = self.item_set(item_book_ids)
+            else:
+                self.item_map.pop(item_id, None)
+
+
+class CategoryRestriction:
+
+    '''
+    The set of books that tag browser categories are restricted to. Call with
+    the books of an item of a :class:`CategoryIndex` to get the restricted
+    books of the item. Sets are intersected with the set of book ids, bitmaps
+    with a bitmap of it, which is created when first needed. '''
+
+    __slots__ = ('_bitmap', 'book_ids')
+
+    def __init__(self, book_ids):
+        self.book_ids = book_ids if isinstance(book_ids, frozenset) else frozenset(book_ids)
+        self._bitmap = None
+
+    def __call__(self, item_book_ids):
+        if isinstance(item_book_ids, BookIdSet):
+            if self._bitmap is None:
+                self._bitmap = BookIdSet(self.book_ids)
+            return item_book_ids & self._bitmap
+        return item_book_ids & self.book_ids
+
+
+class RatingIndex:
+
+    '''
+    The average rating of sets of books, computed by intersecting them with
+    the books having each rating, when they are large enough for that to be
+    faster than looking up the rating of every book. '''
+
+    def __init__(self, rating_field, book_rating_map):
+        self.book_rating_map = book_rating_map
+        id_map = rating_field.table.id_map
+        self.bitmaps = tuple((id_map[item_id], book_ids) for item_id, book_ids in
+                             iteritems(rating_field.category_index().item_map) if id_map.get(item_id, 0) > 0)
+        # The cost of an intersection is proportional to the largest book id,
+        # the cost of a lookup is roughly that of intersecting 1024 book ids
+        self.cutoff = len(self.bitmaps) * max(book_rating_map, default=0) // 1024
+
+    def average(self, book_ids):
+        if len(book_ids) > self.cutoff:
+            total = count = 0
+            for rating, rated_book_ids in self.bitmaps:
+                num = len(rated_book_ids & book_ids)
+                total += rating * num
+                count += num
+        else:
+            ratings = tuple(r for r in (self.book_rating_map.get(book_id, 0) for
+                                        book_id in book_ids) if r > 0)
+            total, count = sum(ratings), len(ratings)
+        return total/count if count else 0
+
+
 class InvalidLinkTable(Exception):
 
     def __init__(self, name):
@@ -63,6 +200,8 @@ class Field:
     is_many = False
     is_many_many = False
     is_composite = False
+    supports_search_index = False
+    _category_index = None
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions, db_weakref):
         self.name, self.table = name, table
@@ -104,6 +243,10 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         if self.is_multiple and '&' in self.metadata['is_multiple']['list_to_ui']:
             self._sort_key = lambda x: sort_key(author_to_author_sort(x))
             self.sort_sort_key = False
+        self.sort_key_cache = None
+        if dt in ('text', 'series', 'enumeration') and self._sort_key is not IDENTITY:
+            # Collation keys are expensive to compute, keep them across sorts
+            self._sort_key = self.sort_key_cache = SortKeyCache(self._sort_key)
         self.default_value = {} if name == 'identifiers' else () if self.is_multiple else None
         self.category_formatter = str
         if dt == 'rating':
@@ -116,11 +259,31 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        self._category_index = None
 
     @property
     def metadata(self):
         return self.table.metadata
 
+    def clear_caches(self, book_ids=None):
+        if book_ids is None and self.sort_key_cache is not None:
+            self.sort_key_cache.clear()
+
+    def category_index(self):
+        ''' Return the :class:`CategoryIndex` for this field, only valid for
+        fields that have a col_book_map '''
+        ans = self._category_index
+        if ans is None or ans.table is not self.table:
+            ans = self._category_index = CategoryIndex(self.table, self.is_many_many)
+        return ans
+
+    def update_category_index(self, book_ids=None):
+        if self._category_index is not None:
+            if book_ids is None:
+                self._category_index = None
+            else:
+                self._category_index.update(book_ids)
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -169,20 +332,22 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         raise NotImplementedError()
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, rating_index, lang_map, book_ids=None):
+        '''
+        Return the tag browser items for this field. book_ids, if not None,
+        must be a :class:`CategoryRestriction` and rating_index a :class:`RatingIndex`.
+        '''
         ans = []
         if not self.is_many:
             return ans
 
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in iteritems(self.table.col_book_map):
+        for item_id, item_book_ids in iteritems(self.category_index().item_map):
             if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
+                item_book_ids = book_ids(item_book_ids)
             if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
+                avg = rating_index.average(item_book_ids)
                 try:
                     name = self.category_formatter(id_map[item_id])
                 except KeyError:
@@ -233,6 +398,24 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
             yield cbm.get(book_id, default_value), {book_id}
 
 
+# Names that templates can use for reading fields, other than field keys, and
+# the fields they depend on
+TEMPLATE_NAME_FIELDS = {
+    'application_id': (),
+    'author_sort': ('author_sort', 'authors'),
+    'book_size': ('size',),
+    'db_approx_formats': ('formats',),
+    'format_metadata': ('formats',),
+    'has_cover': ('cover',),
+    'id': (),
+    'language': ('languages',),
+    'ondevice_col': ('ondevice',),
+    'path': ('path', 'title', 'authors'),
+    'sort': ('sort', 'title'),
+    'title_sort': ('sort', 'title'),
+}
+
+
 class CompositeField(OneToOneField):
 
     is_composite = True
@@ -242,6 +425,7 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         super().__init__(name, table, bools_are_tristate, get_template_functions, db_weakref)
 
         self._render_cache = {}
+        self._dependencies = null
         self._lock = Lock()
         m = self.metadata
         self._composite_name = '#' + m['label']
@@ -327,6 +511,62 @@ def clear_caches(self, book_ids=None):
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def dependencies(self, fields, field_metadata, seen=frozenset()):
+        '''
+        Return the set of keys of the fields that the value of this column
+        depends on, or None if it could depend on anything. The dependencies
+        of any composite columns this column refers to are included.
+        '''
+        if self.name in seen:
+            return None  # A template that refers to itself
+        ans = self._dependencies
+        if ans is not null:
+            return ans
+        from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
+        from calibre.utils.formatter import template_references
+        ans = None
+        refs = template_references(self.metadata['display']['composite_template'], self.get_template_functions())
+        if refs is not None:
+            ans = set()
+            names, possible_names = refs
+            for name, must_be_field in chain(((x, True) for x in names), ((x, False) for x in possible_names)):
+                key = name.lower()
+                if key in TEMPLATE_NAME_FIELDS:
+                    ans.update(TEMPLATE_NAME_FIELDS[key])
+                    continue
+                if key in TOP_LEVEL_IDENTIFIERS:
+                    ans.add('identifiers')
+                    continue
+                if key not in fields:
+                    key = field_metadata.search_term_to_field_key(key)
+                field = fields.get(key)
+                if field is None:
+                    if must_be_field:
+                        ans = None
+                        break
+                    continue
+                if field.is_composite:
+                    deps = field.dependencies(fields, field_metadata, seen | {self.name})
+                    if deps is None:
+                        ans = None
+                        break
+                    ans |= deps
+                    continue
+                ans.add(key)
+                # Series and their indices are changed together
+                if key.endswith('_index') and key[:-len('_index')] in fields:
+                    ans.add(key[:-len('_index')])
+                elif key + '_index' in fields:
+                    ans.add(key + '_index')
+        if ans is not None:
+            ans = frozenset(ans)
+        if not seen:
+            self._dependencies = ans
+        return ans
+
+    def clear_dependencies(self):
+        self._dependencies = null
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -493,6 +733,7 @@ def __call__(self, item_id):
 class ManyToOneField(Field):
 
     is_many = True
+    supports_search_index = True
 
     def for_book(self, book_id, default_value=None):
         ids = self.table.book_col_map.get(book_id, None)
@@ -543,6 +784,7 @@ class ManyToManyField(Field):
 
     is_many = True
     is_many_many = True
+    supports_search_index = True
 
     def __init__(self, *args, **kwargs):
         Field.__init__(self, *args, **kwargs)
@@ -609,6 +851,8 @@ def book_value_map(self):
 
 class IdentifiersField(ManyToManyField):
 
+    supports_search_index = False
+
     def for_book(self, book_id, default_value=None):
         ids = self.table.book_col_map.get(book_id, None)
         if ids:
@@ -633,12 +877,12 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=()):
             if val:
                 yield val, {book_id}
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, rating_index, lang_map, book_ids=None):
         ans = []
 
-        for id_key, item_book_ids in iteritems(self.table.col_book_map):
+        for id_key, item_book_ids in iteritems(self.category_index().item_map):
             if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
+                item_book_ids = book_ids(item_book_ids)
             if item_book_ids:
                 c = tag_class(id_key, id_set=item_book_ids, count=len(item_book_ids))
                 ans.append(c)
@@ -667,6 +911,8 @@ def author_sort_for_book(self, book_id):
 
 class FormatsField(ManyToManyField):
 
+    supports_search_index = False
+
     def for_book(self, book_id, default_value=None):
         return self.table.book_col_map.get(book_id, default_value)
 
@@ -687,12 +933,12 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         for val, book_ids in iteritems(val_map):
             yield val, book_ids
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, rating_index, lang_map, book_ids=None):
         ans = []
 
-        for fmt, item_book_ids in iteritems(self.table.col_book_map):
+        for fmt, item_book_ids in iteritems(self.category_index().item_map):
             if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
+                item_book_ids = book_ids(item_book_ids)
             if item_book_ids:
                 c = tag_class(fmt, id_set=item_book_ids, count=len(item_book_ids))
                 ans.append(c)
@@ -722,13 +968,24 @@ def __call__(self, item_id, lang):
 
 class SeriesField(ManyToOneField):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.series_sort_key_cache = SortKeyCache(self._series_sort_key)
+
+    def _series_sort_key(self, val_and_lang):
+        val, lang = val_and_lang
+        return self._sort_key(title_sort(val, order=tweaks['title_series_sorting'], lang=lang))
+
+    def clear_caches(self, book_ids=None):
+        super().clear_caches(book_ids)
+        if book_ids is None:
+            self.series_sort_key_cache.clear()
+
     def sort_keys_for_books(self, get_metadata, lang_map):
-        sso = tweaks['title_series_sorting']
-        ssk = self._sort_key
-        ts = title_sort
+        sskc = self.series_sort_key_cache
 
         def sk(val, lang):
-            return ssk(ts(val, order=sso, lang=lang))
+            return sskc((val, lang))
         sk_map = LazySeriesSortMap(self._default_sort_key, sk, self.table.id_map)
         bcmg = self.table.book_col_map.get
         lang_map = {k:v[0] if v else None for k, v in iteritems(lang_map)}
@@ -7,21 +7,22 @@
 
 import operator
 import weakref
-from collections import OrderedDict, deque
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
 from datetime import timedelta
 from functools import partial
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
-from calibre.db.utils import force_to_bool
+from calibre.db.utils import BookIdSet, force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import primary_contains, primary_no_punc_contains, sort_key
 from calibre.utils.localization import canonicalize_lang, lang_map
 from calibre.utils.search_query_parser import ParseException, SearchQueryParser
-from polyglot.builtins import iteritems, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, string_or_bytes
 
 CONTAINS_MATCH = 0
 EQUALS_MATCH   = 1
@@ -472,12 +473,155 @@ def names(self):
 # }}}
 
 
+def compile_search_tree(tree):  # {{{
+    '''
+    Compile a parse tree produced by :class:`SearchQueryParser` into a plan.
+    A plan is a callable of the form ``plan(parser, candidates)`` that returns
+    the set of matching book ids, with the same semantics as
+    :meth:`SearchQueryParser.evaluate`. Plans hold no reference to the parser
+    so they can be cached and re-used across searches.
+    '''
+    op = tree[0]
+    if op == 'and':
+        lhs, rhs = compile_search_tree(tree[1]), compile_search_tree(tree[2])
+
+        def plan(sqp, candidates):
+            # RHS checks only those items matched by LHS
+            l = lhs(sqp, candidates)
+            return l.intersection(rhs(sqp, l))
+    elif op == 'or':
+        lhs, rhs = compile_search_tree(tree[1]), compile_search_tree(tree[2])
+
+        def plan(sqp, candidates):
+            # RHS checks only those items not matched by LHS
+            l = lhs(sqp, candidates)
+            return l.union(rhs(sqp, candidates.difference(l)))
+    elif op == 'not':
+        child = compile_search_tree(tree[1])
+
+        def plan(sqp, candidates):
+            return candidates.difference(child(sqp, candidates))
+    else:
+        location, query = tree[1], tree[2]
+        if location.lower() == 'search':
+            # Saved searches are resolved at evaluation time as they can
+            # change without the query text changing
+            def plan(sqp, candidates):
+                return sqp.evaluate_token((location, query), candidates)
+        else:
+            def plan(sqp, candidates):
+                return sqp._get_matches(location, query, candidates)
+    return plan
+# }}}
+
+
+class ItemSearchIndex:  # {{{
+
+    '''
+    An inverted index for a many-one or many-many field, mapping the case
+    folded value of every item to the ids of the items having that value. The
+    books for an item come from the col_book_map of the field's table, so the
+    index only needs to change when item values change. It is kept up to date
+    via :meth:`update` which is called with the ids of books that were
+    changed. '''
+
+    def __init__(self, field):
+        self.table = field.table
+        self.is_many_many = field.is_many_many
+        self.key_map = defaultdict(set)
+        self.item_keys = {}
+        self._sorted_keys = None
+        for item_id, val in iteritems(self.table.id_map):
+            self._set_item(item_id, val)
+
+    def _set_item(self, item_id, val):
+        key = icu_lower(val) if isinstance(val, str) else None
+        old_key = self.item_keys.get(item_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            items = self.key_map[old_key]
+            items.discard(item_id)
+            if not items:
+                del self.key_map[old_key]
+                self._sorted_keys = None
+        if key is None:
+            del self.item_keys[item_id]
+        else:
+            self.item_keys[item_id] = key
+            if key not in self.key_map:
+                self._sorted_keys = None
+            self.key_map[key].add(item_id)
+
+    def update(self, book_ids):
+        ''' Re-check the items linked to the specified books. Items that are
+        no longer present in the table are ignored at query time, so they need
+        not be removed here. '''
+        bcm, id_map = self.table.book_col_map, self.table.id_map
+        seen = set()
+        for book_id in book_ids:
+            item_ids = bcm.get(book_id)
+            if item_ids is None:
+                continue
+            if not self.is_many_many:
+                item_ids = (item_ids,)
+            for item_id in item_ids:
+                if item_id not in seen:
+                    seen.add(item_id)
+                    self._set_item(item_id, id_map.get(item_id))
+
+    @property
+    def sorted_keys(self):
+        ans = self._sorted_keys
+        if ans is None:
+            ans = self._sorted_keys = sorted(self.key_map)
+        return ans
+
+    def matching_items(self, query, matchkind, use_primary_find_in_search=True):
+        ''' Return the ids of items whose value matches query. query must
+        already be case folded, as returned by :func:`_matchkind`. '''
+        if matchkind == EQUALS_MATCH and not query.startswith('..'):
+            if query.startswith('.'):
+                # Hierarchical match: the query and all its children
+                prefix = query[1:]
+                keys = self.sorted_keys
+                ans = set()
+                for i in range(bisect_left(keys, prefix), len(keys)):
+                    key = keys[i]
+                    if not key.startswith(prefix):
+                        break
+                    if len(key) == len(prefix) or key[len(prefix)] == '.':
+                        ans |= self.key_map[key]
+                return ans
+            return self.key_map.get(query, set())
+        ans = set()
+        for key, item_ids in iteritems(self.key_map):
+            if _match(query, (key,), matchkind, use_primary_find_in_search=use_primary_find_in_search):
+                ans |= item_ids
+        return ans
+
+    def matches(self, query, matchkind, candidates, use_primary_find_in_search=True):
+        ''' Return the subset of candidates that have an item matching
+        query. '''
+        cbm, id_map = self.table.col_book_map, self.table.id_map
+        ans = set()
+        for item_id in self.matching_items(query, matchkind, use_primary_find_in_search):
+            book_ids = cbm.get(item_id)
+            if book_ids and item_id in id_map:
+                ans |= book_ids
+        return ans.intersection(candidates)
+# }}}
+
+
 class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache,
+                 plan_cache=None, search_index_for_field=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.plan_cache = plan_cache
+        self.search_index_for_field = search_index_for_field
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -515,6 +659,27 @@ def parse(self, *args, **kwargs):
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    def _parse(self, query, candidates=None):
+        # Evaluate the query via its compiled plan, compiling the parse tree
+        # on first use. Plans do not depend on the parser instance, so they
+        # are shared between searches via plan_cache.
+        plan = None if self.plan_cache is None else self.plan_cache.get(query)
+        if plan is None:
+            plan = compile_search_tree(self._get_tree(query))
+            if self.plan_cache is not None:
+                self.plan_cache[query] = plan
+        if candidates is None:
+            candidates = self.universal_set()
+        return plan(self, candidates)
+
+    def search_index(self, location):
+        if self.search_index_for_field is None:
+            return None
+        field = self.dbcache.fields.get(location)
+        if field is None or not getattr(field, 'supports_search_index', False):
+            return None
+        return self.search_index_for_field(field)
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
@@ -533,10 +698,14 @@ def get_matches(self, location, query, candidates=None,
             if not vl:
                 raise ParseException(_('No such Virtual library: {}').format(query))
             try:
-                return candidates & self.dbcache.books_in_virtual_library(
+                vl_ids = self.dbcache.books_in_virtual_library(
                             query, virtual_fields=self.virtual_fields)
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
+            # Return a mutable set, iterating over the smaller of the two
+            if len(vl_ids) < len(candidates):
+                return candidates.intersection(vl_ids)
+            return {x for x in candidates if x in vl_ids}
 
         if (len(location) > 2 and location.startswith('@') and
                     location[1:] in self.grouped_search_terms):
@@ -774,12 +943,16 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
-                    if val is not None:
-                        if isinstance(val, string_or_bytes):
-                            val = (val,)
-                        if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
-                            matches |= book_ids
+                sidx = None if case_sensitive else self.search_index(location)
+                if sidx is not None:
+                    matches |= sidx.matches(q, matchkind, current_candidates, use_primary_find_in_search=upf)
+                else:
+                    for val, book_ids in self.field_iter(location, current_candidates):
+                        if val is not None:
+                            if isinstance(val, string_or_bytes):
+                                val = (val,)
+                            if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
+                                matches |= book_ids
 
             if location == 'series_sort':
                 book_lang_map = self.dbcache.fields['languages'].book_value_map
@@ -886,6 +1059,9 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
         self.parse_cache = LRUCache(limit=100)
+        self.plan_cache = LRUCache(limit=100)
+        self.book_id_set_cache = LRUCache(limit=20)
+        self.search_indices = {}
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -894,9 +1070,11 @@ def change_locations(self, newlocs):
         if frozenset(newlocs) != frozenset(self.all_search_locations):
             self.clear_caches()
             self.parse_cache.clear()
+            self.plan_cache.clear()
         self.all_search_locations = newlocs
 
     def update_or_clear(self, dbcache, book_ids=None):
+        self.update_search_indices(book_ids)
         if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
             self.update_caches(dbcache, book_ids)
         else:
@@ -904,8 +1082,27 @@ def update_or_clear(self, dbcache, book_ids=None):
 
     def clear_caches(self):
         self.cache.clear()
+        self.book_id_set_cache.clear()
+
+    def search_index_for_field(self, field):
+        ans = self.search_indices.get(field.name)
+        if ans is None or ans.table is not field.table:
+            # Build the index lazily, on first use. The index is only swapped
+            # in once it is complete, so concurrent readers never see a
+            # partially built index.
+            ans = ItemSearchIndex(field)
+            self.search_indices[field.name] = ans
+        return ans
+
+    def update_search_indices(self, book_ids=None):
+        if book_ids is None:
+            self.search_indices.clear()
+        else:
+            for sidx in tuple(itervalues(self.search_indices)):
+                sidx.update(book_ids)
 
     def update_caches(self, dbcache, book_ids):
+        self.book_id_set_cache.clear()
         sqp = self.create_parser(dbcache)
         try:
             return self._update_caches(sqp, book_ids)
@@ -913,6 +1110,7 @@ def update_caches(self, dbcache, book_ids):
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def discard_books(self, book_ids):
+        self.book_id_set_cache.clear()
         book_ids = set(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
@@ -940,7 +1138,8 @@ def create_parser(self, dbcache, virtual_fields=None):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            plan_cache=self.plan_cache, search_index_for_field=self.search_index_for_field)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
@@ -955,6 +1154,29 @@ def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
+    def book_id_set(self, dbcache, *queries, virtual_fields=None):
+        '''
+        Return the books matching all the queries over the full library as a
+        :class:`BookIdSet`. The bitmaps of queries whose results are cached
+        are cached as well, as are their intersections, so that the same
+        object, whose hash is computed only once, is returned for a virtual
+        library and restriction until the library changes.
+        '''
+        key = tuple(q.strip() for q in queries)
+        ans = self.book_id_set_cache.get(key)
+        if ans is None:
+            if len(key) == 1:
+                ans = BookIdSet(self(dbcache, '', key[0], virtual_fields=virtual_fields))
+                cacheable = key[0] in self.cache
+            else:
+                ans = self.book_id_set(dbcache, key[0], virtual_fields=virtual_fields)
+                for q in key[1:]:
+                    ans &= self.book_id_set(dbcache, q, virtual_fields=virtual_fields)
+                cacheable = all((q,) in self.book_id_set_cache for q in key)
+            if cacheable:
+                self.book_id_set_cache.add(key, ans)
+        return ans
+
     def query_is_cacheable(self, sqp, dbcache, query):
         if query:
             for name, value in sqp.get_queried_fields(query):
@@ -979,6 +1201,10 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
 
         query = query.strip()
         use_cache = self.query_is_cacheable(sqp, dbcache, query)
+        if isinstance(book_ids, BookIdSet):
+            # Field iteration intersects item sets with the candidates, which
+            # is fastest when the candidates are a native set
+            book_ids = frozenset(book_ids)
 
         if use_cache and book_ids is None and query and not search_restriction:
             cached = self.cache.get(query)
@@ -6,11 +6,13 @@
 __docformat__ = 'restructuredtext en'
 
 import numbers
+from array import array
 from collections import defaultdict
-from collections.abc import Iterable
+from collections.abc import Iterable, MutableMapping
 from datetime import datetime, timedelta
 
 from calibre.ebooks.metadata import author_to_author_sort
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
 from calibre_extensions.speedup import parse_date as _c_speedup
@@ -52,6 +54,159 @@ def c_parse(val):
 null = object()
 
 
+# Columnar storage {{{
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def store_exact_type(typ, val):
+    if type(val) is not typ:
+        raise TypeError(f'Not a {typ.__name__}')
+    return val
+
+
+def store_bool(val):
+    if type(val) is not bool:
+        raise TypeError('Not a bool')
+    return int(val)
+
+
+def store_datetime(val):
+    # Only UTC datetimes can round trip unchanged, others are kept as is
+    if type(val) is not datetime or val.tzinfo is not utc_tz:
+        raise TypeError('Not a UTC datetime')
+    return (val - EPOCH) // ONE_MICROSECOND
+
+
+def load_datetime(val):
+    return EPOCH + timedelta(microseconds=val)
+
+
+COLUMNAR_TYPES = {
+    # datatype: (array typecode, to stored value, from stored value)
+    'int': ('q', lambda x: store_exact_type(int, x), identity),
+    'float': ('d', lambda x: store_exact_type(float, x), identity),
+    'bool': ('b', store_bool, bool),
+    'datetime': ('q', store_datetime, load_datetime),
+    'item_id': ('q', lambda x: store_exact_type(int, x), identity),
+}
+
+
+class ColumnarMap(MutableMapping):
+
+    '''
+    A mapping of book id to value that stores values in a typed array indexed
+    by book id, instead of as one boxed python object per book. Used for
+    fixed size data such as numbers, booleans, dates and the item ids of
+    many-one fields. Values that cannot be stored in the array, for example
+    None, are kept in an ordinary dict, so any value can be stored. '''
+
+    __slots__ = ('count', 'datatype', 'from_stored', 'overflow', 'present', 'to_stored', 'values')
+
+    ABSENT, IN_ARRAY, IN_OVERFLOW = 0, 1, 2
+
+    def __init__(self, datatype, items=()):
+        self.datatype = datatype
+        typecode, self.to_stored, self.from_stored = COLUMNAR_TYPES[datatype]
+        self.values = array(typecode)
+        self.present = bytearray()
+        self.overflow = {}
+        self.count = 0
+        self.update(items)
+
+    def _grow(self, book_id):
+        extra = book_id + 1 - len(self.present)
+        if extra > 0:
+            # Grow geometrically so that adding books one at a time is cheap
+            extra = max(extra, len(self.present) // 4)
+            self.present.extend(bytes(extra))
+            self.values.extend(array(self.values.typecode, bytes(extra * self.values.itemsize)))
+
+    def __setitem__(self, book_id, val):
+        if book_id < 0:
+            raise KeyError(book_id)
+        self._grow(book_id)
+        state = self.present[book_id]
+        try:
+            self.values[book_id] = self.to_stored(val)
+        except (TypeError, ValueError, OverflowError):
+            self.overflow[book_id] = val
+            self.present[book_id] = self.IN_OVERFLOW
+        else:
+            if state == self.IN_OVERFLOW:
+                del self.overflow[book_id]
+            self.present[book_id] = self.IN_ARRAY
+        if state == self.ABSENT:
+            self.count += 1
+
+    def _state(self, book_id):
+        try:
+            return self.present[book_id] if book_id >= 0 else self.ABSENT
+        except (IndexError, TypeError):
+            return self.ABSENT
+
+    def __getitem__(self, book_id):
+        state = self._state(book_id)
+        if state == self.IN_ARRAY:
+            return self.from_stored(self.values[book_id])
+        if state == self.IN_OVERFLOW:
+            return self.overflow[book_id]
+        raise KeyError(book_id)
+
+    def get(self, book_id, default=None):
+        state = self._state(book_id)
+        if state == self.IN_ARRAY:
+            return self.from_stored(self.values[book_id])
+        if state == self.IN_OVERFLOW:
+            return self.overflow[book_id]
+        return default
+
+    def __delitem__(self, book_id):
+        state = self._state(book_id)
+        if state == self.ABSENT:
+            raise KeyError(book_id)
+        if state == self.IN_OVERFLOW:
+            del self.overflow[book_id]
+        self.present[book_id] = self.ABSENT
+        self.count -= 1
+
+    def __contains__(self, book_id):
+        return self._state(book_id) != self.ABSENT
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (book_id for book_id, state in enumerate(self.present) if state)
+
+    def items(self):
+        values, overflow, fs = self.values, self.overflow, self.from_stored
+        for book_id, state in enumerate(self.present):
+            if state == self.IN_ARRAY:
+                yield book_id, fs(values[book_id])
+            elif state:
+                yield book_id, overflow[book_id]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __reduce__(self):
+        # The conversion functions are not picklable, so pickle the arrays
+        return restore_columnar_map, (self.datatype, self.values, self.present, self.overflow, self.count)
+
+
+def restore_columnar_map(datatype, values, present, overflow, count):
+    ans = ColumnarMap(datatype)
+    ans.values, ans.present, ans.overflow, ans.count = values, present, overflow, count
+    return ans
+
+
+def use_columnar_storage(datatype):
+    return datatype in COLUMNAR_TYPES and tweaks['use_columnar_storage_for_book_data']
+# }}}
+
+
 class Table:
 
     supports_notes = False
@@ -126,6 +281,9 @@ def read(self, db):
         else:
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
+        dt = self.metadata['datatype']
+        if use_columnar_storage(dt):
+            self.book_col_map = ColumnarMap(dt, self.book_col_map)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -150,7 +308,7 @@ def read(self, db):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = ColumnarMap('int', query) if use_columnar_storage('int') else dict(query)
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -224,6 +382,9 @@ def read_id_maps(self, db):
 
     def read_maps(self, db):
         cbm = self.col_book_map
+        if use_columnar_storage('item_id'):
+            # Each book maps to a single item id, store them as a column
+            self.book_col_map = ColumnarMap('item_id')
         bcm = self.book_col_map
         for book, item_id in db.execute(
                 'SELECT book, {} FROM {}'.format(
@@ -215,6 +215,104 @@ def test_add_books(self):  # {{{
         self.assertEqual(set(cache.formats(book_id)), {'FMT1', 'FMT2'})
         self.assertEqual(cache.format(book_id, 'FMT1'), FMT1)
         self.assertEqual(cache.format(book_id, 'FMT2'), FMT2)
+
+        # Adding in batches, with the files copied concurrently
+        books, paths = [], []
+        for i in range(7):
+            with PersistentTemporaryFile('.fmt1') as f:
+                f.write(b'fmt1 %d' % i)
+            paths.append(f.name)
+            books.append((Metadata(f'Batch {i % 5}', authors=['Batch Author']), {'FMT1': f.name, 'FMT2': BytesIO(b'fmt2 %d' % i)}))
+        books.append((mi, {}))
+        ids, duplicates = cache.add_books(books, add_duplicates=False, run_hooks=False, batch_size=3)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual([x[0].title for x in duplicates], ['Batch 0', 'Batch 1', 'Created One'])
+        for i, book_id in enumerate(ids):
+            self.assertEqual(cache.field_for('title', book_id), f'Batch {i}')
+            self.assertEqual(cache.format(book_id, 'FMT1'), b'fmt1 %d' % i)
+            self.assertEqual(cache.format(book_id, 'FMT2'), b'fmt2 %d' % i)
+            self.assertEqual(cache.field_for('size', book_id), len(b'fmt1 %d' % i))
+        self.assertEqual(cache.search('formats:FMT1 and title:Batch'), set(ids))
+        cache = self.init_cache()
+        for i, book_id in enumerate(ids):
+            self.assertEqual(set(cache.formats(book_id)), {'FMT1', 'FMT2'})
+            self.assertEqual(cache.format(book_id, 'FMT1'), b'fmt1 %d' % i)
+        for path in paths:
+            os.remove(path)
+    # }}}
+
+    def test_bulk_import(self):  # {{{
+        'Test adding books in bulk from folders'
+        from calibre.db.adding import bulk_import, cdb_recursive_find
+        cache = self.init_cache()
+        root = self.mkdtemp()
+        for i in range(5):
+            d = os.path.join(root, str(i % 3))
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f'Title {i % 4} - Author.txt'), 'wb') as f:
+                f.write(b'some text %d' % i)
+            if i == 1:
+                with open(os.path.join(d, f'Title {i % 4} - Author.epub'), 'wb') as f:
+                    f.write(b'not an epub')
+        progress = []
+        added_ids, duplicates, errors = bulk_import(
+            cache, cdb_recursive_find(root, single_book_per_directory=False), num_workers=2, batch_size=2,
+            callback=lambda *args: progress.append(args))
+        self.assertEqual(len(added_ids), 4)
+        self.assertEqual([mi.title for mi, paths in duplicates], ['Title 0 - Author'])
+        self.assertEqual(progress[-1][:2], (5, 4))
+        self.assertEqual({cache.field_for('title', book_id)[:7] for book_id in added_ids}, {f'Title {i}' for i in range(4)})
+        self.assertEqual({fmt for book_id in added_ids for fmt in cache.formats(book_id)}, {'TXT', 'EPUB'})
+        added_ids, duplicates, errors = bulk_import(cache, cdb_recursive_find(root, single_book_per_directory=False), num_workers=1)
+        self.assertFalse(added_ids)
+        self.assertEqual(len(duplicates), 5)
+        added_ids, duplicates, errors = bulk_import(cache, cdb_recursive_find(root), add_duplicates=True, num_workers=1)
+        self.assertEqual(len(added_ids), 3)
+        self.assertFalse(errors)
+
+        # Failures of the worker pool that are not caused by a book restart it
+        from importlib import import_module
+        from queue import Queue
+        from unittest.mock import patch
+
+        from calibre.utils.ipc.pool import Failure, Result, TerminalFailure, WorkerResult
+        plan = []
+
+        class FakePool:
+
+            max_workers = 2
+
+            def __init__(self, *a, **kw):
+                self.results, self.terminal_failure = Queue(), None
+
+            @property
+            def failed(self):
+                return self.terminal_failure is not None
+
+            def __call__(self, job_id, module, func, *args):
+                if self.failed:
+                    raise Failure(self.terminal_failure)
+                action = plan.pop(0) if plan else 'run'
+                if action == 'fail':
+                    self.terminal_failure = TerminalFailure('Failed to start worker process', 'traceback', None)
+                    return
+                self.results.put(WorkerResult(job_id, Result(getattr(import_module(module), func)(*args), None, None), False, None))
+                if action == 'crash_after':
+                    self.terminal_failure = TerminalFailure('Worker process crashed while sending common data', 'traceback', None)
+
+            def join(self, timeout):
+                pass
+
+            def shutdown(self):
+                pass
+
+        with patch('calibre.utils.ipc.pool.Pool', FakePool):
+            plan[:] = ['run', 'crash_after', 'fail', 'fail']
+            added_ids, duplicates, errors = bulk_import(cache, cdb_recursive_find(root), add_duplicates=True)
+            self.assertEqual(len(added_ids), 3)
+            self.assertFalse(errors)
+            plan[:] = ['fail'] * 10
+            self.assertRaises(Failure, bulk_import, cache, cdb_recursive_find(root), add_duplicates=True)
     # }}}
 
     def test_remove_books(self):  # {{{
@@ -464,6 +562,98 @@ def clear_extra_files(book_id):
 
     # }}}
 
+    def test_copy_books(self):  # {{{
+        import json
+        from unittest.mock import patch
+
+        from calibre.db.copy_to_library import copy_books, read_journal
+        from calibre.utils.filenames import reflink_file
+        src_db = self.init_cache()
+        dest_db = self.init_cache(self.cloned_library)
+        src_db.add_extra_files(1, {'exf': BytesIO(b'exf'), 'sub/recurse': BytesIO(b'recurse')})
+        journal = os.path.join(self.library_path, 'journal.jsonl')
+        book_ids = sorted(src_db.all_book_ids())
+        before = dest_db.all_book_ids()
+        notified = []
+
+        def new_book(book_id):
+            return records[book_id]['new_book_id']
+
+        postadd = []
+        with patch('calibre.db.copy_to_library.run_plugins_on_postadd', lambda db, book_id, fmt_map: postadd.append((book_id, fmt_map))), \
+                patch.object(dest_db, 'queue_next_fts_job') as queue_next_fts_job:
+            records = copy_books(book_ids, src_db, dest_db, journal_path=journal, batch_size=2, notify=notified.append)
+        self.assertEqual([r['book_id'] for r in notified], book_ids)
+        # File type plugins are run and indexing is started, once per batch, as when adding books
+        self.assertEqual({b for b, fmt_map in postadd}, {new_book(b) for b in book_ids})
+        self.assertEqual(dict(postadd)[new_book(1)], {fmt.lower(): src_db.format_abspath(1, fmt) for fmt in src_db.formats(1)})
+        self.assertEqual(queue_next_fts_job.call_count, 2)
+        self.assertEqual(read_journal(journal), records)
+        for book_id in book_ids:
+            r = records[book_id]
+            self.assertIsNone(r['error'])
+            self.assertEqual(r['action'], 'add')
+            self.assertNotIn(r['new_book_id'], before)
+            self.assertEqual(src_db.field_for('title', book_id), dest_db.field_for('title', r['new_book_id']))
+            for fmt in src_db.formats(book_id):
+                self.assertEqual(src_db.format(book_id, fmt), dest_db.format(r['new_book_id'], fmt))
+            self.assertEqual(src_db.cover(book_id), dest_db.cover(r['new_book_id']))
+        self.assertEqual(
+            {ef.relpath: open(ef.file_path, 'rb').read() for ef in dest_db.list_extra_files(new_book(1))},
+            {'exf': b'exf', 'sub/recurse': b'recurse'})
+        self.assertEqual(src_db.all_annotations_for_book(1), dest_db.all_annotations_for_book(new_book(1)))
+
+        # Resuming copies only the books that are not in the journal
+        del notified[:]
+        with open(journal, 'rb') as f:
+            lines = [line for line in f if json.loads(line)['book_id'] != 3]
+        with open(journal, 'wb') as f:
+            f.writelines(lines)
+            f.write(b'{"book_id": 3, "truncated')
+        records = copy_books(book_ids, src_db, dest_db, journal_path=journal, notify=notified.append)
+        self.assertEqual([r['book_id'] for r in notified], [3])
+        self.assertEqual(len(read_journal(journal)), len(book_ids))
+
+        # Books whose copy was interrupted after their entries were created
+        # are removed and copied again, not duplicated
+        os.remove(journal)
+        before = dest_db.all_book_ids()
+
+        def crash(*args):
+            raise KeyboardInterrupt()
+        with patch('calibre.db.copy_to_library.run_plugins_on_postadd', crash), self.assertRaises(KeyboardInterrupt):
+            copy_books(book_ids, src_db, dest_db, journal_path=journal, batch_size=2)
+        self.assertEqual(len(dest_db.all_book_ids()), len(before) + 2)
+        records = copy_books(book_ids, src_db, dest_db, journal_path=journal, batch_size=2)
+        new_book_ids = dest_db.all_book_ids() - before
+        self.assertEqual(new_book_ids, {new_book(b) for b in book_ids})
+        self.assertEqual(read_journal(journal), records)
+        self.assertNotIn('pending', json.dumps(records))
+        self.assertEqual(copy_books(book_ids, src_db, dest_db, journal_path=journal), records)
+        self.assertEqual(dest_db.all_book_ids() - before, new_book_ids)
+
+        # Duplicates are not copied
+        before = dest_db.all_book_ids()
+        records = copy_books(book_ids, src_db, dest_db, duplicate_action='ignore')
+        self.assertEqual({r['action'] for r in records.values()}, {'duplicate'})
+        self.assertEqual(before, dest_db.all_book_ids())
+
+        # Hard links are used only when allowed and reflinks are not supported
+        def is_hardlinked():
+            return os.stat(src_db.format_abspath(1, 'FMT1')).st_ino == os.stat(dest_db.format_abspath(new_book(1), 'FMT1')).st_ino
+        try:
+            reflink_file(src_db.format_abspath(1, 'FMT1'), os.path.join(self.cloned_library, 'reflink-test'))
+        except OSError:
+            reflinks_supported = False
+        else:
+            reflinks_supported = True
+        records = copy_books([1], src_db, dest_db)
+        self.assertFalse(is_hardlinked())
+        records = copy_books([1], src_db, dest_db, allow_hardlinks=True)
+        self.assertEqual(src_db.format(1, 'FMT1'), dest_db.format(new_book(1), 'FMT1'))
+        self.assertEqual(is_hardlinked(), not reflinks_supported)
+    # }}}
+
     def test_merging_extra_files(self):  # {{{
         db = self.init_cache()
 
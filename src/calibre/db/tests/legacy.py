@@ -11,7 +11,7 @@
 from io import BytesIO
 from operator import itemgetter
 
-from calibre.db.constants import NOTES_DIR_NAME
+from calibre.db.constants import NOTES_DIR_NAME, TABLES_SNAPSHOT_NAME
 from calibre.db.tests.base import BaseTest
 from calibre.library.field_metadata import fm_as_dict
 from polyglot import reprlib
@@ -279,6 +279,8 @@ def f(x, y):  # get_top_level_move_items is broken in the old db on case-insensi
             y.pop('full-text-search.db', None)
             x.discard(NOTES_DIR_NAME)
             y.pop(NOTES_DIR_NAME, None)
+            x.discard(TABLES_SNAPSHOT_NAME)
+            y.pop(TABLES_SNAPSHOT_NAME, None)
             return x, y
         self.assertEqual(f(*db.get_top_level_move_items()), f(*ndb.get_top_level_move_items()))
         d1, d2 = BytesIO(), BytesIO()
@@ -218,6 +218,19 @@ def test_sorting(self):  # {{{
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+
+        # Test that cached sort keys do not go stale when values change
+        cache.set_field('series', {1: 'b', 2: 'a', 3: 'c'})
+        ae([2, 1, 3], cache.multisort([('series', True)], ids_to_sort=(1, 2, 3)))
+        self.assertTrue(cache.fields['series'].series_sort_key_cache.cache)
+        cache.rename_items('series', {cache.get_item_id('series', 'a'): 'd'})
+        ae([1, 3, 2], cache.multisort([('series', True)], ids_to_sort=(1, 2, 3)))
+        cache.set_field('title', {1: 'z', 2: 'y', 3: 'x'})
+        ae([3, 2, 1], cache.multisort([('#one', True), ('title', True)], ids_to_sort=(1, 2, 3)))
+        cache.set_field('title', {1: 'a'})
+        ae([1, 3, 2], cache.multisort([('#one', True), ('title', True)], ids_to_sort=(1, 2, 3)))
+        cache.clear_caches()
+        self.assertFalse(cache.fields['sort'].sort_key_cache.cache)
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -546,6 +559,8 @@ def test_restrictions(self):  # {{{
         se({1,2}, cache.books_in_virtual_library('12'))
         se({1}, cache.books_in_virtual_library('12', 'id:1'))
         se({2}, cache.books_in_virtual_library('1', 'id:1 or id:2'))
+        self.assertIs(cache.books_in_virtual_library('12', 'id:1'), cache.books_in_virtual_library('12', 'id:1'))
+        self.assertIsInstance(cache.books_in_virtual_library(''), frozenset)
     # }}}
 
     def test_search_caching(self):  # {{{
@@ -604,6 +619,114 @@ def test(hit, result, *args, **kw):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_search_indices(self):  # {{{
+        ' Test that the per-field search indices are kept up to date '
+        cache = self.init_cache()
+        ae = self.assertEqual
+        ae(cache.search('tags:"=tag one"'), {1, 2})
+        ae(cache.search('tags:"=.tag one"'), {1, 2})
+        self.assertIn('tags', cache._search_api.search_indices)
+        cache.set_field('tags', {3: ('Tag One.child', 'Three')})
+        ae(cache.search('tags:"=.tag one"'), {1, 2, 3})
+        ae(cache.search('tags:"=tag one"'), {1, 2})
+        ae(cache.search('tags:child'), {3})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One.child'): 'renamed'})
+        ae(cache.search('tags:"=.tag one"'), {1, 2})
+        ae(cache.search('tags:=renamed'), {3})
+        cache.remove_items('tags', (cache.get_item_id('tags', 'renamed'),))
+        ae(cache.search('tags:=renamed'), set())
+        ae(cache.search('publisher:=ppppp'), set())
+        cache.set_field('publisher', {1: 'ppppp'})
+        ae(cache.search('publisher:=ppppp'), {1})
+        ae(cache.search('publisher:pppp and tags:"tag one"'), {1})
+        cache.clear_caches()
+        self.assertNotIn('tags', cache._search_api.search_indices)
+        ae(cache.search('tags:"=tag one"'), {1, 2})
+    # }}}
+
+    def test_load_modes(self):  # {{{
+        ' Test reading the tables in parallel and from a snapshot '
+        from calibre.db.constants import TABLES_SNAPSHOT_NAME
+        from calibre.utils.config_base import tweaks
+        ae = self.assertEqual
+
+        def read_all(cache):
+            return {field: {book_id: cache.field_for(field, book_id) for book_id in cache.all_book_ids()}
+                    for field in cache.fields if field != 'ondevice'}
+
+        cache = self.init_cache()
+        expected = read_all(cache)
+        # A rating of zero is removed while reading, which cannot be done using
+        # the read only connections of the threads
+        cache.backend.execute('INSERT INTO ratings (rating) VALUES (0)')
+        snapshot = os.path.join(self.library_path, TABLES_SNAPSHOT_NAME)
+        orig = tweaks['library_load_threads'], tweaks['use_library_load_snapshot']
+        tweaks['library_load_threads'], tweaks['use_library_load_snapshot'] = 4, True
+        try:
+            cache = self.init_cache()
+            ae(read_all(cache), expected)
+            ae(cache.backend.conn.get('SELECT COUNT(*) FROM ratings WHERE rating=0', all=False), 0)
+            self.assertTrue(os.path.exists(snapshot))
+            cache = self.init_cache()
+            ae(read_all(cache), expected)
+            self.assertIn(TABLES_SNAPSHOT_NAME, cache.backend.get_top_level_move_items(())[0])
+            # Snapshots that were not written by this user are ignored
+            with open(snapshot, 'r+b') as f:
+                f.seek(len(cache.backend.TABLES_SNAPSHOT_MAGIC))
+                f.write(b'\0' * 32)
+            cache = self.init_cache()
+            ae(read_all(cache), expected)
+            with open(snapshot, 'rb') as f:
+                f.seek(len(cache.backend.TABLES_SNAPSHOT_MAGIC))
+                self.assertNotEqual(f.read(32), b'\0' * 32)
+            cache.set_field('title', {1: 'changed'})
+            tweaks['library_load_threads'] = 1
+            ae(self.init_cache().field_for('title', 1), 'changed')
+            ae(self.init_cache().field_for('title', 1), 'changed')
+        finally:
+            tweaks['library_load_threads'], tweaks['use_library_load_snapshot'] = orig
+    # }}}
+
+    def test_category_indices(self):  # {{{
+        ' Test that the per-field category indices are kept up to date '
+        from calibre.db.fields import CategoryIndex
+        # Run with the default, where the items of the test library are all
+        # stored as bitmaps, and with items that have a single book stored as sets
+        libraries = self.cloned_library, self.cloned_library
+        for dense_factor, library_path in zip((CategoryIndex.dense_factor, 2), libraries):
+            orig, CategoryIndex.dense_factor = CategoryIndex.dense_factor, dense_factor
+            try:
+                self.check_category_indices(library_path)
+            finally:
+                CategoryIndex.dense_factor = orig
+
+    def check_category_indices(self, library_path):
+        cache = self.init_cache(library_path)
+        ae = self.assertEqual
+
+        def cats(book_ids=None):
+            return {category: {t.name: (t.count, set(t.id_set), t.avg_rating) for t in items}
+                    for category, items in cache.get_categories(book_ids=book_ids).items() if category != 'search'}
+
+        def check(book_ids=None):
+            incremental = cats(book_ids)
+            cache.clear_caches()
+            ae(incremental, cats(book_ids))
+
+        check(), check({1, 2})
+        cache.set_field('tags', {3: ('Tag One', 'Three'), 1: ()})
+        cache.set_field('rating', {2: 8})
+        cache.set_field('publisher', {1: 'ppppp', 2: None})
+        ae(cats()['tags']['Tag One'][1], {2, 3})
+        check(), check({1, 3})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'): 'Three'})
+        cache.remove_items('publisher', (cache.get_item_id('publisher', 'ppppp'),))
+        check(), check({2})
+        cache.remove_books((1,))
+        ae(cats()['tags']['Three'][1], {2, 3})
+        check(), check({2, 3})
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -768,6 +891,23 @@ def test_composites(self):  # {{{
         self.assertEqual(cache.search('#ccf:FMT1'), {1, 2})
         cache.remove_formats({1:('FMT1',)})
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
+
+        # Test that only composites depending on a changed field are re-rendered
+        f = cache.fields['#ccp']
+        self.assertEqual(f.dependencies(cache.fields, cache.field_metadata), {'publisher'})
+        self.assertEqual(cache.fields['#ccf'].dependencies(cache.fields, cache.field_metadata), {'formats'})
+        self.assertEqual(cache.fields['#mult'].dependencies(cache.fields, cache.field_metadata), set())
+        cache.field_for('#ccp', 1), cache.field_for('#mult', 1)
+        cache.set_field('tags', {1:'newtag'})
+        self.assertIn(1, f._render_cache)
+        self.assertIn(1, cache.fields['#mult']._render_cache)
+        cache.set_field('publisher', {1:'Two'})
+        # The search cache for #ccp:One may have re-rendered it already
+        self.assertNotEqual(f._render_cache.get(1), 'One')
+        self.assertEqual(cache.field_for('#ccp', 1), 'Two')
+        cache.create_custom_column('ccl', 'CC10', 'composite', False, display={'composite_template': "{:'field($publisher)'}"})
+        cache = self.init_cache()
+        self.assertIsNone(cache.fields['#ccl'].dependencies(cache.fields, cache.field_metadata))
     # }}}
 
     def test_find_identical_books(self):  # {{{
@@ -790,6 +930,26 @@ def test_find_identical_books(self):  # {{{
         ):
             self.assertEqual(books, cache.find_identical_books(mi))
             self.assertEqual(books, find_identical_books(mi, data))
+            self.assertEqual(books, cache.find_duplicate_books(mi))
+
+        # The index used by find_duplicate_books() is kept up to date
+        ae = self.assertEqual
+        mi = Metadata('The Title: One', ['author one'])
+        mi.set_identifiers({'isbn': '978-0-306-40615-7'})
+        ae(cache.find_duplicate_books(mi), {2})
+        cache.set_field('title', {2: 'Title Two'})
+        ae(cache.find_duplicate_books(mi), set())
+        self.assertFalse(cache.has_book(Metadata('title one')))
+        cache.set_field('identifiers', {3: {'isbn': '9780306406157'}})
+        ae(cache.find_duplicate_books(mi), set())
+        ae(cache.find_duplicate_books(mi, match_identifiers=True), {3})
+        book_id = cache.create_book_entry(Metadata('Title One', ['Author One']))
+        ae(cache.find_duplicate_books(mi), {book_id})
+        self.assertTrue(cache.has_book(Metadata('title one')))
+        self.assertIn('title one', cache.data_for_has_book())
+        cache.remove_books((book_id, 3))
+        ae(cache.find_duplicate_books(mi, match_identifiers=True), set())
+        self.assertFalse(cache.has_book(Metadata('title one')))
     # }}}
 
     def test_last_read_positions(self):  # {{{
@@ -955,3 +1115,39 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_compiled_templates(self):  # {{{
+        ' Test that compiled templates give the same results as the interpreter '
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter import BENCHMARK_TEMPLATES
+        from calibre.utils.formatter_functions import load_user_template_functions, unload_user_template_functions
+        db = self.init_legacy(self.library_path)
+        load_user_template_functions('aaaaa', [
+            ['stored', '', 0, "program: arguments(a, b='x'); if a == 'r' then return 'early' fi; strcat(a, b)"],
+            ['stored2', '', 0, "program: arguments(a); stored(a) & stored(a, 'q')"],
+        ], None)
+        templates = BENCHMARK_TEMPLATES + (
+            "program: for x in 'tags': if x == 'News' then continue fi; r = x; break rof; r",
+            "program: for x in 'a,b,c': if x == 'b' then return 'ret' fi rof; 'no'",
+            'program: for i in range(0, 5000): 1 rof',
+            "program: def g(a, b='z'): strcat(a, b) fed; g('x') & g('x', 'y') & g(1, 2, 3)",
+            "program: globals(q='d'); set_globals(r=q); q & raw_field('nosuch', 'dflt') & field('nosuch')",
+            "program: list_count_field('tags') & ('news' inlist_field 'tags') & $$rating & undefined",
+            "program: switch_if('', 'a', '1', 'b', 'c') & switch($title, '[', 'b', 'c')",
+            "program: 1 + 2.5 * -3 / 2 - $rating & ('x' - 1)",
+            "program: stored('1') & stored('r') & stored2('z')",
+        )
+        formatter = SafeFormat()
+        try:
+            for book_id in (1, 2, 3):
+                mi = db.get_metadata(book_id, index_is_id=True)
+                for template in templates:
+                    results = []
+                    for use_compiled_programs in (False, True):
+                        formatter.use_compiled_programs = use_compiled_programs
+                        global_vars = {}
+                        results.append((formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, global_vars=global_vars), global_vars))
+                    self.assertEqual(results[0], results[1], template)
+        finally:
+            unload_user_template_functions('aaaaa')
+    # }}}
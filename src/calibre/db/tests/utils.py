@@ -81,3 +81,89 @@ def test_thumbnail_cache(self):  # {{{
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
     # }}}
+
+    def test_book_id_set(self):  # {{{
+        ' Test the bitmap backed book id set '
+        from calibre.db.utils import BookIdSet
+        ae = self.assertEqual
+        a, b = BookIdSet({1, 5, 9, 100}), BookIdSet([5, 100, 200])
+        ae(a & b, {5, 100})
+        ae(a | b, {1, 5, 9, 100, 200})
+        ae(a - b, {1, 9})
+        ae(a ^ b, {1, 9, 200})
+        ae({1, 5, 7} & a, {1, 5})
+        ae({1, 5, 7} - a, {7})
+        ae(len(a), 4)
+        ae(list(a), [1, 5, 9, 100])
+        self.assertIn(100, a)
+        self.assertNotIn(101, a)
+        self.assertNotIn(-1, a)
+        ae(a, BookIdSet(frozenset(a)))
+        ae(hash(a), hash(BookIdSet(sorted(a))))
+        ae(hash(a), hash(frozenset(a)))
+        ae({frozenset(a): 1}[a], 1)
+        self.assertTrue(a.issubset(range(101)))
+        self.assertTrue(a.isdisjoint(BookIdSet({2, 3})))
+        ae(a.intersection([5, 9, 11]), {5, 9})
+        ae(a.union({2}), {1, 2, 5, 9, 100})
+        self.assertFalse(BookIdSet())
+        ae(BookIdSet() | a, a)
+        import pickle
+        ae(pickle.loads(pickle.dumps(a)), a)
+    # }}}
+
+    def test_columnar_map(self):  # {{{
+        ' Test the typed array backed book data storage '
+        from calibre.db.tables import ColumnarMap
+        from calibre.utils.config_base import tweaks
+        from calibre.utils.date import utcnow
+        ae = self.assertEqual
+        m = ColumnarMap('datetime')
+        d = utcnow()
+        m[3] = d
+        m[7] = None
+        m[1000] = d.replace(tzinfo=None)
+        ae(len(m), 3)
+        ae(m[3], d)
+        self.assertIs(m[3].tzinfo, d.tzinfo)
+        self.assertIsNone(m[7])
+        ae(list(m), [3, 7, 1000])
+        self.assertNotIn(4, m)
+        self.assertNotIn(-3, m)
+        ae(m.get(4, 'x'), 'x')
+        ae(m.pop(7), None)
+        ae(len(m), 2)
+        m[3] = 1
+        ae(m.copy(), {3: 1, 1000: d.replace(tzinfo=None)})
+        m = ColumnarMap('bool', {1: True, 2: False, 3: None})
+        ae(dict(m.items()), {1: True, 2: False, 3: None})
+        self.assertIs(m[2], False)
+        m = ColumnarMap('float', ((1, 1.5), (2, 2)))
+        self.assertIs(type(m[2]), int)
+
+        def read_all(cache):
+            return {field: {book_id: cache.field_for(field, book_id) for book_id in cache.all_book_ids()}
+                for field in ('series', 'series_index', 'publisher', 'rating', 'size', 'pubdate', 'timestamp',
+                              'last_modified', '#yesno', '#float', '#date', '#enum', '#series', '#series_index')}
+        library_path = os.path.join(self.tdir, 'library')
+        os.mkdir(library_path)
+        self.create_db(library_path)
+        expected = read_all(self.init_cache(library_path))
+        orig = tweaks['use_columnar_storage_for_book_data']
+        tweaks['use_columnar_storage_for_book_data'] = True
+        try:
+            cache = self.init_cache(library_path)
+            self.assertIsInstance(cache.fields['series'].table.book_col_map, ColumnarMap)
+            self.assertIsInstance(cache.fields['pubdate'].table.book_col_map, ColumnarMap)
+            ae(read_all(cache), expected)
+            cache.set_field('series', {1: 'xxx', 3: 'yyy'})
+            cache.set_field('#float', {1: 7.5, 2: None})
+            ae(cache.search('series:=xxx'), {1})
+            ae(cache.field_for('#float', 1), 7.5)
+            ae(cache.field_for('#float', 2), None)
+            cache.remove_books((1,))
+            ae(cache.field_for('series', 1), None)
+            ae(cache.field_for('series', 3), 'yyy')
+        finally:
+            tweaks['use_columnar_storage_for_book_data'] = orig
+    # }}}
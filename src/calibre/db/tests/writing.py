@@ -278,6 +278,19 @@ def test_many_many_basic(self):  # {{{
             ae(cache.field_for('languages', 2), ('deu', 'eng'))
         del cache2
 
+        # Adding, removing and re-ordering items in many books at once
+        ae(sf('tags', {1:'a1,a2,a3', 2:'a1,a2', 3:'a3'}), {1, 2, 3})
+        ae(sf('tags', {1:'a1,a3,a4', 2:'a2,a1', 3:'a3,New1,new2,new1'}), {1, 2, 3})
+        cache2 = self.init_cache(cl)
+        for c in (cache, cache2):
+            ae(c.field_for('tags', 1), ('a1', 'a3', 'a4'))
+            ae(c.field_for('tags', 2), ('a2', 'a1'))
+            ae(c.field_for('tags', 3), ('a3', 'New1', 'new2'))
+            ae(c.books_for_field('tags', c.get_item_id('tags', 'a1')), {1, 2})
+            ae(c.books_for_field('tags', c.get_item_id('tags', 'a2')), {2})
+            ae(c.books_for_field('tags', c.get_item_id('tags', 'a3')), {1, 3})
+        del cache2
+
         # Identifiers
         f = cache.fields['identifiers']
         ae(sf('identifiers', {3: 'one:1,two:2'}), {3})
@@ -366,6 +379,52 @@ def test_backup(self):  # {{{
             mb.stop()
         mb.join(2)
         af(mb.is_alive())
+
+        # Batched backups
+        mb = MetadataBackup(cache, interval=interval, scheduling_interval=0, batch_size=2, num_threads=2)
+        mb.start()
+        try:
+            ae(sf('publisher', {1:'pub1', 2:'pub2', 3:'pub3'}), {1,2,3})
+            count = 6
+            while mb.queue_depth and count > 0:
+                mb.join(2)
+                count -= 1
+            af(mb.queue_depth)
+            ae(mb.total_backed_up, 3)
+            self.assertGreater(mb.drain_rate, 0)
+        finally:
+            mb.stop()
+        mb.join(2)
+        af(mb.is_alive())
+        af(cache.backend.conn.get('SELECT book FROM metadata_dirtied'))
+        for book_id in (1, 2, 3):
+            self.assertIn(f'<dc:publisher>pub{book_id}</dc:publisher>'.encode(), cache.read_backup(book_id))
+
+        # Books that fail to backup must not hold up the others
+        orig_write_backup = cache.write_backup
+
+        def write_backup(book_id, raw):
+            if book_id in (1, 2):
+                raise PermissionError(f'Cannot write backup for {book_id}')
+            return orig_write_backup(book_id, raw)
+        cache.write_backup = write_backup
+        mb = MetadataBackup(cache, interval=interval, scheduling_interval=0, batch_size=2, num_threads=2)
+        mb.start()
+        try:
+            ae(sf('publisher', {1:'p1', 2:'p2', 3:'p3'}), {1,2,3})
+            count = 100
+            while mb.queue_depth > 2 and count > 0:
+                mb.join(0.1)
+                count -= 1
+            ae(mb.queue_depth, 2)
+            ae(set(mb.failures), {1, 2})
+        finally:
+            mb.stop()
+        mb.join(2)
+        del cache.write_backup
+        self.assertIn(b'<dc:publisher>p3</dc:publisher>', cache.read_backup(3))
+        ae(cache.get_dirtied_books(exclude={1}), (2,))
+        cache.dump_metadata()
         from calibre.ebooks.metadata.opf2 import OPF
         book_ids = (1,2,3)
 
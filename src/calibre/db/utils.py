@@ -9,7 +9,8 @@
 import re
 import shutil
 import sys
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
+from collections.abc import Set
 from contextlib import suppress
 from locale import localeconv
 from threading import Lock
@@ -99,9 +100,267 @@ def lang_matches(book_id):
     return {book_id for book_id in ans if lang_matches(book_id)}
 
 
+def identifier_key(typ, val):
+    typ, val = icu_lower(typ.strip()), icu_lower(val.strip())
+    if typ == 'isbn':
+        from calibre.ebooks.metadata import check_isbn
+        val = check_isbn(val) or val
+    return typ, val
+
+
+class DuplicatesIndex:
+
+    '''
+    Maps of the case-folded titles, fuzzy titles and identifiers of the
+    books in a library to the ids of the books that have them, for finding
+    the books that are duplicates of a new book without looking at every book
+    in the library. The index is kept up to date via :meth:`update` which is
+    called with the ids of books that were changed. '''
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.titles, self.fuzzy_titles, self.identifiers = defaultdict(set), defaultdict(set), defaultdict(set)
+        self.book_keys = {}
+        self.update(fields['title'].table.book_col_map)
+
+    def keys_for_book(self, book_id):
+        title = self.fields['title'].table.book_col_map.get(book_id)
+        if title is None:
+            return None
+        title = as_unicode(title)
+        identifiers = self.fields['identifiers'].table.book_col_map.get(book_id, {})
+        return icu_lower(title), fuzzy_title(title), tuple(identifier_key(typ, val) for typ, val in iteritems(identifiers) if val)
+
+    def update(self, book_ids):
+        for book_id in book_ids:
+            old = self.book_keys.pop(book_id, None)
+            if old is not None:
+                self.discard(self.titles, old[0], book_id)
+                self.discard(self.fuzzy_titles, old[1], book_id)
+                for key in old[2]:
+                    self.discard(self.identifiers, key, book_id)
+            new = self.keys_for_book(book_id)
+            if new is not None:
+                self.book_keys[book_id] = new
+                self.titles[new[0]].add(book_id)
+                self.fuzzy_titles[new[1]].add(book_id)
+                for key in new[2]:
+                    self.identifiers[key].add(book_id)
+
+    def discard(self, m, key, book_id):
+        books = m.get(key)
+        if books is not None:
+            books.discard(book_id)
+            if not books:
+                del m[key]
+
+    def find(self, mi, match_identifiers=False):
+        ''' Return the ids of books that have the same fuzzy title as mi, a
+        superset of its authors and compatible languages, the same test
+        as :func:`find_identical_books`. If match_identifiers is True, books
+        that share an identifier with mi are also returned. '''
+        ans = set()
+        authors_field, languages_field = self.fields['authors'], self.fields['languages']
+        qauthors = {icu_lower(str(a)) for a in mi.authors or ()}
+        langq = tuple(filter(lambda x: x and x != 'und', map(canonicalize_lang, mi.languages or ())))
+        for book_id in self.fuzzy_titles.get(fuzzy_title(mi.title or ''), ()):
+            if not qauthors.issubset(map(icu_lower, authors_field.for_book(book_id, default_value=()))):
+                continue
+            if langq:
+                book_langq = languages_field.for_book(book_id, default_value=())
+                if book_langq and book_langq != langq:
+                    continue
+            ans.add(book_id)
+        if match_identifiers:
+            for typ, val in iteritems(mi.get_identifiers()):
+                if val:
+                    ans |= self.identifiers.get(identifier_key(typ, val), set())
+        return ans
+
+
 Entry = namedtuple('Entry', 'path size timestamp thumbnail_size')
 
 
+# The positions of the set bits in every possible byte value
+_bit_positions = tuple(tuple(bit for bit in range(8) if byte & (1 << bit)) for byte in range(256))
+
+
+class BookIdSet(Set):  # {{{
+
+    '''
+    An immutable set of book ids stored as a bitmap. The bitmap is a python
+    int, so the set operations &, |, - and ^ between two BookIdSets run in C
+    over machine words instead of allocating a boxed int per member, and the
+    set takes one bit per possible book id. Membership tests and iteration use
+    a lazily created little endian bytes copy of the bitmap.
+
+    Operations with other kinds of sets are supported as well, with the result
+    always being a BookIdSet.
+    '''
+
+    __slots__ = ('_bits', '_bytes', '_hash', '_len')
+
+    def __init__(self, book_ids=()):
+        if isinstance(book_ids, BookIdSet):
+            bits = book_ids._bits
+        else:
+            book_ids = book_ids if isinstance(book_ids, (set, frozenset, tuple, list)) else tuple(book_ids)
+            if book_ids:
+                buf = bytearray((max(book_ids) >> 3) + 1)
+                for book_id in book_ids:
+                    buf[book_id >> 3] |= 1 << (book_id & 7)
+                bits = int.from_bytes(buf, 'little')
+            else:
+                bits = 0
+        self._bits = bits
+        self._bytes = self._hash = self._len = None
+
+    @classmethod
+    def from_bits(cls, bits):
+        ans = cls.__new__(cls)
+        ans._bits, ans._bytes, ans._hash, ans._len = bits, None, None, None
+        return ans
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @property
+    def as_bytes(self):
+        ans = self._bytes
+        if ans is None:
+            ans = self._bytes = self._bits.to_bytes((self._bits.bit_length() + 7) >> 3, 'little')
+        return ans
+
+    def __len__(self):
+        ans = self._len
+        if ans is None:
+            ans = self._len = self._bits.bit_count()
+        return ans
+
+    def __bool__(self):
+        return self._bits != 0
+
+    def __contains__(self, book_id):
+        try:
+            if book_id < 0:
+                return False
+            return bool(self.as_bytes[book_id >> 3] & (1 << (book_id & 7)))
+        except (IndexError, TypeError):
+            return False
+
+    def __iter__(self):
+        # Yields the book ids in ascending order
+        positions = _bit_positions
+        for i, byte in enumerate(self.as_bytes):
+            if byte:
+                base = i << 3
+                for bit in positions[byte]:
+                    yield base + bit
+
+    def __hash__(self):
+        # Must be the same as the hash of a frozenset with the same members,
+        # since they compare equal
+        ans = self._hash
+        if ans is None:
+            ans = self._hash = hash(frozenset(self))
+        return ans
+
+    def __eq__(self, other):
+        if isinstance(other, BookIdSet):
+            return self._bits == other._bits
+        return Set.__eq__(self, other)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({sorted(self)!r})'
+
+    def __reduce__(self):
+        return self.from_bits, (self._bits,)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    @staticmethod
+    def _bits_of(other):
+        return (other if isinstance(other, BookIdSet) else BookIdSet(other))._bits
+
+    def __and__(self, other):
+        if isinstance(other, BookIdSet):
+            return self.from_bits(self._bits & other._bits)
+        if not isinstance(other, Set):
+            return NotImplemented
+        # Avoid building a bitmap for the other set, only its members that
+        # are also present here are needed
+        return BookIdSet([x for x in other if x in self])
+    __rand__ = __and__
+
+    def __or__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return self.from_bits(self._bits | self._bits_of(other))
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return self.from_bits(self._bits & ~self._bits_of(other))
+
+    def __rsub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return self.from_bits(self._bits_of(other) & ~self._bits)
+
+    def __xor__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return self.from_bits(self._bits ^ self._bits_of(other))
+    __rxor__ = __xor__
+
+    def __le__(self, other):
+        if isinstance(other, BookIdSet):
+            return self._bits & ~other._bits == 0
+        return Set.__le__(self, other)
+
+    def __ge__(self, other):
+        if isinstance(other, BookIdSet):
+            return other._bits & ~self._bits == 0
+        return Set.__ge__(self, other)
+
+    def isdisjoint(self, other):
+        if isinstance(other, BookIdSet):
+            return self._bits & other._bits == 0
+        return Set.isdisjoint(self, other)
+
+    def intersection(self, *others):
+        ans = self
+        for other in others:
+            ans = ans & (other if isinstance(other, Set) else frozenset(other))
+        return ans
+
+    def union(self, *others):
+        bits = self._bits
+        for other in others:
+            bits |= self._bits_of(other)
+        return self.from_bits(bits)
+
+    def difference(self, *others):
+        bits = self._bits
+        for other in others:
+            bits &= ~self._bits_of(other)
+        return self.from_bits(bits)
+
+    def issubset(self, other):
+        return self <= (other if isinstance(other, Set) else frozenset(other))
+
+    def issuperset(self, other):
+        return self >= (other if isinstance(other, Set) else frozenset(other))
+
+    def copy(self):
+        return self
+# }}}
+
+
 class CacheError(Exception):
     pass
 
@@ -6,6 +6,7 @@
 __docformat__ = 'restructuredtext en'
 
 import re
+from collections import defaultdict
 from datetime import datetime
 from functools import partial
 
@@ -275,34 +276,58 @@ def safe_lower(x):
         return x
 
 
-def get_db_id(val, db, m, table, kmap, rid_map, allow_case_change,
-              case_changes, val_map, is_authors=False):
-    ''' Get the db id for the value val. If val does not exist in the db it is
-    inserted into the db. '''
-    kval = kmap(val)
-    item_id = rid_map.get(kval, None)
-    if item_id is None:
-        if is_authors:
-            aus = author_to_author_sort(val)
-            db.execute('INSERT INTO authors(name,sort) VALUES (?,?)',
-                            (val.replace(',', '|'), aus))
-        else:
-            db.execute('INSERT INTO {}({}) VALUES (?)'.format(
-                m['table'], m['column']), (val,))
-        item_id = rid_map[kval] = db.last_insert_rowid()
+def insert_new_items(vals, db, m, table, kmap, rid_map, is_authors=False):
+    ''' Insert all the values in vals that do not exist in the db into it, with
+    a single statement. '''
+    new_vals = {}
+    for val in vals:
+        kval = kmap(val)
+        if kval not in rid_map and kval not in new_vals:
+            new_vals[kval] = val
+    if not new_vals:
+        return
+    if is_authors:
+        aus_map = {val:author_to_author_sort(val) for val in new_vals.values()}
+        item_ids = db.insert_many('INSERT INTO authors(name,sort) VALUES (?,?) RETURNING id',
+                                  ((val.replace(',', '|'), aus) for val, aus in aus_map.items()))
+    else:
+        item_ids = db.insert_many('INSERT INTO {}({}) VALUES (?) RETURNING id'.format(
+            m['table'], m['column']), ((val,) for val in new_vals.values()))
+    for (kval, val), item_id in zip(new_vals.items(), item_ids):
+        rid_map[kval] = item_id
         table.id_map[item_id] = val
         table.col_book_map[item_id] = set()
         if is_authors:
-            table.asort_map[item_id] = aus
+            table.asort_map[item_id] = aus_map[val]
         if hasattr(table, 'link_map'):
             table.link_map[item_id] = ''
         if table.supports_notes:
             db.unretire_note(table.name, item_id, val)
+
+
+def get_db_id(val, db, m, table, kmap, rid_map, allow_case_change,
+              case_changes, val_map, is_authors=False):
+    ''' Get the db id for the value val. If val does not exist in the db it is
+    inserted into the db. '''
+    kval = kmap(val)
+    item_id = rid_map.get(kval, None)
+    if item_id is None:
+        insert_new_items((val,), db, m, table, kmap, rid_map, is_authors=is_authors)
+        item_id = rid_map[kval]
     elif allow_case_change and val != table.id_map[item_id]:
         case_changes[item_id] = val
     val_map[val] = item_id
 
 
+def update_col_book_map(table, removed, added):
+    ''' Apply the changes, which are maps of item id to sets of book ids, to
+    the item->books map of table '''
+    for item_id, book_ids in removed.items():
+        table.col_book_map[item_id] -= book_ids
+    for item_id, book_ids in added.items():
+        table.col_book_map[item_id] |= book_ids
+
+
 def change_case(case_changes, dirtied, db, table, m, is_authors=False):
     if is_authors:
         vals = ((val.replace(',', '|'), item_id) for item_id, val in
@@ -334,10 +359,11 @@ def many_one(book_id_val_map, db, field, allow_case_change, *args):
         rid_map = {kmap(item):item_id for item_id, item in iteritems(table.id_map)}
     val_map = {None:None}
     case_changes = {}
-    for val in itervalues(book_id_val_map):
-        if val is not None:
-            get_db_id(val, db, m, table, kmap, rid_map, allow_case_change,
-                    case_changes, val_map)
+    vals = tuple(val for val in itervalues(book_id_val_map) if val is not None)
+    insert_new_items(vals, db, m, table, kmap, rid_map)
+    for val in vals:
+        get_db_id(val, db, m, table, kmap, rid_map, allow_case_change,
+                case_changes, val_map)
 
     if case_changes:
         change_case(case_changes, dirtied, db, table, m)
@@ -352,31 +378,31 @@ def many_one(book_id_val_map, db, field, allow_case_change, *args):
     # Update the book->col and col->book maps
     deleted = set()
     updated = {}
+    removed, added = defaultdict(set), defaultdict(set)
     for book_id, item_id in iteritems(book_id_item_id_map):
         old_item_id = table.book_col_map.get(book_id, None)
         if old_item_id is not None:
-            table.col_book_map[old_item_id].discard(book_id)
+            removed[old_item_id].add(book_id)
         if item_id is None:
             table.book_col_map.pop(book_id, None)
             deleted.add(book_id)
         else:
             table.book_col_map[book_id] = item_id
-            table.col_book_map[item_id].add(book_id)
+            added[item_id].add(book_id)
             updated[book_id] = item_id
+    update_col_book_map(table, removed, added)
 
     # Update the db link table
-    if deleted:
+    if deleted or updated:
         db.executemany(f'DELETE FROM {table.link_table} WHERE book=?',
-                            ((k,) for k in deleted))
+                            ((k,) for k in deleted | set(updated)))
     if updated:
         sql = (
-            'DELETE FROM {0} WHERE book=?; INSERT INTO {0}(book,{1},extra) VALUES(?, ?, 1.0)'
+            'INSERT INTO {0}(book,{1},extra) VALUES(?, ?, 1.0)'
             if is_custom_series else
-            'DELETE FROM {0} WHERE book=?; INSERT INTO {0}(book,{1}) VALUES(?, ?)'
+            'INSERT INTO {0}(book,{1}) VALUES(?, ?)'
         )
-        db.executemany(sql.format(table.link_table, m['link_column']),
-            ((book_id, book_id, item_id) for book_id, item_id in
-                    iteritems(updated)))
+        db.executemany(sql.format(table.link_table, m['link_column']), iteritems(updated))
 
     # Remove no longer used items
     remove = {item_id:item_val for item_id, item_val in table.id_map.items() if not table.col_book_map.get(item_id, False)}
@@ -422,6 +448,8 @@ def many_many(book_id_val_map, db, field, allow_case_change, *args):
     val_map = {}
     case_changes = {}
     book_id_val_map = {k:uniq(vals, kmap) for k, vals in iteritems(book_id_val_map)}
+    insert_new_items((val for vals in itervalues(book_id_val_map) for val in vals),
+                     db, m, table, kmap, rid_map, is_authors=is_authors)
     for vals in itervalues(book_id_val_map):
         for val in vals:
             get_db_id(val, db, m, table, kmap, rid_map, allow_case_change,
@@ -448,36 +476,46 @@ def many_many(book_id_val_map, db, field, allow_case_change, *args):
     book_id_item_id_map = {k:v for k, v in book_id_item_id_map.items() if v != g(k, not_set)}
     dirtied |= set(book_id_item_id_map)
 
-    # Update the book->col and col->book maps
-    deleted = set()
+    # Update the book->col and col->book maps. Only the differences between
+    # the old and new values are written to the link table, unless the order
+    # of the items that remain changes, since the order is that of the rows in
+    # the link table.
     updated = {}
+    removed, added = defaultdict(set), defaultdict(set)
+    rewritten, removed_links, added_links = [], [], []
     for book_id, item_ids in iteritems(book_id_item_id_map):
-        old_item_ids = table.book_col_map.get(book_id, None)
-        if old_item_ids:
-            for old_item_id in old_item_ids:
-                table.col_book_map[old_item_id].discard(book_id)
+        old_item_ids = g(book_id, not_set)
+        new_item_ids = set(item_ids)
+        kept = tuple(x for x in old_item_ids if x in new_item_ids)
+        for old_item_id in old_item_ids:
+            if old_item_id not in new_item_ids:
+                removed[old_item_id].add(book_id)
+        for item_id in new_item_ids.difference(old_item_ids):
+            added[item_id].add(book_id)
         if item_ids:
             table.book_col_map[book_id] = item_ids
-            for item_id in item_ids:
-                table.col_book_map[item_id].add(book_id)
             updated[book_id] = item_ids
         else:
             table.book_col_map.pop(book_id, None)
-            deleted.add(book_id)
+        if item_ids[:len(kept)] == kept:
+            removed_links.extend((book_id, x) for x in old_item_ids if x not in new_item_ids)
+            added_links.extend((book_id, x) for x in item_ids[len(kept):])
+        else:
+            rewritten.append(book_id)
+            added_links.extend((book_id, x) for x in item_ids)
+    update_col_book_map(table, removed, added)
 
     # Update the db link table
-    if deleted:
+    if rewritten:
         db.executemany(f'DELETE FROM {table.link_table} WHERE book=?',
-                            ((k,) for k in deleted))
-    if updated:
-        vals = (
-            (book_id, val) for book_id, vals in iteritems(updated)
-            for val in vals
-        )
-        db.executemany(f'DELETE FROM {table.link_table} WHERE book=?',
-                            ((k,) for k in updated))
+                            ((k,) for k in rewritten))
+    if removed_links:
+        db.executemany('DELETE FROM {} WHERE book=? AND {}=?'.format(
+            table.link_table, m['link_column']), removed_links)
+    if added_links:
         db.executemany('INSERT INTO {}(book,{}) VALUES(?, ?)'.format(
-            table.link_table, m['link_column']), vals)
+            table.link_table, m['link_column']), added_links)
+    if updated:
         if is_authors:
             aus_map = {book_id:field.author_sort_for_book(book_id) for book_id
                        in updated}
@@ -202,6 +202,7 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'parallel_workers',
                      ]
                     )),
               (_('LOOK AND FEEL'), (
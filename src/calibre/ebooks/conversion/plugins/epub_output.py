@@ -8,12 +8,20 @@
 import os
 import re
 import shutil
+from functools import partial
 
 from calibre import CurrentDir
 from calibre.customize.conversion import OptionRecommendation, OutputFormatPlugin
 from calibre.ptempfile import TemporaryDirectory
 from polyglot.builtins import as_bytes
 
+
+def read_from_zip(path, name, *args):
+    from calibre.utils.zipfile import ZipFile
+    with ZipFile(path) as zf:
+        return zf.read(name)
+
+
 block_level_tags = (
     'address',
     'body',
@@ -262,17 +270,37 @@ def convert(self, oeb, output_path, input_plugin, opts, log):
                 if str(x) == uuid:
                     x.content = 'urn:uuid:'+uuid
 
+        metadata_xml = None
+        extra_entries = []
+        if self.is_periodical:
+            if self.opts.output_profile.epub_periodical_format == 'sony':
+                from calibre.ebooks.epub.periodical import sony_metadata
+                metadata_xml, atom_xml = sony_metadata(oeb)
+                extra_entries = [('atom.xml', 'application/atom+xml', atom_xml)]
+
+        if self.opts.epub_version == '3' or getattr(self, 'container_callback', None):
+            # These need the book as a folder, for polishing
+            self.write_via_folder(output_path, input_plugin, uuid, encrypted_fonts, extra_entries, metadata_xml)
+        else:
+            self.write_streaming(output_path, uuid, encrypted_fonts, extra_entries, metadata_xml)
+
+        if opts.extract_to is not None:
+            from calibre.utils.zipfile import ZipFile
+            if os.path.exists(opts.extract_to):
+                if os.path.isdir(opts.extract_to):
+                    shutil.rmtree(opts.extract_to)
+                else:
+                    os.remove(opts.extract_to)
+            os.mkdir(opts.extract_to)
+            with ZipFile(output_path) as zf:
+                zf.extractall(path=opts.extract_to)
+            self.log.info('Book extracted to:', opts.extract_to)
+
+    def write_via_folder(self, output_path, input_plugin, uuid, encrypted_fonts, extra_entries, metadata_xml):
+        from calibre.customize.ui import plugin_for_output_format
         with TemporaryDirectory('_epub_output') as tdir:
-            from calibre.customize.ui import plugin_for_output_format
-            metadata_xml = None
-            extra_entries = []
-            if self.is_periodical:
-                if self.opts.output_profile.epub_periodical_format == 'sony':
-                    from calibre.ebooks.epub.periodical import sony_metadata
-                    metadata_xml, atom_xml = sony_metadata(oeb)
-                    extra_entries = [('atom.xml', 'application/atom+xml', atom_xml)]
             oeb_output = plugin_for_output_format('oeb')
-            oeb_output.convert(oeb, tdir, input_plugin, opts, log)
+            oeb_output.convert(self.oeb, tdir, input_plugin, self.opts, self.log)
             opf = [x for x in os.listdir(tdir) if x.endswith('.opf')][0]
             self.condense_ncx([os.path.join(tdir, x) for x in os.listdir(tdir)
                     if x.endswith('.ncx')][0])
@@ -296,17 +324,43 @@ def convert(self, oeb, output_path, input_plugin, opts, log):
                 if metadata_xml is not None:
                     epub.writestr('META-INF/metadata.xml',
                             metadata_xml.encode('utf-8'))
-            if opts.extract_to is not None:
-                from calibre.utils.zipfile import ZipFile
-                if os.path.exists(opts.extract_to):
-                    if os.path.isdir(opts.extract_to):
-                        shutil.rmtree(opts.extract_to)
-                    else:
-                        os.remove(opts.extract_to)
-                os.mkdir(opts.extract_to)
-                with ZipFile(output_path) as zf:
-                    zf.extractall(path=opts.extract_to)
-                self.log.info('Book extracted to:', opts.extract_to)
+
+    def write_streaming(self, output_path, uuid, encrypted_fonts, extra_entries, metadata_xml):
+        # Write each file straight into the EPUB as soon as it is serialized,
+        # and release the data of manifest items once written, so that memory
+        # use is bounded by the largest file in the book, rather than the
+        # whole book, and no copy of the book is made in a temporary folder.
+        from calibre.customize.ui import plugin_for_output_format
+        from calibre.ebooks.epub import initialize_container
+        from polyglot.urllib import unquote
+        oeb_output = plugin_for_output_format('oeb')
+        files = oeb_output.serialize_book(self.oeb, self.opts, self.log)
+        opf, raw, _ = next(files)
+        key = self.font_key(uuid) if encrypted_fonts else None
+        fonts = {x if isinstance(x, str) else x.decode('utf-8') for x in encrypted_fonts}
+        encrypted = []
+        with initialize_container(output_path, opf, extra_entries=extra_entries) as epub:
+            epub.writestr(opf, raw, 0o644)
+            for href, raw, item in files:
+                name = href if item is None else unquote(href)
+                if href.endswith('.ncx'):
+                    raw = self.condense_ncx_data(raw)
+                if name in fonts:
+                    self.log.debug('Encrypting font:', name)
+                    obfuscated = self.obfuscate_font(raw, key, name)
+                    if obfuscated is not None:
+                        raw = obfuscated
+                        encrypted.append(name)
+                epub.writestr(name, raw, 0o644)
+                # Dont hold on to this file while the next one is serialized
+                del raw
+                if item is not None and name not in fonts:
+                    item.release_data(partial(read_from_zip, output_path, name))
+            if encrypted:
+                epub.writestr('META-INF/encryption.xml', as_bytes(self.encryption_xml(encrypted)))
+            if metadata_xml is not None:
+                epub.writestr('META-INF/metadata.xml',
+                        metadata_xml.encode('utf-8'))
 
     def create_container(self, tdir, opf, encryption):
         from calibre.ebooks.epub import simple_container_xml
@@ -354,12 +408,7 @@ def upgrade_to_epub3(self, tdir, opf, encryption=None):
         return encryption
 
     def encrypt_fonts(self, uris, tdir, uuid):  # {{{
-        from polyglot.binary import from_hex_bytes
-
-        key = re.sub(r'[^a-fA-F0-9]', '', uuid)
-        if len(key) < 16:
-            raise ValueError(f'UUID identifier {uuid!r} is invalid')
-        key = bytearray(from_hex_bytes((key + key)[:32]))
+        key = self.font_key(uuid)
         paths = []
         with CurrentDir(tdir):
             paths = [os.path.join(*x.split('/')) for x in uris]
@@ -372,46 +421,76 @@ def encrypt_fonts(self, uris, tdir, uuid):  # {{{
                     continue
                 self.log.debug('Encrypting font:', uri)
                 with open(path, 'r+b') as f:
-                    data = f.read(1024)
-                    if len(data) >= 1024:
-                        data = bytearray(data)
+                    data = self.obfuscate_font(f.read(1024), key, path)
+                    if data is not None:
                         f.seek(0)
-                        f.write(bytes(bytearray(data[i] ^ key[i%16] for i in range(1024))))
-                    else:
-                        self.log.warn('Font', path, 'is invalid, ignoring')
+                        f.write(data)
                 if not isinstance(uri, str):
                     uri = uri.decode('utf-8')
-                fonts.append('''
-                <enc:EncryptedData>
-                    <enc:EncryptionMethod Algorithm="http://ns.adobe.com/pdf/enc#RC"/>
-                    <enc:CipherData>
-                    <enc:CipherReference URI="{}"/>
-                    </enc:CipherData>
-                </enc:EncryptedData>
-                '''.format(uri.replace('"', '\\"')))
-            if fonts:
-                ans = '''<encryption
-                    xmlns="urn:oasis:names:tc:opendocument:xmlns:container"
-                    xmlns:enc="http://www.w3.org/2001/04/xmlenc#"
-                    xmlns:deenc="http://ns.adobe.com/digitaleditions/enc">
-                    '''
-                ans += '\n'.join(fonts)
-                ans += '\n</encryption>'
-                return ans
+                fonts.append(uri)
+            return self.encryption_xml(fonts)
+
+    def font_key(self, uuid):
+        from polyglot.binary import from_hex_bytes
+
+        key = re.sub(r'[^a-fA-F0-9]', '', uuid)
+        if len(key) < 16:
+            raise ValueError(f'UUID identifier {uuid!r} is invalid')
+        return bytearray(from_hex_bytes((key + key)[:32]))
+
+    def obfuscate_font(self, data, key, name):
+        # Return data with its first 1024 bytes obfuscated, or None if the font
+        # is too small to be valid
+        if len(data) < 1024:
+            self.log.warn('Font', name, 'is invalid, ignoring')
+            return
+        data = bytearray(data)
+        for i in range(1024):
+            data[i] ^= key[i%16]
+        return bytes(data)
+
+    def encryption_xml(self, uris):
+        fonts = []
+        for uri in uris:
+            fonts.append('''
+            <enc:EncryptedData>
+                <enc:EncryptionMethod Algorithm="http://ns.adobe.com/pdf/enc#RC"/>
+                <enc:CipherData>
+                <enc:CipherReference URI="{}"/>
+                </enc:CipherData>
+            </enc:EncryptedData>
+            '''.format(uri.replace('"', '\\"')))
+        if fonts:
+            ans = '''<encryption
+                xmlns="urn:oasis:names:tc:opendocument:xmlns:container"
+                xmlns:enc="http://www.w3.org/2001/04/xmlenc#"
+                xmlns:deenc="http://ns.adobe.com/digitaleditions/enc">
+                '''
+            ans += '\n'.join(fonts)
+            ans += '\n</encryption>'
+            return ans
     # }}}
 
     def condense_ncx(self, ncx_path):  # {{{
-        from lxml import etree
         if not self.opts.pretty_print:
-            tree = etree.parse(ncx_path)
-            for tag in tree.getroot().iter(tag=etree.Element):
-                if tag.text:
-                    tag.text = tag.text.strip()
-                if tag.tail:
-                    tag.tail = tag.tail.strip()
-            compressed = etree.tostring(tree.getroot(), encoding='utf-8')
+            with open(ncx_path, 'rb') as f:
+                compressed = self.condense_ncx_data(f.read())
             with open(ncx_path, 'wb') as f:
                 f.write(compressed)
+
+    def condense_ncx_data(self, raw):
+        from lxml import etree
+
+        from calibre.utils.xml_parse import safe_xml_fromstring
+        if self.opts.pretty_print:
+            return raw
+        root = safe_xml_fromstring(raw)
+        for tag in root.iter(tag=etree.Element):
+            if tag.text:
+                tag.text = tag.text.strip()
+            if tag.tail:
+                tag.tail = tag.tail.strip()
+        return etree.tostring(root, encoding='utf-8')
     # }}}
 
     def workaround_ade_quirks(self):  # {{{
@@ -19,54 +19,64 @@ class OEBOutput(OutputFormatPlugin):
     recommendations = {('pretty_print', True, OptionRecommendation.HIGH)}
 
     def convert(self, oeb_book, output_path, input_plugin, opts, log):
-        from lxml import etree
-
         from polyglot.urllib import unquote
 
-        self.log, self.opts = log, opts
         if not os.path.exists(output_path):
             os.makedirs(output_path)
-        from calibre.ebooks.oeb.base import NCX_MIME, OEB_STYLES, OPF_MIME, PAGE_MAP_MIME
-        from calibre.ebooks.oeb.normalize_css import condense_sheet
         with CurrentDir(output_path):
-            results = oeb_book.to_opf2(page_map=True)
-            for key in (OPF_MIME, NCX_MIME, PAGE_MAP_MIME):
-                href, root = results.pop(key, [None, None])
-                if root is not None:
-                    if key == OPF_MIME:
-                        try:
-                            self.workaround_nook_cover_bug(root)
-                        except Exception:
-                            self.log.exception('Something went wrong while trying to'
-                                    ' workaround Nook cover bug, ignoring')
-                        try:
-                            self.workaround_pocketbook_cover_bug(root)
-                        except Exception:
-                            self.log.exception('Something went wrong while trying to'
-                                    ' workaround Pocketbook cover bug, ignoring')
-                        self.migrate_lang_code(root)
-                        self.adjust_mime_types(root)
-                    raw = etree.tostring(root, pretty_print=True,
-                            encoding='utf-8', xml_declaration=True)
-                    if key == OPF_MIME:
-                        # Needed as I can't get lxml to output opf:role and
-                        # not output <opf:metadata> as well
-                        raw = re.sub(br'(<[/]{0,1})opf:', br'\1', raw)
-                    with open(href, 'wb') as f:
-                        f.write(raw)
-
-            for item in oeb_book.manifest:
-                if (
-                        not self.opts.expand_css and item.media_type in OEB_STYLES and hasattr(
-                            item.data, 'cssText') and 'nook' not in self.opts.output_profile.short_name):
-                    condense_sheet(item.data)
-                path = os.path.abspath(unquote(item.href))
+            for href, raw, item in self.serialize_book(oeb_book, opts, log):
+                path = os.path.abspath(unquote(href) if item is not None else href)
                 dir = os.path.dirname(path)
                 if not os.path.exists(dir):
                     os.makedirs(dir)
                 with open(path, 'wb') as f:
-                    f.write(item.bytes_representation)
-                item.unload_data_from_memory(memory=path)
+                    f.write(raw)
+                if item is not None:
+                    item.unload_data_from_memory(memory=path)
+
+    def serialize_book(self, oeb_book, opts, log):
+        '''
+        Serialize the OPF, NCX and page map, followed by every item in the
+        manifest, yielding (href, raw bytes, manifest item or None) one file at
+        a time, with the OPF first. This allows the book to be streamed into an
+        output container without holding all of it in memory at once.
+        '''
+        from lxml import etree
+
+        self.log, self.opts = log, opts
+        from calibre.ebooks.oeb.base import NCX_MIME, OEB_STYLES, OPF_MIME, PAGE_MAP_MIME
+        from calibre.ebooks.oeb.normalize_css import condense_sheet
+        results = oeb_book.to_opf2(page_map=True)
+        for key in (OPF_MIME, NCX_MIME, PAGE_MAP_MIME):
+            href, root = results.pop(key, [None, None])
+            if root is not None:
+                if key == OPF_MIME:
+                    try:
+                        self.workaround_nook_cover_bug(root)
+                    except Exception:
+                        self.log.exception('Something went wrong while trying to'
+                                ' workaround Nook cover bug, ignoring')
+                    try:
+                        self.workaround_pocketbook_cover_bug(root)
+                    except Exception:
+                        self.log.exception('Something went wrong while trying to'
+                                ' workaround Pocketbook cover bug, ignoring')
+                    self.migrate_lang_code(root)
+                    self.adjust_mime_types(root)
+                raw = etree.tostring(root, pretty_print=True,
+                        encoding='utf-8', xml_declaration=True)
+                if key == OPF_MIME:
+                    # Needed as I can't get lxml to output opf:role and
+                    # not output <opf:metadata> as well
+                    raw = re.sub(br'(<[/]{0,1})opf:', br'\1', raw)
+                yield href, raw, None
+
+        for item in oeb_book.manifest:
+            if (
+                    not self.opts.expand_css and item.media_type in OEB_STYLES and hasattr(
+                        item.data, 'cssText') and 'nook' not in self.opts.output_profile.short_name):
+                condense_sheet(item.data)
+            yield item.href, item.bytes_representation, item
 
     def adjust_mime_types(self, root):
         from calibre.ebooks.oeb.polish.utils import adjust_mime_for_epub
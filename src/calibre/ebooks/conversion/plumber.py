@@ -130,6 +130,17 @@ def __init__(self, input, output, log, report_progress=DummyReporter(),
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='parallel_workers',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Number of worker processes to use for the parts of the '
+                   'conversion that work on each file in the book separately, '
+                   'such as flattening the CSS and rescaling images. Using '
+                   'several workers speeds up the conversion of books with '
+                   'many files. The default of zero means no workers are '
+                   'used. The output is the same regardless of the number of '
+                   'workers. Not supported on Windows.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1221,6 +1232,7 @@ def run(self):
                 page_break_on_body=self.output_plugin.file_type in ('mobi',
                     'lit'),
                 transform_css_rules=transform_css_rules,
+                num_workers=self.opts.parallel_workers,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
                     self.log, self.opts))
         flattener(self.oeb, self.opts)
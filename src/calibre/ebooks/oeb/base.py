@@ -1093,6 +1093,8 @@ def loader(*args):
                             ans = f.read()
                         os.remove(pt.name)
                         return ans
+                    # The data can be read only once, see uncached_data
+                    loader.single_use = True
                     self._loader = loader
                 else:
                     def loader2(*args):
@@ -1102,6 +1104,27 @@ def loader2(*args):
                     self._loader = loader2
                 self._data = None
 
+        def release_data(self, loader):
+            '''
+            Remove the data of this item from memory, whether parsed or not. If
+            it is needed again, it is read with ``loader`` and parsed afresh.
+            '''
+            self._data = None
+            self._loader = loader
+
+        @property
+        def uncached_data(self):
+            '''
+            The same as :attr:`data` except that if the data is not already in
+            memory, it is not kept in memory after being loaded, unless the
+            loader cannot read it again.
+            '''
+            if self._data is None and self._loader is not None and not getattr(self._loader, 'single_use', False):
+                ans = self.data
+                self._data = None
+                return ans
+            return self.data
+
         @property
         def unicode_representation(self):
             data = self.data
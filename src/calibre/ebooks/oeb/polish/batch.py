@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+# Polishing of many books at a time. The books are polished in a pool of worker
+# processes that are re-used from book to book, so that interpreter startup and
+# imports are paid for only once per worker. The results are appended to a
+# report file, one JSON object per book, as they arrive. Books that already
+# have a successful record in the report are skipped, so an interrupted batch
+# is resumed by running it again with the same report file.
+
+import json
+import os
+import time
+from collections import deque, namedtuple
+from queue import Empty
+
+from calibre import detect_ncpus
+from calibre.ebooks.oeb.polish.main import ALL_OPTS, SUPPORTED
+from calibre.utils.ipc.pool import Failure, Pool
+
+BatchJob = namedtuple('BatchJob', 'book fmt src_fmt inbook outbook')
+
+
+class LibraryInUse(Exception):
+    pass
+
+
+def polish_book(inbook, outbook, actions, parsed_cache_limit=0):
+    ' Polish a single book, runs in the worker process '
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.ebooks.oeb.polish.main import polish_one
+    from calibre.utils.logging import DevNull
+    opts = ALL_OPTS.copy()
+    opts.update(actions)
+    opts = namedtuple('Options', ' '.join(ALL_OPTS))(**opts)
+    size_before = os.path.getsize(inbook)
+    st = time.monotonic()
+    ebook = get_container(inbook, DevNull())
+    ebook.parsed_cache_limit = parsed_cache_limit
+    load_time = time.monotonic() - st
+    action_times, report = {}, []
+    changed = polish_one(ebook, opts, report.append, action_times=action_times)
+    cst = time.monotonic()
+    ebook.commit(outbook)
+    now = time.monotonic()
+    return {
+        'changed': changed, 'size_before': size_before, 'size_after': os.path.getsize(outbook),
+        'time': now - st, 'load_time': load_time, 'commit_time': now - cst,
+        'action_times': action_times, 'parse_time': ebook.parse_stats.parse_time,
+    }
+
+
+def read_report(path):
+    ''' Return the records in the report file at path, as a mapping of (book,
+    format) to record. Later records for a book replace earlier ones. '''
+    ans = {}
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return ans
+    with f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue  # A record truncated by an interruption
+            ans[(r['book'], r['format'])] = r
+    return ans
+
+
+class BatchPolish:
+
+    '''
+    Polish books using a pool of worker processes. Call with an iterable of
+    paths to book files or, if library_path is specified, of book ids in that
+    library. Books in a library are polished in place, the same way the
+    polish action in the calibre GUI does. Books in a library that have no
+    format that can be polished are recorded as skipped, with a format of None.
+    Raises :class:`LibraryInUse` if another calibre program is using the library.
+
+    :param actions: A mapping of the names in ALL_OPTS to True for the actions to perform.
+    :param report_path: The file that the per-book records are appended to.
+    :param output_dir: The folder to write polished files to. By default they are written
+        next to the original with a _polished suffix. Not used for libraries.
+    :param notify: Called with every record as it is written.
+    '''
+
+    def __init__(
+        self, actions, report_path, library_path=None, output_dir=None, max_workers=None,
+        parsed_cache_limit=0, notify=None
+    ):
+        self.actions = {k: v for k, v in actions.items() if v}
+        if self.actions.keys() & {'opf', 'cover'}:
+            raise ValueError('Updating metadata and covers is not supported when polishing in batches')
+        self.report_path = report_path
+        self.library_path, self.output_dir = library_path, output_dir
+        self.max_workers = max_workers or detect_ncpus()
+        self.parsed_cache_limit = parsed_cache_limit
+        self.notify = notify or (lambda record: None)
+        self.db = self.pool = None
+        self.job_counter = 0
+        self.outstanding = {}
+
+    def __call__(self, books):
+        ''' Polish the specified books, returning a mapping of (book, format)
+        to record for all books in the report, including those done by earlier
+        runs. '''
+        if self.library_path is None:
+            return self.polish(books)
+        from calibre.utils.lock import create_single_instance_mutex
+        # Take the same lock as calibredb, so that the library is not changed
+        # by another calibre program at the same time
+        release_mutex = create_single_instance_mutex('db')
+        if release_mutex is None:
+            raise LibraryInUse(_(
+                'Another calibre program such as calibre-server or the main calibre program is running.'
+                ' Having multiple programs that can make changes to a calibre library'
+                ' running at the same time is a bad idea. Close them before polishing books in the library.'))
+        try:
+            from calibre.library import db
+            self.db = db(self.library_path).new_api
+            return self.polish(books)
+        finally:
+            release_mutex()
+
+    def polish(self, books):
+        from calibre.ptempfile import TemporaryDirectory
+        self.records = read_report(self.report_path)
+        jobs = (job for job in self.iterjobs(books) if self.records.get((job.book, job.fmt), {}).get('error', True) is not None)
+        retries = deque()
+        with open(self.report_path, 'a+b') as self.report_file, TemporaryDirectory('_polish_batch') as self.tdir:
+            if self.report_file.tell():
+                # Start on a new line if the last run was interrupted while writing
+                self.report_file.seek(-1, os.SEEK_END)
+                if self.report_file.read(1) != b'\n':
+                    self.report_file.write(b'\n')
+            self.pool = Pool(max_workers=self.max_workers, name='PolishBatch')
+            try:
+                while True:
+                    while len(self.outstanding) < 2 * self.max_workers:
+                        job = retries.popleft() if retries else next(jobs, None)
+                        if job is None:
+                            break
+                        self.start_job(job)
+                    if not self.outstanding:
+                        break
+                    retries.extend(self.wait_for_result())
+            finally:
+                self.pool.shutdown()
+                self.pool = None
+                if self.db is not None:
+                    self.db.close()
+                    self.db = None
+        return self.records
+
+    def iterjobs(self, books):
+        if self.db is None:
+            for path in books:
+                path = os.path.abspath(path)
+                base, ext = os.path.splitext(path)
+                if self.output_dir:
+                    outbook = os.path.join(self.output_dir, os.path.basename(path))
+                else:
+                    outbook = base + '_polished' + ext
+                yield BatchJob(path, ext[1:].upper(), None, path, outbook)
+            return
+        for book_id in books:
+            fmts = self.db.formats(book_id)
+            polishable = False
+            for fmt in sorted(SUPPORTED):
+                # Polish the original format, if present, as the GUI does
+                src = 'ORIGINAL_' + fmt if 'ORIGINAL_' + fmt in fmts else fmt
+                if src in fmts:
+                    polishable = True
+                    path = os.path.join(self.tdir, f'{book_id}.{fmt.lower()}')
+                    yield BatchJob(book_id, fmt, src, path, path)
+            if not polishable:
+                yield BatchJob(book_id, None, None, None, None)
+
+    def start_job(self, job):
+        if job.fmt is None:
+            return self.record(job, {'skipped': True})
+        if job.fmt not in SUPPORTED:
+            return self.record(job, {}, f'Polishing is not supported for the {job.fmt} format')
+        try:
+            if job.src_fmt is not None:
+                self.db.copy_format_to(job.book, job.src_fmt, job.inbook)
+            elif self.output_dir:
+                os.makedirs(self.output_dir, exist_ok=True)
+        except Exception as err:
+            import traceback
+            return self.record(job, {}, str(err), traceback.format_exc())
+        self.job_counter += 1
+        self.outstanding[self.job_counter] = job
+        self.pool(self.job_counter, __name__, 'polish_book', job.inbook, job.outbook, self.actions, self.parsed_cache_limit)
+
+    def wait_for_result(self):
+        while True:
+            try:
+                wr = self.pool.results.get(timeout=0.2)
+            except Empty:
+                if self.pool.failed:
+                    return self.worker_crashed()
+                continue
+            if wr.is_terminal_failure:
+                return self.worker_crashed()
+            self.job_finished(wr)
+            return ()
+
+    def job_finished(self, wr):
+        job = self.outstanding.pop(wr.id)
+        result = wr.result
+        if result.err is not None:
+            return self.record(job, {}, result.err, result.traceback)
+        if job.src_fmt is not None:
+            try:
+                self.add_to_library(job)
+            except Exception as err:
+                import traceback
+                return self.record(job, result.value, str(err), traceback.format_exc())
+        self.record(job, result.value)
+
+    def worker_crashed(self):
+        # The pool is unusable after a worker process crashes. Record the
+        # failure for the book that was being polished, keep any results that
+        # arrived before the crash and re-run everything else in a new pool.
+        tf = self.pool.terminal_failure
+        self.pool.join(5)
+        while True:
+            try:
+                wr = self.pool.results.get_nowait()
+            except Empty:
+                break
+            if not wr.is_terminal_failure and wr.id in self.outstanding:
+                self.job_finished(wr)
+        job = self.outstanding.pop(tf.job_id, None)
+        if job is None:
+            raise Failure(tf)
+        self.record(job, {}, 'The worker process crashed while polishing this book', tf.tb)
+        retries = tuple(self.outstanding.values())
+        self.outstanding.clear()
+        self.pool.shutdown()
+        self.pool = Pool(max_workers=self.max_workers, name='PolishBatch')
+        return retries
+
+    def add_to_library(self, job):
+        from calibre.utils.config import tweaks
+        if tweaks['save_original_format_when_polishing'] and job.src_fmt == job.fmt:
+            self.db.save_original_format(job.book, job.fmt)
+        with open(job.inbook, 'rb') as f:
+            self.db.add_format(job.book, job.fmt, f)
+        os.remove(job.inbook)
+
+    def record(self, job, stats, error=None, tb=None):
+        r = {'book': job.book, 'format': job.fmt, 'output': None if job.src_fmt else job.outbook, 'error': error, 'traceback': tb}
+        r.update(stats)
+        self.records[(job.book, job.fmt)] = r
+        self.report_file.write(json.dumps(r).encode('utf-8') + b'\n')
+        self.report_file.flush()
+        self.notify(r)
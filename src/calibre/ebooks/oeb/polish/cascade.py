@@ -9,7 +9,7 @@
 from operator import itemgetter
 
 from css_parser.css import CSSRule, CSSStyleSheet, Property
-from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError
+from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select
 from tinycss.fonts3 import parse_font_family, serialize_font_family
 
 from calibre import as_unicode
@@ -164,25 +164,16 @@ def resolve_styles(container, name, select=None, sheet_callback=None):
     rule_index_counter = count()
     pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
 
+    # The selectors of all rules are matched together, in a single pass over
+    # the tree, once all sheets have been processed
+    selectors = []
+
     def process_sheet(sheet, sheet_name):
         if sheet_callback is not None:
             sheet_callback(sheet, sheet_name)
         for rule, sheet_name, rule_index in iterrules(container, sheet_name, rules=sheet, rule_index_counter=rule_index_counter, rule_type='STYLE_RULE'):
             for selector in rule.selectorList:
-                text = selector.selectorText
-                try:
-                    matches = tuple(select(text))
-                except SelectorError as err:
-                    container.log.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
-                    continue
-                m = pseudo_pat.search(text)
-                style = normalize_style_declaration(rule.style, sheet_name)
-                if m is None:
-                    for elem in matches:
-                        style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, None))
-                else:
-                    for elem in matches:
-                        pseudo_style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, m.group(1)))
+                selectors.append((selector.selectorText, selector, rule, sheet_name, rule_index))
 
     process_sheet(html_css_stylesheet(container), 'user-agent.css')
 
@@ -208,6 +199,23 @@ def process_sheet(sheet, sheet_name):
                 continue
         process_sheet(sheet, sheet_name)
 
+    errors = {}
+    matches = select.select_many((x[0] for x in selectors), errors)
+    for text, selector, rule, sheet_name, rule_index in selectors:
+        if text in errors:
+            container.log.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(errors[text])})')
+            continue
+        if not matches[text]:
+            continue
+        m = pseudo_pat.search(text)
+        style = normalize_style_declaration(rule.style, sheet_name)
+        if m is None:
+            for elem in matches[text]:
+                style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, None))
+        else:
+            for elem in matches[text]:
+                pseudo_style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, m.group(1)))
+
     for elem in root.xpath('//*[@style]'):
         text = elem.get('style')
         if text:
@@ -9,6 +9,7 @@
 import re
 import shutil
 import sys
+import time
 import unicodedata
 import uuid
 from collections import defaultdict
@@ -17,6 +18,7 @@
 from math import floor
 
 from css_parser import getUrls, replaceUrls
+from lxml import etree
 
 from calibre import CurrentDir, walk
 from calibre.constants import iswindows
@@ -140,6 +142,22 @@ def seconds_to_timestamp(duration: float) -> str:
     return ans
 
 
+class ParseStats:
+
+    ''' Counts of the work done by :meth:`Container.parsed`, useful to profile
+    polishing actions. '''
+
+    __slots__ = ('commits_on_eviction', 'evictions', 'hits', 'parse_time', 'parses')
+
+    def __init__(self):
+        self.parses = self.hits = self.evictions = self.commits_on_eviction = 0
+        self.parse_time = 0.
+
+    def __str__(self):
+        return (f'{self.parses} files parsed in {self.parse_time:.2f} seconds, {self.hits} cache hits,'
+                f' {self.evictions} evictions ({self.commits_on_eviction} committed)')
+
+
 class ContainerBase:  # {{{
     '''
     A base class that implements just the parsing methods. Useful to create
@@ -229,6 +247,10 @@ class Container(ContainerBase):  # {{{
     SUPPORTS_FILENAMES = True
     MAX_HTML_FILE_SIZE = 0
 
+    #: The maximum number of parsed HTML and XML files to keep in memory, zero
+    #: means no limit. See :meth:`parsed`.
+    parsed_cache_limit = 0
+
     @property
     def book_type_for_display(self):
         return self.book_type.upper()
@@ -239,6 +261,7 @@ def __init__(self, rootpath=None, opfpath=None, log=default_log, clone_data=None
 
         self.name_path_map = {}
         self.dirtied = set()
+        self.parse_stats = ParseStats()
         self.pretty_print = set()
         self.cloned = False
         self.cache_names = ('parsed_cache', 'mime_map', 'name_path_map', 'encoding_map', 'dirtied', 'pretty_print')
@@ -624,22 +647,58 @@ def parsed(self, name):
         HTML and XML files an lxml tree is returned. For CSS files a css_parser
         stylesheet is returned. Note that parsed objects are cached for
         performance. If you make any changes to the parsed object, you must
-        call :meth:`dirty` so that the container knows to update the cache. See also :meth:`replace`.'''
+        call :meth:`dirty` so that the container knows to update the cache. See also :meth:`replace`.
+
+        If :attr:`parsed_cache_limit` is set, the cache is kept in least
+        recently used order, so that :meth:`evict_parsed` can shrink it.'''
         ans = self.parsed_cache.get(name, None)
         if ans is None:
             self.used_encoding = None
             mime = self.mime_map.get(name, guess_type(name))
+            st = time.monotonic()
             ans = self.parse(self.name_path_map[name], mime)
+            self.parse_stats.parse_time += time.monotonic() - st
+            self.parse_stats.parses += 1
             self.parsed_cache[name] = ans
             self.encoding_map[name] = self.used_encoding
+        else:
+            self.parse_stats.hits += 1
+            if self.parsed_cache_limit > 0:
+                # Mark as most recently used
+                self.parsed_cache[name] = self.parsed_cache.pop(name)
         return ans
 
+    def evict_parsed(self):
+        ''' Remove the least recently used HTML and XML files from the cache of
+        parsed objects until it is no larger than :attr:`parsed_cache_limit`,
+        committing dirty files first. The OPF is never removed. Callers may
+        hold on to elements of parsed trees, which would then silently
+        become detached from the container, so this must only be called at
+        points where no parsed objects are in use, such as between polishing
+        actions or at the end of each iteration of a loop over the files of
+        the book. '''
+        limit = self.parsed_cache_limit
+        if limit < 1 or len(self.parsed_cache) <= limit:
+            return
+        for name in tuple(self.parsed_cache):
+            if name == self.opf_name or not etree.iselement(self.parsed_cache[name]):
+                continue
+            if name in self.dirtied:
+                self.commit_item(name)
+                self.parse_stats.commits_on_eviction += 1
+            else:
+                del self.parsed_cache[name]
+            self.parse_stats.evictions += 1
+            if len(self.parsed_cache) <= limit:
+                break
+
     def replace(self, name, obj):
         '''
         Replace the parsed object corresponding to name with obj, which must be
         a similar object, i.e. an lxml tree for HTML/XML or a css_parser
         stylesheet for a CSS file.
         '''
+        self.parsed_cache.pop(name, None)
         self.parsed_cache[name] = obj
         self.dirty(name)
 
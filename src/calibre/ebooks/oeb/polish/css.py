@@ -10,7 +10,7 @@
 from operator import itemgetter
 
 from css_parser.css import CSSRule, CSSStyleDeclaration
-from css_selectors import Select, SelectorError, SelectorSyntaxError, parse
+from css_selectors import Select, SelectorSyntaxError, parse
 
 from calibre import force_unicode
 from calibre.ebooks.oeb.base import OEB_DOCS, OEB_STYLES, XHTML, css_text
@@ -30,23 +30,25 @@ class SelectorStatus:
 
 def mark_used_selectors(rules, log, select):
     ans = SelectorStatus()
+    unknown = []
     for rule in rules:
         for selector in rule.selectorList:
             if getattr(selector, 'calibre_used', False):
                 ans.any_used = True
-                continue
-            try:
-                if select.has_matches(selector.selectorText):
-                    selector.calibre_used = True
-                    ans.any_used = True
-                else:
-                    ans.any_unused = True
-                    selector.calibre_used = False
-            except SelectorError:
-                # Cannot parse/execute this selector, be safe and assume it
-                # matches something
+            else:
+                unknown.append(selector)
+    if unknown:
+        errors = {}
+        matches = select.select_many((selector.selectorText for selector in unknown), errors)
+        for selector in unknown:
+            # Be safe and assume that selectors that cannot be parsed/executed
+            # match something
+            if selector.selectorText in errors or matches[selector.selectorText]:
                 selector.calibre_used = True
                 ans.any_used = True
+            else:
+                ans.any_unused = True
+                selector.calibre_used = False
     return ans
 
 
@@ -252,6 +254,7 @@ def safe_parse(name):
                         del elem.attrib['class']
                     num_of_removed_classes += len(original_classes) - len(classes)
                     container.dirty(name)
+        container.evict_parsed()
 
     for name, sheet in iteritems(sheets):
         if name in unreferenced_sheets:
@@ -2,22 +2,56 @@
 # License: GPLv3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import hashlib
 import os
+import time
+from collections import OrderedDict
 from functools import partial
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 
 from calibre import detect_ncpus, filesystem_encoding, force_unicode, human_readable
 from polyglot.builtins import iteritems
 from polyglot.queue import Empty, Queue
 
+# Images compressed by this process, so that images shared by many books are
+# compressed only once when polishing books in batches. Maps the hash of the
+# original image and the settings used to compress it to the compressed
+# data, or None if it could not be compressed further.
+CACHE_SIZE = 32 * 1024 * 1024
+compressed_cache = OrderedDict()
+compressed_cache_size = 0
+compressed_cache_lock = Lock()
+
+
+def cached_compressed_data(key):
+    with compressed_cache_lock:
+        ans = compressed_cache.get(key, False)
+        if ans is not False:
+            compressed_cache.move_to_end(key)
+        return ans
+
+
+def cache_compressed_data(key, data):
+    global compressed_cache_size
+    size = 0 if data is None else len(data)
+    if size > CACHE_SIZE // 4:
+        return
+    with compressed_cache_lock:
+        if key not in compressed_cache:
+            compressed_cache[key] = data
+            compressed_cache_size += size
+        while compressed_cache_size > CACHE_SIZE:
+            old = compressed_cache.popitem(last=False)[1]
+            compressed_cache_size -= 0 if old is None else len(old)
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, abort, name, queue, results, jpeg_quality, webp_quality, progress_callback):
+    def __init__(self, abort, name, queue, results, timings, jpeg_quality, webp_quality, progress_callback):
         Thread.__init__(self, name=name)
-        self.queue, self.results = queue, results
+        self.queue, self.results, self.timings = queue, results, timings
         self.progress_callback = progress_callback
         self.jpeg_quality = jpeg_quality
         self.webp_quality = webp_quality
@@ -30,12 +64,14 @@ def run(self):
                 name, path, mt = self.queue.get_nowait()
             except Empty:
                 break
+            st = time.monotonic()
             try:
                 self.compress(name, path, mt)
             except Exception:
                 import traceback
                 self.results[name] = (False, traceback.format_exc())
             finally:
+                self.timings[name] = time.monotonic() - st
                 try:
                     self.progress_callback(name)
                 except Exception:
@@ -56,15 +92,29 @@ def compress(self, name, path, mime_type):
             func = optimize_jpeg
         else:
             func = partial(encode_jpeg, quality=self.jpeg_quality)
-        before = os.path.getsize(path)
         with open(path, 'rb') as f:
             old_data = f.read()
-        func(path)
-        after = os.path.getsize(path)
-        if after >= before:
-            with open(path, 'wb') as f:
-                f.write(old_data)
+        before = len(old_data)
+        key = hashlib.sha1(old_data).digest(), mime_type, self.jpeg_quality, self.webp_quality
+        data = cached_compressed_data(key)
+        if data is False:
+            func(path)
+            after = os.path.getsize(path)
+            if after >= before:
+                with open(path, 'wb') as f:
+                    f.write(old_data)
+                after = before
+                data = None
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            cache_compressed_data(key, data)
+        elif data is None:
             after = before
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+            after = len(data)
         self.results[name] = (True, (before, after))
 
 
@@ -80,26 +130,42 @@ def compress_images(container, report=None, names=None, jpeg_quality=None, webp_
     images = get_compressible_images(container)
     if names is not None:
         images &= set(names)
-    results = {}
+    results, timings = {}, {}
     queue = Queue()
     abort = Event()
-    seen = set()
+    seen_paths, seen_contents = set(), {}
+    duplicates = []
     num_to_process = 0
     for name in sorted(images):
         path = os.path.abspath(container.get_file_path_for_processing(name))
+        # Images that are the same file or that have the same contents are
+        # compressed only once
+        with open(path, 'rb') as f:
+            key = hashlib.sha1(f.read()).digest(), container.mime_map[name]
         path_key = os.path.normcase(path)
-        if path_key not in seen:
+        if path_key in seen_paths:
+            continue
+        seen_paths.add(path_key)
+        if key in seen_contents:
+            duplicates.append((name, path, seen_contents[key]))
+        else:
             num_to_process += 1
             queue.put((name, path, container.mime_map[name]))
-            seen.add(path_key)
+            seen_contents[key] = name
 
     def pc(name):
         keep_going = progress_callback(len(results), num_to_process, name)
         if not keep_going:
             abort.set()
     progress_callback(0, num_to_process, '')
-    [Worker(abort, f'CompressImage{i}', queue, results, jpeg_quality, webp_quality, pc) for i in range(min(detect_ncpus(), num_to_process))]
+    [Worker(abort, f'CompressImage{i}', queue, results, timings, jpeg_quality, webp_quality, pc) for i in range(min(detect_ncpus(), num_to_process))]
     queue.join()
+    for name, path, original in duplicates:
+        if original in results:
+            results[name] = ok, res = results[original]
+            if ok and res[0] != res[1]:
+                with open(container.get_file_path_for_processing(original), 'rb') as src, open(path, 'wb') as dest:
+                    dest.write(src.read())
     before_total = after_total = 0
     processed_num = 0
     changed = False
@@ -118,6 +184,10 @@ def pc(name):
                         name, human_readable(before), human_readable(after), (before - after)/before))
                 else:
                     report(_('{0} could not be further compressed').format(name))
+                if name in timings:
+                    report('\t' + _('Processed in {:.2f} seconds').format(timings[name]))
+                else:
+                    report('\t' + _('Identical to an image that was already processed'))
         else:
             report(_('Failed to process {0} with error:').format(name))
             report(res)
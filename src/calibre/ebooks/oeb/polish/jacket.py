@@ -74,7 +74,7 @@ def remove_jacket(container):
 
 
 def remove_jacket_images(container, name):
-    root = container.parsed_cache[name]
+    root = container.parsed(name)
     for img in root.xpath('//*[local-name() = "img" and @src]'):
         iname = container.href_to_name(img.get('src'), name)
         if container.has_name(iname):
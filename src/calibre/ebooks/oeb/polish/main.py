@@ -194,9 +194,21 @@ def download_resources(ebook, report) -> bool:
     return changed
 
 
-def polish_one(ebook, opts, report, customization=None):
-    def rt(x):
-        return report('\n### ' + x)
+def polish_one(ebook, opts, report, customization=None, action_times=None):
+    current_action, action_start = None, time.monotonic()
+
+    def rt(x, action=None):
+        # Each action starts with a heading, use it to time the previous action
+        # and, as no parsed objects are in use between actions, to shrink the
+        # cache of parsed files
+        nonlocal current_action, action_start
+        ebook.evict_parsed()
+        now = time.monotonic()
+        if action_times is not None and current_action is not None:
+            action_times[current_action] = action_times.get(current_action, 0) + now - action_start
+        current_action, action_start = action, now
+        if x:
+            return report('\n### ' + x)
     jacket = None
     changed = False
     customization = customization or CUSTOMIZATION.copy()
@@ -210,7 +222,7 @@ def rt(x):
 
     if opts.opf:
         changed = True
-        rt(_('Updating metadata'))
+        rt(_('Updating metadata'), 'opf')
         update_metadata(ebook, opts.opf)
         jacket = find_existing_jacket(ebook)
         if jacket is not None:
@@ -220,13 +232,13 @@ def rt(x):
 
     if opts.cover:
         changed = True
-        rt(_('Setting cover'))
+        rt(_('Setting cover'), 'cover')
         set_cover(ebook, opts.cover, report)
         report('')
 
     if opts.jacket:
         changed = True
-        rt(_('Inserting metadata jacket'))
+        rt(_('Inserting metadata jacket'), 'jacket')
         if jacket is None:
             if add_or_replace_jacket(ebook):
                 report(_('Existing metadata jacket replaced'))
@@ -237,7 +249,7 @@ def rt(x):
         report('')
 
     if opts.remove_jacket:
-        rt(_('Removing metadata jacket'))
+        rt(_('Removing metadata jacket'), 'remove_jacket')
         if remove_jacket(ebook):
             report(_('Metadata jacket removed'))
             changed = True
@@ -246,13 +258,13 @@ def rt(x):
         report('')
 
     if opts.smarten_punctuation:
-        rt(_('Smartening punctuation'))
+        rt(_('Smartening punctuation'), 'smarten_punctuation')
         if smarten_punctuation(ebook, report):
             changed = True
         report('')
 
     if opts.embed:
-        rt(_('Embedding referenced fonts'))
+        rt(_('Embedding referenced fonts'), 'embed')
         if embed_all_fonts(ebook, stats, report):
             changed = True
             has_subsettable_fonts = True
@@ -260,15 +272,15 @@ def rt(x):
 
     if opts.subset:
         if has_subsettable_fonts:
-            rt(_('Subsetting embedded fonts'))
+            rt(_('Subsetting embedded fonts'), 'subset')
             if subset_all_fonts(ebook, stats.font_stats, report):
                 changed = True
         else:
-            rt(_('No embedded fonts to subset'))
+            rt(_('No embedded fonts to subset'), 'subset')
         report('')
 
     if opts.remove_unused_css:
-        rt(_('Removing unused CSS rules'))
+        rt(_('Removing unused CSS rules'), 'remove_unused_css')
         if remove_unused_css(
             ebook, report,
             remove_unused_classes=customization['remove_unused_classes'],
@@ -280,28 +292,28 @@ def rt(x):
         report('')
 
     if opts.compress_images:
-        rt(_('Losslessly compressing images'))
+        rt(_('Losslessly compressing images'), 'compress_images')
         if compress_images(ebook, report)[0]:
             changed = True
         report('')
 
     if opts.upgrade_book:
-        rt(_('Upgrading book, if possible'))
+        rt(_('Upgrading book, if possible'), 'upgrade_book')
         if upgrade_book(ebook, report, remove_ncx=customization['remove_ncx']):
             changed = True
         report('')
 
     if opts.remove_soft_hyphens:
-        rt(_('Removing soft hyphens'))
+        rt(_('Removing soft hyphens'), 'remove_soft_hyphens')
         remove_soft_hyphens(ebook, report)
         changed = True
     elif opts.add_soft_hyphens:
-        rt(_('Adding soft hyphens'))
+        rt(_('Adding soft hyphens'), 'add_soft_hyphens')
         add_soft_hyphens(ebook, report)
         changed = True
 
     if opts.download_external_resources:
-        rt(_('Downloading external resources'))
+        rt(_('Downloading external resources'), 'download_external_resources')
         try:
             download_resources(ebook, report)
         except Exception:
@@ -310,16 +322,19 @@ def rt(x):
             report(traceback.format_exc())
         report('')
 
+    rt(None)
     return changed
 
 
-def polish(file_map, opts, log, report):
+def polish(file_map, opts, log, report, parsed_cache_limit=0):
     st = time.time()
     for inbook, outbook in iteritems(file_map):
         report(_('## Polishing: %s')%(inbook.rpartition('.')[-1].upper()))
         ebook = get_container(inbook, log)
+        ebook.parsed_cache_limit = parsed_cache_limit
         polish_one(ebook, opts, report)
         ebook.commit(outbook)
+        log.debug('Parse statistics for', inbook + ':', ebook.parse_stats)
         report('-'*70)
     report(_('Polishing took: %.1f seconds')%(time.time()-st))
 
@@ -382,30 +397,80 @@ def option_parser():
     o('--upgrade-book', '-U', help=CLI_HELP['upgrade_book'])
     o('--download-external-resources', '-d', help=CLI_HELP['download_external_resources'])
 
+    a('--max-parsed-files', type='int', default=0, help=_(
+        'The maximum number of HTML files to keep parsed in memory between polishing actions, when polishing books with very many files.'
+        ' Zero, the default, means no limit. Use with --verbose to see how much parsing is done.'))
     o('--verbose', help=_('Produce more verbose output, useful for debugging.'))
 
+    a('--batch', metavar='REPORT_FILE', help=_(
+        'Polish many books at a time, in a pool of worker processes. All the arguments are the books to polish,'
+        ' each is written next to the original with a _polished suffix, unless --output-folder is used.'
+        ' A report with one line of JSON per book is appended to REPORT_FILE.'
+        ' Books that were successfully polished according to an existing REPORT_FILE are skipped,'
+        ' so to resume an interrupted batch, run the same command again.'))
+    a('--books-from', metavar='FILE', help=_(
+        'With --batch, read the books to polish from FILE, one per line, in addition to the arguments.'))
+    a('--with-library', metavar='LIBRARY', help=_(
+        'With --batch, the books to polish are book ids in the specified calibre library. They are'
+        ' polished in place, as in the calibre program. Note that calibre must not be running.'))
+    a('--output-folder', help=_('With --batch, write polished files to this folder.'))
+    a('--workers', type='int', default=0, help=_(
+        'With --batch, the number of worker processes to use. Defaults to the number of CPU cores.'))
+
     return parser
 
 
+def batch_main(opts, args, popts, log):
+    from calibre.ebooks.oeb.polish.batch import BatchPolish, LibraryInUse
+    if opts.books_from:
+        with open(opts.books_from, encoding='utf-8') as f:
+            args += [x.strip() for x in f if x.strip()]
+    if opts.with_library:
+        try:
+            args = [int(x) for x in args]
+        except ValueError:
+            raise SystemExit(_('Book ids must be integers'))
+    counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+
+    def notify(r):
+        if r.get('skipped'):
+            counts['skipped'] += 1
+            log(_('Skipped {0}: it has no format that can be polished').format(r['book']))
+        elif r['error'] is None:
+            counts['ok'] += 1
+            log(_('Polished {0}: {1} to {2} bytes in {3:.1f} seconds').format(r['book'], r['size_before'], r['size_after'], r['time']))
+        else:
+            counts['failed'] += 1
+            log.error(_('Failed to polish {0}: {1}').format(r['book'], r['error']))
+            if r['traceback']:
+                log.debug(r['traceback'])
+
+    bp = BatchPolish(
+        popts._asdict(), opts.batch, library_path=opts.with_library, output_dir=opts.output_folder,
+        max_workers=opts.workers, parsed_cache_limit=opts.max_parsed_files, notify=notify)
+    try:
+        bp(args)
+    except LibraryInUse as err:
+        log.error(str(err))
+        raise SystemExit(1)
+    log(_('{0} books polished, {1} failed, {2} skipped, report written to: {3}').format(
+        counts['ok'], counts['failed'], counts['skipped'], opts.batch))
+    if counts['failed']:
+        raise SystemExit(1)
+
+
 def main(args=None):
     parser = option_parser()
     opts, args = parser.parse_args(args or sys.argv[1:])
     log = Log(level=Log.DEBUG if opts.verbose else Log.INFO)
-    if not args:
+    if not args and not (opts.batch and opts.books_from):
         parser.print_help()
         log.error(_('You must provide the input file to polish'))
         raise SystemExit(1)
-    if len(args) > 2:
+    if len(args) > 2 and not opts.batch:
         parser.print_help()
         log.error(_('Unknown extra arguments'))
         raise SystemExit(1)
-    if len(args) == 1:
-        inbook = args[0]
-        base, ext = inbook.rpartition('.')[0::2]
-        outbook = base + '_polished.' + ext
-    else:
-        inbook, outbook = args
-
     popts = ALL_OPTS.copy()
     for k, v in iteritems(popts):
         popts[k] = getattr(opts, k, None)
@@ -418,7 +483,20 @@ def main(args=None):
         log.error(_('You must specify at least one action to perform'))
         raise SystemExit(1)
 
-    polish({inbook:outbook}, popts, log, report.append)
+    if opts.batch:
+        if popts.opf or popts.cover:
+            log.error(_('Updating metadata and covers is not supported with --batch'))
+            raise SystemExit(1)
+        return batch_main(opts, args, popts, log)
+
+    if len(args) == 1:
+        inbook = args[0]
+        base, ext = inbook.rpartition('.')[0::2]
+        outbook = base + '_polished.' + ext
+    else:
+        inbook, outbook = args
+
+    polish({inbook:outbook}, popts, log, report.append, parsed_cache_limit=opts.max_parsed_files)
     log('')
     log(REPORT)
     for msg in report:
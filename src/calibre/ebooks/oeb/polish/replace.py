@@ -176,6 +176,7 @@ def smarten_punctuation(container, report):
                 m.getparent().remove(m)
             container.dirty(name)
             smartened = True
+        container.evict_parsed()
     if not smartened:
         report(_('No punctuation that could be smartened found'))
     return smartened
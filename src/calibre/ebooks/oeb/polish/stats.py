@@ -298,6 +298,7 @@ def collect_font_stats(self, container, do_embed=False):
             self.font_usage_map[name] = {}
             self.font_spec_map[name] = set()
             self.get_font_usage(container, name, resolve_property, resolve_pseudo_property, font_face_rules, do_embed)
+            container.evict_parsed()
         self.font_stats = {k:{safe_chr(x) for x in v} for k, v in iteritems(self.font_stats)}
         for fum in itervalues(self.font_usage_map):
             for v in itervalues(fum):
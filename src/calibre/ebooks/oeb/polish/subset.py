@@ -103,6 +103,7 @@ def subset_all_fonts(container, font_stats, report):
                         if remove_font_face_rules(container, sheet, remove, name):
                             style.text = css_text(sheet)
                             container.dirty(name)
+                container.evict_parsed()
     if total_old > 0:
         report(_('Reduced total font size to %.1f%% of original')%(
             total_new/total_old*100))
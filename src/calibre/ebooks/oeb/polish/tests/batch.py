@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+import os
+import shutil
+
+from calibre.ebooks.oeb.polish.batch import BatchPolish, LibraryInUse, read_report
+from calibre.ebooks.oeb.polish.tests.base import BaseTest
+from calibre.utils.resources import get_path as P
+
+
+class BatchTests(BaseTest):
+
+    def test_batch_polish(self):
+        ' Test polishing of books in batches, with resume '
+        books = []
+        for i in range(3):
+            books.append(os.path.join(self.tdir, f'{i}.epub'))
+            shutil.copy2(P('quick_start/eng.epub', allow_user_override=False), books[-1])
+        bad = os.path.join(self.tdir, 'bad.epub')
+        with open(bad, 'wb') as f:
+            f.write(b'not an epub')
+        books.append(bad)
+        report = os.path.join(self.tdir, 'report.jsonl')
+        out = os.path.join(self.tdir, 'out')
+        notified = []
+        bp = BatchPolish({'remove_unused_css': True, 'upgrade_book': True}, report, output_dir=out, max_workers=2, notify=notified.append)
+        records = bp(books)
+        self.assertEqual(len(notified), len(books))
+        for book in books[:-1]:
+            r = records[(book, 'EPUB')]
+            self.assertIsNone(r['error'])
+            self.assertTrue(os.path.exists(r['output']))
+            self.assertEqual(r['size_before'], os.path.getsize(book))
+            self.assertEqual(r['size_after'], os.path.getsize(r['output']))
+            self.assertEqual(set(r['action_times']), {'remove_unused_css', 'upgrade_book'})
+        r = records[(bad, 'EPUB')]
+        self.assertTrue(r['error'])
+        self.assertTrue(r['traceback'])
+        self.assertEqual(read_report(report), records)
+
+        # Resuming polishes only the books that failed or are new, appending to the report
+        del notified[:]
+        with open(report, 'a') as f:
+            f.write('{"book": "truncated')
+        os.remove(bad)
+        shutil.copy2(books[0], bad)
+        records = bp(books)
+        self.assertEqual([r['book'] for r in notified], [bad])
+        self.assertIsNone(records[(bad, 'EPUB')]['error'])
+        self.assertEqual(len(records), len(books))
+
+    def test_batch_polish_library_lock(self):
+        ' Test that polishing books in a library requires the library lock '
+        from unittest.mock import patch
+        report = os.path.join(self.tdir, 'report.jsonl')
+        bp = BatchPolish({'upgrade_book': True}, report, library_path=os.path.join(self.tdir, 'library'))
+        with patch('calibre.utils.lock.create_single_instance_mutex', return_value=None):
+            self.assertRaises(LibraryInUse, bp, [1])
+        self.assertIsNone(bp.db)
+        self.assertFalse(os.path.exists(report))
+
+    def test_batch_polish_library(self):
+        ' Test polishing of books in a library '
+        from calibre.ebooks.metadata.book.base import Metadata
+        from calibre.library import db
+        library_path = os.path.join(self.tdir, 'library')
+        os.mkdir(library_path)
+        txt = os.path.join(self.tdir, 'book.txt')
+        with open(txt, 'wb') as f:
+            f.write(b'text')
+        cache = db(library_path).new_api
+        (epub_book, txt_book), duplicates = cache.add_books([
+            (Metadata('EPUB book', ['A']), {'EPUB': P('quick_start/eng.epub', allow_user_override=False)}),
+            (Metadata('TXT book', ['A']), {'TXT': txt})])
+        cache.close()
+        report = os.path.join(self.tdir, 'report.jsonl')
+        bp = BatchPolish({'upgrade_book': True}, report, library_path=library_path, max_workers=1)
+        records = bp([epub_book, txt_book])
+        self.assertIsNone(records[(epub_book, 'EPUB')]['error'])
+        r = records[(txt_book, None)]
+        self.assertTrue(r['skipped'])
+        self.assertIsNone(r['error'])
+        self.assertEqual(read_report(report), records)
+        cache = db(library_path).new_api
+        self.assertEqual(set(cache.formats(epub_book)), {'EPUB', 'ORIGINAL_EPUB'})
+        cache.close()
+
+
+def find_tests():
+    import unittest
+    return unittest.defaultTestLoader.loadTestsFromTestCase(BatchTests)
+
+
+def run_tests():
+    from calibre.utils.run_tests import run_tests
+    run_tests(find_tests)
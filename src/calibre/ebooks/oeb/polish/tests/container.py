@@ -277,6 +277,57 @@ def create_book(source):
                 self.assertTrue(os.path.exists('images/test-container.xyz'))
                 self.assertFalse(os.path.exists('images/cover.jpg'))
 
+    def test_parsed_cache_limit(self):
+        ' Test the bounded cache of parsed objects '
+        c = get_container(P('quick_start/eng.epub', allow_user_override=False), tdir=self.tdir)
+        c.parsed_cache_limit = 3
+        names = [name for name, is_linear in c.spine_names]
+        self.assertGreater(len(names), 3)
+        # Nothing is evicted while parsing, so elements held by callers
+        # stay attached to the container
+        held = c.parsed(names[0])[0]
+        for name in names[1:]:
+            c.parsed(name)
+        held.set('data-test', 'changed')
+        c.dirty(names[0])
+        self.assertLessEqual(set(names), set(c.parsed_cache))
+        self.assertEqual(c.parse_stats.evictions, 0)
+        c.parsed(names[1])
+        before = len(c.parsed_cache)
+        c.evict_parsed()
+        # The OPF and the most recently used files are kept
+        self.assertEqual(set(c.parsed_cache), {c.opf_name, names[1], names[-1]})
+        s = c.parse_stats
+        self.assertEqual(s.parses, len(names) + 1)
+        self.assertEqual(s.commits_on_eviction, 1)
+        self.assertEqual(s.evictions, before - 3)
+        self.assertEqual(c.parsed(names[0])[0].get('data-test'), 'changed')
+        self.assertEqual(s.parses, len(names) + 2)
+
+        c = get_container(P('quick_start/eng.epub', allow_user_override=False), tdir=self.tdir)
+        for name, is_linear in c.spine_names:
+            c.parsed(name)
+        c.evict_parsed()
+        self.assertLessEqual(set(names) | {c.opf_name}, set(c.parsed_cache))
+        self.assertEqual(c.parse_stats.evictions, 0)
+
+        # Actions that walk every file evict as they go, without losing edits
+        from calibre.ebooks.oeb.polish.css import remove_unused_css
+        results = []
+        for limit in (0, 2):
+            c = get_container(P('quick_start/eng.epub', allow_user_override=False), tdir=self.tdir)
+            for name in names:
+                c.parsed(name)[-1].set('class', 'no-such-class')
+                c.dirty(name)
+                c.commit_item(name)
+            c.parsed_cache_limit = limit
+            self.assertTrue(remove_unused_css(c, remove_unused_classes=True))
+            results.append({name: c.raw_data(name) for name in names})
+            if limit:
+                self.assertLessEqual(len([x for x in itervalues(c.parsed_cache) if hasattr(x, 'xpath')]), limit)
+                self.assertGreater(c.parse_stats.commits_on_eviction, 0)
+        self.assertEqual(results[0], results[1])
+
     def test_folder_type_map_case(self):
         book = get_simple_book()
         c = get_container(book)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+# Splitting of large flows to size during conversion. The huge_flow() fixture
+# generates a synthetic single file book, benchmark the splitting of it with:
+# calibre-debug -c "from calibre.ebooks.oeb.polish.tests.splitting import main; main()"
+
+import re
+import time
+
+from lxml import etree
+
+from calibre.ebooks.oeb.polish.tests.base import BaseTest
+
+
+def huge_flow(size=50 * 1024 * 1024):
+    # Return the markup of a single XHTML file of approximately size bytes,
+    # made of chapters of headings, paragraphs, lists and pre blocks, with
+    # internal links across the whole file
+    para = ('Lorem ipsum dolor sit amet, consectetur &amp; adipiscing elit, sed <b>do eiusmod</b> tempor'
+            ' incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud. ')
+    parts, total, i = [], 0, 0
+    while total < size:
+        chapter = [f'<div class="chapter" id="c{i}"><h2>Chapter {i}</h2>',
+                   f'<p>See <a href="#c{max(0, i - 1)}">the previous chapter</a>.</p>']
+        for j in range(40):
+            chapter.append(f'<p id="p{i}_{j}">{para * 3}</p>')
+            if j % 10 == 0:
+                chapter.append('<ul>' + ''.join(f'<li>{para}</li>' for k in range(5)) + '</ul>')
+            if j % 20 == 0:
+                chapter.append('<pre>' + '\n'.join(f'line {k} &lt;code&gt;' for k in range(50)) + '</pre>')
+        chapter.append('</div>\n')
+        chapter = ''.join(chapter)
+        parts.append(chapter)
+        total += len(chapter)
+        i += 1
+    return ('<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Huge</title></head><body>' +
+            ''.join(parts) + '</body></html>')
+
+
+def split_flow(raw, max_flow_size):
+    # Split the flow in raw as the conversion pipeline does, returning the
+    # roots of the resulting files in spine order
+    from calibre.ebooks.oeb.base import XHTML_MIME, OEBBook
+    from calibre.ebooks.oeb.transforms.split import Split
+    from calibre.utils.logging import DevNull
+    oeb = OEBBook(DevNull(), html_preprocessor=None)
+    item = oeb.manifest.add('index', 'index.html', XHTML_MIME, data=etree.fromstring(raw))
+    oeb.spine.add(item, True)
+
+    class Opts:
+        epub_version = '2'
+
+    Split(split_on_page_breaks=False, max_flow_size=max_flow_size)(oeb, Opts())
+    return [x.data for x in oeb.spine]
+
+
+def text_of(root):
+    body = root.find('{http://www.w3.org/1999/xhtml}body')
+    return re.sub(r'\s+', '', etree.tostring(body, method='text', encoding='unicode', with_tail=False))
+
+
+class Splitting(BaseTest):
+
+    def test_split_to_size(self):
+        ' Test splitting of large flows to size '
+        from calibre.ebooks.oeb.transforms.split import MIN_SPLIT_SIZE, tostring
+        raw = huge_flow(3 * 1024 * 1024)
+        max_flow_size = 260 * 1024
+        roots = split_flow(raw, max_flow_size)
+        sizes = [len(tostring(r)) for r in roots]
+        self.assertLessEqual(max(sizes), max_flow_size)
+        self.assertGreaterEqual(min(sizes), MIN_SPLIT_SIZE)
+        self.assertLess(len(roots), 2 * len(raw) / max_flow_size)
+        self.assertEqual(text_of(etree.fromstring(raw)), ''.join(map(text_of, roots)))
+        for r in roots:
+            self.assertEqual(r.xpath('local-name(/*/*[2])'), 'body')
+            self.assertEqual(r.xpath('string(//*[local-name()="title"])'), 'Huge')
+        ids = [r.xpath('//@id') for r in roots]
+        self.assertEqual(sum(map(len, ids)), len(set().union(*map(set, ids))))
+        # Links to anchors in other files are rewritten
+        links = {a.get('href') for r in roots[1:] for a in r.xpath('//*[local-name()="a"]')}
+        self.assertTrue(any('index_split_' in x for x in links))
+
+        # A flow with nowhere to split it
+        raw = '<html xmlns="http://www.w3.org/1999/xhtml"><head></head><body><span>{}</span></body></html>'.format('x' * 1024 * 20)
+        self.assertRaises(ValueError, split_flow, raw, 10 * 1024)
+        raw = raw.replace('span', 'p')
+        self.assertRaises(ValueError, split_flow, raw, 10 * 1024)
+
+
+def main(sizes=(5, 20, 50), max_flow_size=260 * 1024):
+    for size in sizes:
+        raw = huge_flow(size * 1024 * 1024)
+        st = time.monotonic()
+        roots = split_flow(raw, max_flow_size)
+        print(f'Split a {size} MB flow into {len(roots)} files in {time.monotonic() - st:.1f} seconds')
+
+
+def find_tests():
+    import unittest
+    return unittest.defaultTestLoader.loadTestsFromTestCase(Splitting)
+
+
+def run_tests():
+    from calibre.utils.run_tests import run_tests
+    run_tests(find_tests)
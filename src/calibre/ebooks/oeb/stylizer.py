@@ -11,6 +11,8 @@
 import os
 import re
 import unicodedata
+from collections import defaultdict
+from functools import lru_cache
 from operator import itemgetter
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
@@ -19,7 +21,9 @@
 from css_parser import log as css_parser_log
 from css_parser import profile as cssprofiles
 from css_parser.css import CSSFontFaceRule, CSSPageRule, CSSStyleRule, cssproperties
-from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError
+from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError, parse
+from css_selectors.parser import ascii_lower
+from css_selectors.select import index_keys
 from tinycss.media3 import CSSMedia3Parser
 
 from calibre import as_unicode, force_unicode
@@ -69,6 +73,11 @@ def html_css_stylesheet():
 IGNORED_MEDIA_FEATURES = frozenset('width min-width max-width height min-height max-height device-width min-device-width max-device-width device-height min-device-height max-device-height aspect-ratio min-aspect-ratio max-aspect-ratio device-aspect-ratio min-device-aspect-ratio max-device-aspect-ratio color min-color max-color color-index min-color-index max-color-index monochrome min-monochrome max-monochrome -webkit-min-device-pixel-ratio resolution min-resolution max-resolution scan grid'.split())  # noqa: E501
 
 
+@lru_cache(maxsize=8192)
+def parse_selector(text):
+    return tuple(parse(text))
+
+
 def media_ok(raw):
     if not raw:
         return True
@@ -115,48 +124,134 @@ def __init__(self):
         self.important_properties = set()
 
 
+class RuleIndex:
+
+    ''' The rules of a :class:`StylizerRules`, bucketed by the rightmost
+    simple selector, so that each element is only matched against the rules
+    that could apply to it. '''
+
+    pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
+
+    def __init__(self, rules, select):
+        self.entries = []
+        self.pseudo_classes = {}
+        self.errors = []
+        for i, (_, _, _, text, _) in enumerate(rules):
+            try:
+                parsed_selectors = parse_selector(text)
+                matchers = [select.compile_parsed_selector(ps) for ps in parsed_selectors]
+            except SelectorError as err:
+                self.errors.append((text, err))
+                continue
+            fl = self.pseudo_pat.search(text)
+            if fl is not None:
+                self.pseudo_classes[i] = fl.group(1)
+            for parsed_selector, matcher in zip(parsed_selectors, matchers):
+                self.entries.append((i, matcher) + index_keys(parsed_selector))
+
+    def buckets_for(self, select):
+        ''' Bucket the rules that could match something in the tree of select '''
+        present = {'id': select.id_map, 'class': select.class_map, 'tag': select.element_map}
+        buckets = {'id': defaultdict(list), 'class': defaultdict(list), 'tag': defaultdict(list), None: []}
+        for i, matcher, key, required in self.entries:
+            for kind, name in required:
+                if not present[kind].get(name):
+                    break
+            else:
+                bucket = buckets[None] if key is None else buckets[key[0]][key[1]]
+                bucket.append((i, matcher))
+        return buckets
+
+    @staticmethod
+    def matching_rules(elem, select, buckets):
+        ''' The numbers of the rules that match elem, in rule order '''
+        candidates = list(buckets[None])
+        candidates.extend(buckets['tag'].get(select.map_tag_name(elem.tag), ()))
+        elem_id = elem.get('id')
+        if elem_id is not None:
+            candidates.extend(buckets['id'].get(ascii_lower(elem_id), ()))
+        classes = elem.get('class')
+        if classes:
+            by_class = buckets['class']
+            for cls in set(map(ascii_lower, classes.split())):
+                candidates.extend(by_class.get(cls, ()))
+        candidates.sort(key=itemgetter(0))
+        last = -1
+        for i, matcher in candidates:
+            if i != last and matcher(select, elem):
+                last = i
+                yield i
+
+
+class FlattenedSheet:
+
+    def __init__(self):
+        self.rules = []
+        self.page_rules = []
+        self.font_face_rules = []
+        self.num_rules = 0
+
+
 class StylizerRules:
 
-    def __init__(self, opts, profile, stylesheets):
+    def __init__(self, opts, profile, stylesheets, others=()):
         self.opts, self.profile, self.stylesheets = opts, profile, stylesheets
+        self.rule_index = None
+        # Flattening large stylesheets is slow, so re-use the flattened
+        # sheets from other rules with the same opts and profile
+        self.flattened_sheets = {}
+        sheet_ids = set(map(id, stylesheets))
+        for other in others:
+            if other.opts == opts and other.profile == profile:
+                for sheet_id, fs in other.flattened_sheets.items():
+                    if sheet_id in sheet_ids:
+                        self.flattened_sheets[sheet_id] = fs
 
         index = 0
         self.rules = []
         self.page_rule = {}
         self.font_face_rules = []
         for sheet_index, stylesheet in enumerate(stylesheets):
-            href = stylesheet.href
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            self.rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    self.rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
+            fs = self.flattened_sheets.get(id(stylesheet))
+            if fs is None:
+                fs = self.flattened_sheets[id(stylesheet)] = self.flatten_sheet(stylesheet)
+            sheet_flag = (0 if sheet_index == 0 else 1,)
+            for specificity, sheet_rule_index, selector, style, text, href in fs.rules:
+                self.rules.append((sheet_flag + specificity + (index + sheet_rule_index,), selector, style, text, href))
+            for style in fs.page_rules:
+                self.page_rule.update(style)
+            self.font_face_rules.extend(fs.font_face_rules)
+            index += fs.num_rules
         self.rules.sort(key=itemgetter(0))  # sort by specificity
 
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
-        results = []
-        sheet_index = 0 if is_user_agent_sheet else 1
+    def flatten_sheet(self, stylesheet):
+        fs = FlattenedSheet()
+        href = stylesheet.href
+        for rule in stylesheet.cssRules:
+            if rule.type == rule.MEDIA_RULE:
+                if media_ok(rule.media.mediaText):
+                    for subrule in rule.cssRules:
+                        self.flatten_rule(subrule, href, fs)
+                        fs.num_rules += 1
+            else:
+                self.flatten_rule(rule, href, fs)
+                fs.num_rules += 1
+        return fs
+
+    def flatten_rule(self, rule, href, fs):
         if isinstance(rule, CSSStyleRule):
             style = self.flatten_style(rule.style)
             for selector in rule.selectorList:
-                specificity = (sheet_index,) + selector.specificity + (index,)
                 text = selector.selectorText
-                selector = list(selector.seq)
-                results.append((specificity, selector, style, text, href))
+                fs.rules.append((selector.specificity, fs.num_rules, list(selector.seq), style, text, href))
         elif isinstance(rule, CSSPageRule):
-            style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
+            fs.page_rules.append(self.flatten_style(rule.style))
         elif isinstance(rule, CSSFontFaceRule):
             if rule.style.length > 1:
                 # Ignore the meaningless font face rules generated by the
                 # benighted MS Word that contain only a font-family declaration
                 # and nothing else
-                self.font_face_rules.append(rule)
-        return results
+                fs.font_face_rules.append(rule)
 
     def flatten_style(self, cssstyle):
         style = style_map()
@@ -190,6 +285,13 @@ def flatten_style(self, cssstyle):
                 style[x] = style.get(x, style['-epub-writing-mode'])
         return style
 
+    def index(self, select, logger):
+        if self.rule_index is None:
+            self.rule_index = RuleIndex(self.rules, select)
+            for text, err in self.rule_index.errors:
+                logger.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
+        return self.rule_index
+
     def _apply_text_align(self, text):
         if text in ('left', 'justify') and self.opts.change_justification in ('left', 'justify'):
             text = self.opts.change_justification
@@ -211,6 +313,7 @@ def same_rules(self, opts, profile, stylesheets):
 
 class Stylizer:
     STYLESHEETS = WeakKeyDictionary()
+    RULES_CACHE_SIZE = 8
 
     def __init__(self, tree, path, oeb, opts, profile=None,
             extra_css='', user_css='', base_css=''):
@@ -311,61 +414,75 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                     self.logger.debug('Bad css: ')
                     self.logger.debug(x)
 
-        # using oeb to store the rules, page rule and font face rules
-        # and generating them again if opts, profile or stylesheets are different
-        if (not hasattr(self.oeb, 'stylizer_rules')) \
-            or not self.oeb.stylizer_rules.same_rules(self.opts, self.profile, stylesheets):
-            self.oeb.stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets)
-        self.rules = self.oeb.stylizer_rules.rules
-        self.page_rule = self.oeb.stylizer_rules.page_rule
-        self.font_face_rules = self.oeb.stylizer_rules.font_face_rules
-        self.flatten_style = self.oeb.stylizer_rules.flatten_style
+        # using oeb to store the rules, page rule and font face rules, so
+        # that they, and their index, are re-used for all items that have
+        # the same opts, profile and stylesheets
+        rules_cache = getattr(self.oeb, 'stylizer_rules_cache', None)
+        if rules_cache is None:
+            rules_cache = self.oeb.stylizer_rules_cache = []
+        for stylizer_rules in rules_cache:
+            if stylizer_rules.same_rules(self.opts, self.profile, stylesheets):
+                rules_cache.remove(stylizer_rules)
+                break
+        else:
+            stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets, rules_cache)
+            if len(rules_cache) >= self.RULES_CACHE_SIZE:
+                del rules_cache[0]
+        rules_cache.append(stylizer_rules)
+        self.rules = stylizer_rules.rules
+        self.page_rule = stylizer_rules.page_rule
+        self.font_face_rules = stylizer_rules.font_face_rules
+        self.flatten_style = stylizer_rules.flatten_style
 
         self._styles = {}
-        pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
-
-        for _, _, cssdict, text, _ in self.rules:
-            fl = pseudo_pat.search(text)
-            try:
-                matches = tuple(select(text))
-            except SelectorError as err:
-                self.logger.error(f'Ignoring CSS rule with invalid selector: {text!r} ({as_unicode(err)})')
-                continue
-
-            if fl is not None:
-                fl = fl.group(1)
-                if fl == 'first-letter' and getattr(self.oeb,
-                        'plumber_output_format', '').lower() in {'mobi', 'docx'}:
-                    # Fake first-letter
-                    for elem in matches:
-                        for x in elem.iter('*'):
-                            if x.text:
-                                punctuation_chars = []
-                                text = str(x.text)
-                                while text:
-                                    category = unicodedata.category(text[0])
-                                    if category[0] not in {'P', 'Z'}:
-                                        break
-                                    punctuation_chars.append(text[0])
-                                    text = text[1:]
-
-                                special_text = ''.join(punctuation_chars) + \
-                                        (text[0] if text else '')
-                                span = x.makeelement(f'{{{XHTML_NS}}}span')
-                                span.text = special_text
-                                span.set('data-fake-first-letter', '1')
-                                span.tail = text[1:]
-                                x.text = None
-                                x.insert(0, span)
-                                self.style(span)._update_cssdict(cssdict)
-                                break
-                else:  # Element pseudo-class
-                    for elem in matches:
-                        self.style(elem)._update_pseudo_class(fl, cssdict)
-            else:
-                for elem in matches:
+        rule_index = stylizer_rules.index(select, self.logger)
+        buckets = rule_index.buckets_for(select)
+        fake_first_letter = getattr(self.oeb, 'plumber_output_format', '').lower() in {'mobi', 'docx'}
+        first_letters = []
+
+        for elem in tuple(select.itertag()):
+            for i in rule_index.matching_rules(elem, select, buckets):
+                cssdict = self.rules[i][2]
+                fl = rule_index.pseudo_classes.get(i)
+                if fl is None:
                     self.style(elem)._update_cssdict(cssdict)
+                elif fl == 'first-letter' and fake_first_letter:
+                    first_letters.append((i, len(first_letters), elem))
+                else:  # Element pseudo-class
+                    self.style(elem)._update_pseudo_class(fl, cssdict)
+
+        # Fake first-letter, done after matching so that the inserted
+        # spans do not change which rules match, in rule order
+        first_letters.sort(key=itemgetter(0, 1))
+        for i, _, elem in first_letters:
+            cssdict = self.rules[i][2]
+            for x in elem.iter('*'):
+                if x.text:
+                    if x.get('data-fake-first-letter') is not None:
+                        # The first letter was already wrapped, by an
+                        # earlier rule or an earlier run of the Stylizer
+                        self.style(x)._update_cssdict(cssdict)
+                        break
+                    punctuation_chars = []
+                    text = str(x.text)
+                    while text:
+                        category = unicodedata.category(text[0])
+                        if category[0] not in {'P', 'Z'}:
+                            break
+                        punctuation_chars.append(text[0])
+                        text = text[1:]
+
+                    special_text = ''.join(punctuation_chars) + \
+                            (text[0] if text else '')
+                    span = x.makeelement(f'{{{XHTML_NS}}}span')
+                    span.text = special_text
+                    span.set('data-fake-first-letter', '1')
+                    span.tail = text[1:]
+                    x.text = None
+                    x.insert(0, span)
+                    self.style(span)._update_cssdict(cssdict)
+                    break
         for elem in xpath(tree, '//h:*[@style]'):
             self.style(elem)._apply_style_attr(url_replacer=item.abshref)
         num_pat = re.compile(r'[0-9.]+$')
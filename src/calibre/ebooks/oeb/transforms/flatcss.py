@@ -10,6 +10,7 @@
 import numbers
 import operator
 import re
+import uuid
 from collections import defaultdict
 from xml.dom import SyntaxErr
 
@@ -22,7 +23,9 @@
 from calibre.ebooks.oeb.base import CSS_MIME, OEB_STYLES, SVG, SVG_NS, XHTML, XHTML_NS, XPath, barename, css_text, namespace
 from calibre.ebooks.oeb.stylizer import Stylizer
 from calibre.utils.filenames import ascii_filename, ascii_text
+from calibre.utils.forked_map import forked_map, forked_map_is_supported
 from calibre.utils.icu import numeric_sort_key
+from calibre.utils.xml_parse import safe_xml_fromstring
 from polyglot.builtins import iteritems, string_or_bytes
 
 COLLAPSE = re.compile(r'[ \t\r\n\v]+')
@@ -133,12 +136,24 @@ def __call__(self, oeb):
         return self.href
 
 
+class FlattenedStyles:
+
+    ''' The parts of a Stylizer that are used after flattening, for items
+    that were flattened in a worker process. '''
+
+    def __init__(self, profile, page_rule, font_face_rules, body_font_size):
+        self.profile, self.page_rule, self.body_font_size = profile, page_rule, body_font_size
+        self.font_face_rules = [css_parser.parseString(r, validate=False).cssRules[0] for r in font_face_rules]
+
+
 class CSSFlattener:
 
     def __init__(self, fbase=None, fkey=None, lineh=None, unfloat=False,
                  untable=False, page_break_on_body=False, specializer=None,
-                 transform_css_rules=()):
+                 transform_css_rules=(), num_workers=0):
         self.fbase = fbase
+        self.num_workers = num_workers
+        self.local_classes = None
         self.transform_css_rules = transform_css_rules
         if self.transform_css_rules:
             from calibre.ebooks.css_transform_rules import compile_rules
@@ -199,10 +214,14 @@ def __call__(self, oeb, context):
         # like the AZW3 output inline ToC.
         self.oeb.store_embed_font_rules = EmbedFontsCSSRules(self.body_font_family,
                 self.embed_font_rules)
-        self.stylize_spine()
-        self.sbase = self.baseline_spine() if self.fbase else None
-        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
-        self.flatten_spine()
+        num_workers = min(self.num_workers, len(self.items))
+        if num_workers > 1 and forked_map_is_supported:
+            self.flatten_spine_in_workers(num_workers)
+        else:
+            self.stylize_spine()
+            self.sbase = self.baseline_spine() if self.fbase else None
+            self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+            self.flatten_spine()
         if epub3_nav is not None:
             self.opts.epub3_nav_parsed = epub3_nav.data
 
@@ -282,34 +301,36 @@ def get_embed_font_info(self, family, failure_critical=True):
 
     def stylize_spine(self):
         self.stylizers = {}
-        profile = self.context.source
-        css = ''
         for item in self.items:
-            html = item.data
-            body = html.find(XHTML('body'))
-            if 'style' in html.attrib:
-                b = body.attrib.get('style', '')
-                body.set('style', html.get('style') + ';' + b)
-                del html.attrib['style']
-            bs = body.get('style', '').split(';')
-            bs.append('margin-top: 0pt')
-            bs.append('margin-bottom: 0pt')
-            if float(self.context.margin_left) >= 0:
-                bs.append(f'margin-left : {float(self.context.margin_left):g}pt')
-            if float(self.context.margin_right) >= 0:
-                bs.append(f'margin-right : {float(self.context.margin_right):g}pt')
-            bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
-            if self.page_break_on_body:
-                bs.extend(['page-break-before: always'])
-            if self.context.change_justification != 'original':
-                bs.append('text-align: '+ self.context.change_justification)
-            if self.body_font_family:
-                bs.append('font-family: '+self.body_font_family)
-            body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+            self.set_body_style(item)
+            self.stylizers[item] = self.stylize_item(item)
+
+    def set_body_style(self, item):
+        html = item.data
+        body = html.find(XHTML('body'))
+        if 'style' in html.attrib:
+            b = body.attrib.get('style', '')
+            body.set('style', html.get('style') + ';' + b)
+            del html.attrib['style']
+        bs = body.get('style', '').split(';')
+        bs.append('margin-top: 0pt')
+        bs.append('margin-bottom: 0pt')
+        if float(self.context.margin_left) >= 0:
+            bs.append(f'margin-left : {float(self.context.margin_left):g}pt')
+        if float(self.context.margin_right) >= 0:
+            bs.append(f'margin-right : {float(self.context.margin_right):g}pt')
+        bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
+        if self.page_break_on_body:
+            bs.extend(['page-break-before: always'])
+        if self.context.change_justification != 'original':
+            bs.append('text-align: '+ self.context.change_justification)
+        if self.body_font_family:
+            bs.append('font-family: '+self.body_font_family)
+        body.set('style', '; '.join(bs))
+
+    def stylize_item(self, item):
+        return Stylizer(item.data, item.href, self.oeb, self.context, self.context.source,
+                user_css=self.context.extra_css, extra_css='')
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
@@ -320,14 +341,18 @@ def baseline_node(self, node, stylizer, sizes, csize):
             if child.tail:
                 sizes[csize] += len(COLLAPSE.sub(' ', child.tail))
 
+    def baseline_item(self, item, stylizer, sizes):
+        body = item.data.find(XHTML('body'))
+        fsize = self.context.source.fbase
+        self.baseline_node(body, stylizer, sizes, fsize)
+
     def baseline_spine(self):
         sizes = defaultdict(float)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            body = html.find(XHTML('body'))
-            fsize = self.context.source.fbase
-            self.baseline_node(body, stylizer, sizes, fsize)
+            self.baseline_item(item, self.stylizers[item], sizes)
+        return self.sbase_from_sizes(sizes)
+
+    def sbase_from_sizes(self, sizes):
         try:
             sbase = max(list(sizes.items()), key=operator.itemgetter(1))[0]
         except Exception:
@@ -535,7 +560,9 @@ def force_int(raw):
 
         pseudo_classes = style.pseudo_classes(self.filter_css)
         if cssdict or pseudo_classes:
-            keep_classes = set()
+            # A list, so that the order of the classes is the same in worker
+            # processes, where the names are placeholders
+            keep_classes = []
 
             if cssdict:
                 items = sorted(iteritems(cssdict))
@@ -546,33 +573,22 @@ def force_int(raw):
                 # name with different case, both cases will apply, leading
                 # to incorrect results.
                 klass = ascii_text(STRIPNUM.sub('', classes_list[0])).lower().strip().replace(' ', '_')
-                if css in styles:
-                    match = styles[css]
-                else:
-                    match = klass + str(names[klass] or '')
-                    styles[css] = match
-                    names[klass] += 1
+                match = self.class_for_css(names, styles, klass, css)
                 node.attrib['class'] = match
-                keep_classes.add(match)
+                keep_classes.append(match)
 
             for psel, cssdict in iteritems(pseudo_classes):
                 items = sorted(iteritems(cssdict))
                 css = ';\n'.join(f'{key}: {val}' for key, val in items)
-                pstyles = pseudo_styles[psel]
-                if css in pstyles:
-                    match = pstyles[css]
-                else:
-                    # We have to use a different class for each psel as
-                    # otherwise you can have incorrect styles for a situation
-                    # like: a:hover { color: red } a:link { color: blue } a.x:hover { color: green }
-                    # If the pcalibre class for a:hover and a:link is the same,
-                    # then the class attribute for a.x tags will contain both
-                    # that class and the class for a.x:hover, which is wrong.
-                    klass = 'pcalibre'
-                    match = klass + str(names[klass] or '')
-                    pstyles[css] = match
-                    names[klass] += 1
-                keep_classes.add(match)
+                # We have to use a different class for each psel as
+                # otherwise you can have incorrect styles for a situation
+                # like: a:hover { color: red } a:link { color: blue } a.x:hover { color: green }
+                # If the pcalibre class for a:hover and a:link is the same,
+                # then the class attribute for a.x tags will contain both
+                # that class and the class for a.x:hover, which is wrong.
+                match = self.class_for_css(names, pseudo_styles[psel], 'pcalibre', css, psel)
+                if match not in keep_classes:
+                    keep_classes.append(match)
                 node.attrib['class'] = ' '.join(keep_classes)
 
         elif 'class' in node.attrib:
@@ -583,6 +599,20 @@ def force_int(raw):
             for child in node:
                 self.flatten_node(child, stylizer, names, styles, pseudo_styles, psize, item_id)
 
+    def class_for_css(self, names, styles, klass, css, psel=None):
+        if css in styles:
+            return styles[css]
+        if self.local_classes is None:
+            match = klass + str(names[klass] or '')
+            names[klass] += 1
+        else:
+            # In a worker process, use a placeholder name that is replaced
+            # by the final class name when the results are merged
+            match = f'{self.local_class_prefix}{len(self.local_classes)}'
+            self.local_classes.append((psel, klass, css, match))
+        styles[css] = match
+        return match
+
     def flatten_head(self, item, href, global_href):
         html = item.data
         head = html.find(XHTML('head'))
@@ -680,17 +710,67 @@ def unique_font_face_rules(*rules):
                 ans[item] = gc_map[css]
         return ans
 
+    def flatten_item(self, item, stylizer, names, styles, pseudo_styles):
+        html = item.data
+        if self.specializer is not None:
+            self.specializer(item, stylizer)
+        fsize = self.context.dest.fbase
+        self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
+        self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+
     def flatten_spine(self):
         names = defaultdict(int)
         styles, pseudo_styles = {}, defaultdict(dict)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            if self.specializer is not None:
-                self.specializer(item, stylizer)
-            fsize = self.context.dest.fbase
-            self.flatten_node(html, stylizer, names, styles, pseudo_styles, fsize, item.id, recurse=False)
-            self.flatten_node(html.find(XHTML('body')), stylizer, names, styles, pseudo_styles, fsize, item.id)
+            self.flatten_item(item, self.stylizers[item], names, styles, pseudo_styles)
+        self.write_flattened_css(names, styles, pseudo_styles)
+
+    def font_sizes_in_worker(self, item):
+        sizes = defaultdict(float)
+        self.baseline_item(item, self.stylize_item(item), sizes)
+        return tuple(sizes.items())
+
+    def flatten_item_in_worker(self, item):
+        stylizer = self.stylize_item(item)
+        self.local_classes = []
+        self.flatten_item(item, stylizer, defaultdict(int), {}, defaultdict(dict))
+        return (etree.tostring(item.data, encoding='utf-8'), self.local_classes, dict(stylizer.page_rule),
+                [css_text(r) for r in stylizer.font_face_rules], stylizer.body_font_size)
+
+    def flatten_spine_in_workers(self, num_workers):
+        # Stylizers cannot be sent between processes, so the workers create
+        # them twice, once to find the base font size of the whole book and
+        # once to flatten. Class names are assigned by replaying the new
+        # styles from each item in spine order, giving the same names as
+        # flatten_spine().
+        for item in self.items:
+            self.set_body_style(item)
+        sizes = defaultdict(float)
+        if self.fbase:
+            for item_sizes in forked_map(self.font_sizes_in_worker, self.items, num_workers=num_workers):
+                for size, count in item_sizes:
+                    sizes[size] += count
+        self.sbase = self.sbase_from_sizes(sizes) if self.fbase else None
+        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+
+        self.local_class_prefix = f'calibre-flatten-{uuid.uuid4().hex}-'
+        pat = re.compile(re.escape(self.local_class_prefix.encode()) + rb'\d+')
+        names = defaultdict(int)
+        styles, pseudo_styles = {}, defaultdict(dict)
+        self.stylizers = {}
+        results = forked_map(self.flatten_item_in_worker, self.items, num_workers=num_workers)
+        for item, (raw, local_classes, page_rule, font_face_rules, body_font_size) in zip(self.items, results):
+            class_map = {}
+            for psel, klass, css, local_name in local_classes:
+                class_map[local_name.encode()] = self.class_for_css(
+                    names, styles if psel is None else pseudo_styles[psel], klass, css, psel).encode()
+            if class_map:
+                raw = pat.sub(lambda m: class_map[m.group()], raw)
+            item.data = safe_xml_fromstring(raw)
+            self.stylizers[item] = FlattenedStyles(self.context.source, page_rule, font_face_rules, body_font_size)
+        self.write_flattened_css(names, styles, pseudo_styles)
+
+    def write_flattened_css(self, names, styles, pseudo_styles):
         items = sorted(((key, val) for (val, key) in iteritems(styles)), key=lambda x: numeric_sort_key(x[0]))
         # :hover must come after link and :active must come after :hover
         psels = sorted(pseudo_styles, key=lambda x:
@@ -707,5 +787,44 @@ def flatten_spine(self):
         href = self.replace_css(css)
         global_css = self.collect_global_css()
         for item in self.items:
-            stylizer = self.stylizers[item]
             self.flatten_head(item, href, global_css[item])
+
+
+def find_tests():
+    import unittest
+
+    from calibre.ebooks.conversion.plumber import create_dummy_plumber, create_oebbook
+
+    class TestFlattenInWorkers(unittest.TestCase):
+
+        def flatten(self, num_workers):
+            plumber = create_dummy_plumber('html', 'epub')
+            plumber.setup_options()
+            opts = plumber.opts
+            opts.source, opts.dest = opts.input_profile, opts.output_profile
+            # Keep the @page rules of the files, so that they differ
+            opts.margin_top = -1
+            oeb = create_oebbook(plumber.log, None, opts, populate=False)
+            oeb.manifest.add('css', 'style.css', CSS_MIME, data=(
+                '@page { margin: 1em }\n'
+                '@font-face { font-family: X; src: url(x.ttf) }\n'
+                'p { font-size: 1.2em; text-indent: 1em } .b { font-weight: bold }\n'
+                'a:hover { color: red } h1 { font-size: 2em; page-break-before: always }'))
+            for i in range(5):
+                style = '<style>@page { margin-top: 2em }</style>' if i % 2 else ''
+                oeb.spine.add(oeb.manifest.add(f'f{i}', f'f{i}.html', 'application/xhtml+xml', data=(
+                    f'<html xmlns="{XHTML_NS}"><head><link rel="stylesheet" href="style.css"/>{style}</head><body>'
+                    f'<h1>Chapter {i}</h1><p class="b">Some <a href="#x">text</a> {i}</p>'
+                    f'<p style="font-size: {10 + i}pt; color: blue">More <span style="font-style: italic">text</span></p>'
+                    '</body></html>')))
+            CSSFlattener(fbase=opts.dest.fbase, fkey=opts.dest.fkey, num_workers=num_workers)(oeb, opts)
+            return {item.href: css_text(item.data) if item.media_type in OEB_STYLES else etree.tostring(item.data)
+                    for item in oeb.manifest.values()}
+
+        @unittest.skipUnless(forked_map_is_supported, 'forking not supported on this platform')
+        def test_flatten_spine_in_workers(self):
+            serial = self.flatten(0)
+            self.assertIn('page_styles1.css', serial)
+            self.assertEqual(serial, self.flatten(3))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestFlattenInWorkers)
@@ -5,7 +5,33 @@
 __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import hashlib
+import time
+from functools import partial
+
 from calibre import fit_image
+from calibre.utils.forked_map import forked_map, forked_map_is_supported
+from calibre.utils.logging import Log, Stream
+
+
+class RecordingStream(Stream):
+
+    def __init__(self):
+        Stream.__init__(self)
+        self.records = []
+
+    def prints(self, level, *args, **kwargs):
+        self.records.append((level, args, kwargs))
+
+
+# The maximum amount of image data sent to the worker processes at a time, the
+# results for a batch are held in memory until they are all written back
+MAX_BATCH_SIZE = 64 * 1024 * 1024
+
+
+def read_image(path, *args):
+    with open(path, 'rb') as f:
+        return f.read()
 
 
 class RescaleImages:
@@ -19,10 +45,6 @@ def __call__(self, oeb, opts, max_size: str = 'profile'):
         self.rescale(max_size)
 
     def rescale(self, max_size: str = 'profile'):
-        from io import BytesIO
-
-        from PIL import Image
-
         is_image_collection = getattr(self.opts, 'is_image_collection', False)
 
         if is_image_collection:
@@ -49,48 +71,126 @@ def rescale(self, max_size: str = 'profile'):
                 page_height = no_scale_size
             if page_height <= 0:
                 page_height = no_scale_size
-        for item in self.oeb.manifest:
-            if item.media_type.startswith('image'):
-                ext = item.media_type.split('/')[-1].upper()
-                if ext == 'JPG':
-                    ext = 'JPEG'
-                if ext not in ('PNG', 'JPEG', 'GIF'):
-                    ext = 'JPEG'
-
-                raw = item.data
-                if hasattr(raw, 'xpath') or not raw:
-                    # Probably an svg image
-                    continue
-                try:
-                    img = Image.open(BytesIO(raw))
-                except Exception:
-                    continue
-                width, height = img.size
-
-                try:
-                    if self.check_colorspaces and img.mode == 'CMYK':
-                        self.log.warn(
-                            f'The image {item.href} is in the CMYK colorspace, converting it '
-                            'to RGB as Adobe Digital Editions cannot display CMYK')
-                        img = img.convert('RGB')
-                except Exception:
-                    self.log.exception(f'Failed to convert image {item.href} from CMYK to RGB')
-
-                scaled, new_width, new_height = fit_image(width, height, page_width, page_height)
-                if scaled:
-                    new_width = max(1, new_width)
-                    new_height = max(1, new_height)
-                    self.log(f'Rescaling image from {width}x{height} to {new_width}x{new_height}', item.href)
-                    try:
-                        img = img.resize((new_width, new_height))
-                    except Exception:
-                        self.log.exception(f'Failed to rescale image: {item.href}')
-                        continue
-                    buf = BytesIO()
-                    try:
-                        img.save(buf, ext)
-                    except Exception:
-                        self.log.exception(f'Failed to rescale image: {item.href}')
-                    else:
-                        item.data = buf.getvalue()
-                        item.unload_data_from_memory()
+        images = [item for item in self.oeb.manifest if item.media_type.startswith('image')]
+        num_workers = min(getattr(self.opts, 'parallel_workers', 0), len(images))
+        if num_workers < 2 or not forked_map_is_supported:
+            num_workers = 0
+        # Images with identical contents are processed only once. Every image
+        # is read only once, its data is hashed and then processed.
+        done, batch, size = {}, {}, 0
+        for item in images:
+            raw = item.uncached_data
+            if isinstance(raw, bytes):
+                key = item.media_type, hashlib.sha1(raw).digest()
+            else:
+                key = id(item)
+            if key in done:
+                self.set_duplicate_data(item, *done[key])
+            elif key in batch:
+                batch[key][2].append(item)
+            else:
+                rsz = len(raw) if isinstance(raw, bytes) else 0
+                if batch and size + rsz > MAX_BATCH_SIZE:
+                    self.process_batch(batch, done, page_width, page_height, num_workers)
+                    batch, size = {}, 0
+                batch[key] = item, raw, []
+                size += rsz
+                if not num_workers:
+                    self.process_batch(batch, done, page_width, page_height, num_workers)
+                    batch, size = {}, 0
+            del raw
+        if batch:
+            self.process_batch(batch, done, page_width, page_height, num_workers)
+
+    def process_batch(self, batch, done, page_width, page_height, num_workers):
+        if num_workers:
+            # The log messages from the workers are recorded and replayed in
+            # manifest order so that the output is the same as in serial mode
+            f = partial(self.rescale_image_in_worker, page_width=page_width, page_height=page_height)
+            results = forked_map(f, [(item, raw) for item, raw, duplicates in batch.values()], num_workers=min(num_workers, len(batch)))
+        else:
+            results = ((self.process_image(item, raw, page_width, page_height, self.log), ()) for item, raw, duplicates in batch.values())
+        for (key, (item, raw, duplicates)), (data, records) in zip(batch.items(), results):
+            for level, args, kwargs in records:
+                self.log.prints(level, *args, **kwargs)
+            path = self.set_data(item, data)
+            done[key] = item, path
+            for x in duplicates:
+                self.set_duplicate_data(x, item, path)
+
+    def set_data(self, item, data):
+        # The new image is kept in a file, that is shared with any identical
+        # images, instead of in memory. Returns the path to the file.
+        if data is None:
+            return None
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile(suffix='_rescaled.img') as pt:
+            pt.write(data)
+        self.oeb._temp_files.append(pt.name)
+        item.release_data(partial(read_image, pt.name))
+        return pt.name
+
+    def set_duplicate_data(self, item, original, path):
+        self.log.debug(f'The image {item.href} is identical to {original.href}, re-using its result')
+        if path is not None:
+            item.release_data(partial(read_image, path))
+
+    def process_image(self, item, raw, page_width, page_height, log):
+        st = time.monotonic()
+        ans = self.rescale_image(item, raw, page_width, page_height, log)
+        log.debug(f'Processed the image {item.href} in {time.monotonic() - st:.3f} seconds' + (
+            '' if ans is None else f', the new image is {len(ans)} bytes'))
+        return ans
+
+    def rescale_image_in_worker(self, job, page_width, page_height):
+        item, raw = job
+        log = Log(level=Log.DEBUG)
+        log.outputs = [RecordingStream()]
+        return self.process_image(item, raw, page_width, page_height, log), log.outputs[0].records
+
+    def rescale_image(self, item, raw, page_width, page_height, log):
+        from io import BytesIO
+
+        from PIL import Image
+
+        ext = item.media_type.split('/')[-1].upper()
+        if ext == 'JPG':
+            ext = 'JPEG'
+        if ext not in ('PNG', 'JPEG', 'GIF'):
+            ext = 'JPEG'
+
+        if hasattr(raw, 'xpath') or not raw:
+            # Probably an svg image
+            return
+        try:
+            img = Image.open(BytesIO(raw))
+        except Exception:
+            return
+        width, height = img.size
+
+        try:
+            if self.check_colorspaces and img.mode == 'CMYK':
+                log.warn(
+                    f'The image {item.href} is in the CMYK colorspace, converting it '
+                    'to RGB as Adobe Digital Editions cannot display CMYK')
+                img = img.convert('RGB')
+        except Exception:
+            log.exception(f'Failed to convert image {item.href} from CMYK to RGB')
+
+        scaled, new_width, new_height = fit_image(width, height, page_width, page_height)
+        if scaled:
+            new_width = max(1, new_width)
+            new_height = max(1, new_height)
+            log(f'Rescaling image from {width}x{height} to {new_width}x{new_height}', item.href)
+            try:
+                img = img.resize((new_width, new_height))
+            except Exception:
+                log.exception(f'Failed to rescale image: {item.href}')
+                return
+            buf = BytesIO()
+            try:
+                img.save(buf, ext)
+            except Exception:
+                log.exception(f'Failed to rescale image: {item.href}')
+            else:
+                return buf.getvalue()
@@ -22,21 +22,100 @@
 
 from calibre import as_unicode, force_unicode
 from calibre.ebooks.epub import rules
-from calibre.ebooks.oeb.base import OEB_STYLES, XHTML, rewrite_links, urldefrag, urlnormalize
+from calibre.ebooks.oeb.base import OEB_RASTER_IMAGES, OEB_STYLES, XHTML, barename, rewrite_links, urldefrag, urlnormalize
 from calibre.ebooks.oeb.base import XPNSMAP as NAMESPACES
-from calibre.ebooks.oeb.polish.split import do_split
+from calibre.ebooks.oeb.polish.split import adjust_split_point, do_split, get_body
 from polyglot.builtins import iteritems
 from polyglot.urllib import unquote
 
 XPath = functools.partial(_XPath, namespaces=NAMESPACES)
 
-SPLIT_POINT_ATTR = 'csp'
+MIN_SPLIT_SIZE = 5 * 1024
 
 
 def tostring(root):
     return etree.tostring(root, encoding='utf-8')
 
 
+def escaped_size(text, in_attribute=False):
+    if not text:
+        return 0
+    ans = len(text.encode('utf-8')) + 4 * text.count('&') + 3 * (text.count('<') + text.count('>'))
+    if in_attribute:
+        ans += 5 * text.count('"')
+    return ans
+
+
+def serialized_offsets(body):
+    '''
+    Return a map of every element in body to the approximate offset at which
+    it starts when body is serialized, along with the approximate serialized
+    size of body. Computed in a single pass, so that split points can be chosen
+    without serializing sub-trees repeatedly.
+    '''
+    offsets, pos = {}, 0
+    for event, elem in etree.iterwalk(body, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            offsets[elem] = pos
+            if isinstance(tag, str):
+                pos += len(barename(tag)) + 2 + sum(
+                    len(barename(k)) + 4 + escaped_size(v, True) for k, v in elem.items())
+            else:
+                pos += 4  # comments and processing instructions
+            pos += escaped_size(elem.text)
+        else:
+            pos += (len(barename(tag)) + 3 if isinstance(tag, str) else 3) + escaped_size(elem.tail)
+    return offsets, pos
+
+
+SPLIT_PRIORITIES = {XHTML(f'h{i}'): 0 for i in range(1, 7)}
+SPLIT_PRIORITIES.update({XHTML(tag): i for i, tag in enumerate(('pre', 'hr', 'p', 'div', 'br', 'li'), start=2)})
+
+
+def split_priority(elem, body):
+    if elem.tag == XHTML('div') and elem.getparent() is body:
+        return 1
+    return SPLIT_PRIORITIES.get(elem.tag)
+
+
+def split_after(split_point):
+    '''
+    Move ``split_point`` and everything after it into a new tree, leaving the
+    content before it in the original tree. The result is the same as the after
+    tree from :func:`do_split`, but only the moved content is touched, so
+    splitting a tree into many parts takes linear time.
+
+    :return: The new tree
+    '''
+    root = split_point.getroottree().getroot()
+    body = get_body(root)
+    ancestors = tuple(split_point.iterancestors())[::-1]
+    nroot = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+    nroot.text = root.text
+    for child in root.iterchildren():
+        if child is body:
+            parent = nroot.makeelement(body.tag, attrib=dict(body.attrib))
+            parent.tail = body.tail
+            nroot.append(parent)
+        else:
+            nroot.append(copy.deepcopy(child))
+    # Preserve the ancestors of the split point as they could have CSS styles
+    # that are inherited, but not their text
+    for ancestor in ancestors[ancestors.index(body)+1:]:
+        shell = parent.makeelement(ancestor.tag, attrib=dict(ancestor.attrib))
+        shell.tail = ancestor.tail
+        parent.text = '\n'
+        parent.append(shell)
+        parent.extend(tuple(ancestor.itersiblings()))
+        parent = shell
+    parent.text = '\n'
+    siblings = tuple(split_point.itersiblings())
+    parent.append(split_point)
+    parent.extend(siblings)
+    return nroot.getroottree()
+
+
 class SplitError(ValueError):
 
     def __init__(self, path, root):
@@ -174,6 +253,9 @@ def fix_links(self):
         '''
         seen = set()
         for item in self.oeb.manifest:
+            if item.media_type in OEB_RASTER_IMAGES:
+                # Dont load images into memory just to check if they are markup
+                continue
             if etree.iselement(item.data):
                 self.current_item = item
                 rewrite_links(item.data, self.rewrite_links)
@@ -368,74 +450,101 @@ def split_to_size(self, tree):
                 i = p.index(pre)
                 p[i:i+1] = new_pres
 
-        split_point, before = self.find_split_point(root)
-        if split_point is None:
+        split_points = self.find_split_points(root)
+        if not split_points:
             raise SplitError(self.item.href, root)
-        self.log.debug('\t\t\tSplit point:', split_point.tag, tree.getpath(split_point))
-
-        trees = self.do_split(tree, split_point, before)
-        sizes = [len(tostring(t.getroot())) for t in trees]
-        if min(sizes) < 5*1024:
-            self.log.debug('\t\t\tSplit tree too small')
-            self.split_to_size(tree)
-            return
-
-        for t, size in zip(trees, sizes):
+        trees = [tree]
+        # Split from the end so that each split only moves the content after
+        # the split point, rather than copying the whole tree
+        for split_point in reversed(split_points):
+            self.log.debug('\t\t\tSplit point:', split_point.tag, tree.getpath(split_point))
+            trees.insert(1, split_after(split_point))
+
+        for t in trees:
             r = t.getroot()
             if self.is_page_empty(r):
                 continue
-            elif size <= self.max_flow_size:
+            size = len(tostring(r))
+            if size <= self.max_flow_size:
                 self.split_trees.append(t)
                 self.log.debug(
                     f'\t\t\tCommitted sub-tree #{len(self.split_trees)} ({size/1024.0} KB)')
             else:
                 self.log.debug(
                         f'\t\t\tSplit tree still too large: {size/1024.0} KB')
+                if len(trees) < 2:
+                    raise SplitError(self.item.href, r)
                 self.split_to_size(t)
 
-    def find_split_point(self, root):
+    def find_split_points(self, root):
         '''
-        Find the tag at which to split the tree rooted at `root`.
-        Search order is:
+        Find the tags at which to split the tree rooted at `root`, so that every
+        part is smaller than the maximum flow size. The tags are chosen in a
+        single pass over the tree, using serialized sizes estimated once per
+        tag. Within the range of tags at which a part can end, the preferred
+        tags are, in order:
             * Heading tags
-            * <div> tags
+            * <div> tags that are children of <body>
             * <pre> tags
             * <hr> tags
             * <p> tags
+            * <div> tags
             * <br> tags
             * <li> tags
-
-        We try to split in the "middle" of the file (as defined by tag counts.
         '''
-        def pick_elem(elems):
-            if elems:
-                elems = [i for i in elems if i.get(SPLIT_POINT_ATTR, '0') !=
-                        '1']
-                if elems:
-                    i = int(len(elems)//2)
-                    elems[i].set(SPLIT_POINT_ATTR, '1')
-                    return elems[i]
-
-        for path in (
-                     '//*[re:match(name(), "h[1-6]", "i")]',
-                     '/h:html/h:body/h:div',
-                     '//h:pre',
-                     '//h:hr',
-                     '//h:p',
-                     '//h:div',
-                     '//h:br',
-                     '//h:li',
-                     ):
-            elems = root.xpath(path, namespaces=NAMESPACES)
-            elem = pick_elem(elems)
-            if elem is not None:
-                try:
-                    XPath(elem.getroottree().getpath(elem))
-                except Exception:
-                    continue
-                return elem, True
-
-        return None, True
+        body = self.get_body(root)
+        if body is None:
+            return []
+        offsets, body_size = serialized_offsets(body)
+        overhead = sum(len(tostring(x)) for x in root.iterchildren() if x is not body) + 256
+        # Correct for the approximations in the estimated sizes
+        scale = max(1, len(tostring(root)) - overhead) / max(1, body_size)
+        max_size = self.max_flow_size
+
+        def part_size(offset):
+            return overhead + (offset - start) * scale
+
+        ans, candidates, start = [], [], 0
+
+        def pick():
+            nonlocal start, candidates
+            best = best_small = None
+            for i, (offset, priority, elem) in enumerate(candidates):
+                size = part_size(offset)
+                if size > max_size:
+                    break
+                if size < MIN_SPLIT_SIZE or overhead + (body_size - offset) * scale < MIN_SPLIT_SIZE:
+                    best_small = i
+                elif best is None or priority <= candidates[best][1]:
+                    best = i
+            if best is None:
+                # No tag at which to end a part of reasonable size, so accept a
+                # small or an over-sized part, over-sized parts are split again
+                # if possible
+                best = 0 if best_small is None else best_small
+            start, elem = candidates[best][0], candidates[best][2]
+            candidates = candidates[best+1:]
+            ans.append(elem)
+
+        for elem in body.iterdescendants(etree.Element):
+            priority = split_priority(elem, body)
+            if priority is None:
+                continue
+            offset = offsets[elem]
+            while candidates and part_size(offset) > max_size:
+                pick()
+            candidates.append((offset, priority, elem))
+        while candidates and part_size(body_size) > max_size:
+            pick()
+
+        # Splitting before the first child of body would leave an empty part
+        content_start = offsets[body[0]] if len(body) else body_size
+        split_points = []
+        for elem in ans:
+            elem = adjust_split_point(elem, self.log)
+            if offsets[elem] > content_start and (not split_points or split_points[-1] is not elem):
+                split_points.append(elem)
+        return split_points
 
     def commit(self):
         '''
@@ -455,8 +564,6 @@ def commit(self):
                 for anchor in elem.get('id', ''), elem.get('name', ''):
                     if anchor != '' and anchor not in self.anchor_map:
                         self.anchor_map[anchor] = self.files[-1]
-            for elem in root.xpath(f'//*[@{SPLIT_POINT_ATTR}]'):
-                elem.attrib.pop(SPLIT_POINT_ATTR, '0')
 
         spine_pos = self.item.spine_position
 
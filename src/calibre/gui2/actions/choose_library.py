@@ -213,6 +213,7 @@ def __init__(self, gui):
         b.setIcon(QIcon.ic('lt.png'))
         l.addWidget(bb)
         self.db = weakref.ref(gui.current_db)
+        self.model = weakref.ref(gui.library_view.model())
         self.setResult(9)
         self.setWindowTitle(_('Backup status'))
         self.update()
@@ -229,8 +230,11 @@ def update(self):
             dirty_text = f'{db.dirty_queue_length()}'
         except Exception:
             dirty_text = _('none')
-        self.msg.setText('<p>' + _(
-            'Book metadata files remaining to be written: %s') % dirty_text)
+        msg = '<p>' + _('Book metadata files remaining to be written: %s') % dirty_text
+        mb = getattr(self.model(), 'metadata_backup', None)
+        if mb is not None and mb.drain_rate:
+            msg += '<p>' + _('Files being written per second: {:.1f}').format(mb.drain_rate)
+        self.msg.setText(msg)
         QTimer.singleShot(1000, self.update)
 
     def mark_all_dirty(self):
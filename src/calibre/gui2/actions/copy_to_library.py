@@ -35,7 +35,7 @@
 
 from calibre import as_unicode
 from calibre.constants import ismacos
-from calibre.db.copy_to_library import copy_one_book
+from calibre.db.copy_to_library import copy_books
 from calibre.gui2 import Dispatcher, choose_dir, error_dialog, gprefs, info_dialog, warning_dialog
 from calibre.gui2.actions import InterfaceAction
 from calibre.gui2.actions.choose_library import library_qicon
@@ -163,38 +163,30 @@ def doit(self):
         from calibre.gui2.ui import get_gui
         library_broker = get_gui().library_broker
         newdb = library_broker.get_library(self.loc)
-        self.find_identical_books_data = None
         try:
-            if self.check_for_duplicates:
-                self.find_identical_books_data = newdb.new_api.data_for_find_identical_books()
             self._doit(newdb)
         finally:
             library_broker.prune_loaded_dbs()
 
     def _doit(self, newdb):
-        for i, x in enumerate(self.ids):
-            if self.was_canceled:
-                self.left_after_cancel = len(self.ids) - i
-                break
-            try:
-                self.do_one(i, x, newdb)
-            except Exception as err:
-                import traceback
-                err = as_unicode(err)
-                self.failed_books[x] = (err, as_unicode(traceback.format_exc()))
-
-    def do_one(self, num, book_id, newdb):
         duplicate_action = 'add'
         if self.check_for_duplicates:
             duplicate_action = 'add_formats_to_existing' if prefs['add_formats_to_existing'] else 'ignore'
-        rdata = copy_one_book(
-                book_id, self.db, newdb,
-                preserve_date=gprefs['preserve_date_on_ctl'],
-                duplicate_action=duplicate_action, automerge_action=gprefs['automerge'],
-                identical_books_data=self.find_identical_books_data,
-                preserve_uuid=self.delete_after
+        copy_books(
+            self.ids, self.db, newdb,
+            preserve_date=gprefs['preserve_date_on_ctl'],
+            duplicate_action=duplicate_action, automerge_action=gprefs['automerge'],
+            preserve_uuid=self.delete_after, notify=self.book_copied, abort=lambda: self.was_canceled
         )
-        self.progress(num, rdata['title'])
+        if self.was_canceled:
+            self.left_after_cancel = len(self.ids) - len(self.processed) - len(self.failed_books)
+
+    def book_copied(self, rdata):
+        book_id = rdata['book_id']
+        if rdata['error'] is not None:
+            self.failed_books[book_id] = (as_unicode(rdata['error']), as_unicode(rdata['traceback']))
+            return
+        self.progress(len(self.processed) + len(self.failed_books), rdata['title'])
         if rdata['action'] == 'automerge':
             self.auto_merged_ids[book_id] = _('%(title)s by %(author)s') % dict(title=rdata['title'], author=rdata['author'])
         elif rdata['action'] == 'duplicate':
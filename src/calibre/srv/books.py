@@ -7,6 +7,7 @@
 import os
 import tempfile
 import time
+from collections import OrderedDict
 from functools import partial
 from hashlib import sha1
 from threading import Lock, RLock
@@ -15,12 +16,14 @@
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.metadata import authors_to_string
 from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.jobs import BACKGROUND, INTERACTIVE
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
-from calibre.utils.filenames import rmtree
+from calibre.utils.config import prefs
+from calibre.utils.filenames import atomic_rename, rmtree
 from calibre.utils.localization import _
 from calibre.utils.resources import get_path as P
 from calibre.utils.serialize import json_dumps
@@ -73,7 +76,7 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, priority=INTERACTIVE):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
@@ -84,31 +87,149 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
+    max_cache_size = int(ctx.opts.book_render_cache_size * 1024 * 1024)
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
-    queued_jobs[bhash] = job_id
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, max_cache_size),
+        priority=priority, use_warm_worker=True)
+    if job_id is None:
+        safe_remove(pathtoebook), safe_remove(tdir, False)
+    else:
+        queued_jobs[bhash] = job_id
     return job_id
 
 
-last_final_clean_time = 0
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for x in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, x))
+            except OSError:
+                pass
+    return ans
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
+class RenderCache:
+
+    ''' An index of the rendered books in the cache folder, ordered by last
+    access. Used to keep the cache within a size budget by removing the least
+    recently read books first. The index is stored in the cache folder along
+    with hit/miss counters. Must only be used with cache_lock held. '''
+
+    SAVE_INTERVAL = 60
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, base):
+        self.fdir = os.path.join(base, 'f')
+        self.index_path = os.path.join(base, 'index.json')
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.total_bytes = 0
+        self.last_saved = 0
+        self.load()
+
+    def load(self):
         try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
+            with open(self.index_path, 'rb') as f:
+                data = jsonlib.load(f)
+            self.hits, self.misses, entries = data['hits'], data['misses'], data['entries']
+        except Exception:
+            entries = {}
+        for bhash in os.listdir(self.fdir):
+            e = entries.get(bhash)
+            if e is None:
+                # Rendered before the index existed or by another server process
+                e = self.entry_from_disk(bhash)
+                if e is None:
+                    # Incomplete or invalidated render
+                    safe_remove(os.path.join(self.fdir, bhash), False)
+                    continue
+            entries[bhash] = e
+        for bhash, e in sorted(entries.items(), key=lambda x: x[1]['last_access']):
+            if os.path.isdir(os.path.join(self.fdir, bhash)):
+                self.entries[bhash] = e
+                self.total_bytes += e['size']
+
+    def entry_from_disk(self, bhash):
+        path = os.path.join(self.fdir, bhash)
+        try:
+            last_access = os.path.getmtime(os.path.join(path, 'calibre-book-manifest.json'))
         except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+            return
+        return {'size': dir_size(path), 'last_access': last_access}
+
+    def __contains__(self, bhash):
+        return bhash in self.entries
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'total_bytes': self.total_bytes, 'num_books': len(self.entries)}
+
+    def touch(self, bhash):
+        e = self.entries.pop(bhash, None)
+        if e is None:
+            e = self.entry_from_disk(bhash) or {'size': 0}
+            self.total_bytes += e['size']
+        e['last_access'] = time.time()
+        self.entries[bhash] = e
+        self.hits += 1
+        self.save(force=False)
+
+    def miss(self):
+        self.misses += 1
+
+    def add(self, bhash, size, max_size=0):
+        self.remove(bhash, remove_files=False)
+        self.entries[bhash] = {'size': size, 'last_access': time.time()}
+        self.total_bytes += size
+        self.evict(max_size)
+        self.save()
+
+    def remove(self, bhash, remove_files=True):
+        e = self.entries.pop(bhash, None)
+        if e is not None:
+            self.total_bytes -= e['size']
+        if remove_files:
+            safe_remove(os.path.join(self.fdir, bhash), False)
+
+    def evict(self, max_size=0):
+        now = time.time()
+        newest = next(reversed(self.entries), None)
+        for bhash, e in tuple(self.entries.items()):
+            # The most recently used book is never removed, it is about to be read
+            if bhash == newest:
+                break
+            if (max_size > 0 and self.total_bytes > max_size) or now - e['last_access'] >= self.MAX_AGE:
+                self.remove(bhash)
+            else:
+                # entries are in order of last access
+                break
+
+    def save(self, force=True):
+        now = time.time()
+        if not force and now - self.last_saved < self.SAVE_INTERVAL:
+            return
+        self.last_saved = now
+        data = self.stats()
+        data['entries'] = self.entries
+        tpath = self.index_path + '.tmp'
+        try:
+            with open(tpath, 'wb') as f:
+                f.write(json_dumps(data))
+            atomic_rename(tpath, self.index_path)
+        except OSError:
+            import traceback
+            traceback.print_exc()
+
+
+_render_cache = None
+
+
+def render_cache():
+    global _render_cache
+    with cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(books_cache_dir())
+        return _render_cache
 
 
 def rename_with_retry(a, b, sleep_time=1):
@@ -124,7 +245,7 @@ def rename_with_retry(a, b, sleep_time=1):
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, max_cache_size = job.data
         queued_jobs.pop(bhash, None)
         safe_remove(pathtoebook)
         if job.failed:
@@ -132,10 +253,11 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
+                size = dir_size(tdir)
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 rename_with_retry(tdir, dest)
+                render_cache().add(bhash, size, max_cache_size)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
@@ -153,16 +275,16 @@ def book_manifest(ctx, rd, book_id, fmt):
         fm = db.format_metadata(book_id, fmt, allow_cache=False)
         if not fm:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+        size, mtime = format_fingerprint(fm)
         bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
         with cache_lock:
             mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
             if force_reload:
                 safe_remove(mpath, True)
             try:
-                os.utime(mpath, None)
                 with open(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
+                render_cache().touch(bhash)
                 ans['metadata'] = book_as_json(db, book_id)
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
@@ -176,11 +298,55 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
+                render_cache().miss()
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
+def format_fingerprint(fm):
+    return tuple(map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10)))
+
+
+# Same as the order used by the browser to choose the format to read
+READ_FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+
+
+def preferred_read_format(formats):
+    formats = [x.upper() for x in formats]
+    fmt = prefs['output_format'].upper()
+    if fmt == 'PDF':
+        fmt = 'EPUB'
+    if fmt in formats:
+        return fmt
+    for fmt in sorted(formats, key=lambda x: READ_FORMAT_PRIORITIES.index(x) if x in READ_FORMAT_PRIORITIES else len(READ_FORMAT_PRIORITIES)):
+        if plugin_for_input_format(fmt) is not None:
+            return fmt
+
+
+def prerender_recent_books(ctx):
+    ''' Render the most recently added books in the default library in the
+    background, so that they are already in the cache when first read. '''
+    db = ctx.library_broker.get(None)
+    if db is None:
+        return
+    for book_id in db.newly_added_book_ids(count=ctx.opts.prerender_recent_books):
+        fmt = preferred_read_format(db.formats(book_id) or ())
+        if fmt is None:
+            continue
+        with db.safe_read_lock:
+            fm = db.format_metadata(book_id, fmt, allow_cache=False)
+            if not fm:
+                continue
+            size, mtime = format_fingerprint(fm)
+            bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+            with cache_lock:
+                if bhash in render_cache() or bhash in queued_jobs:
+                    continue
+                if queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, priority=BACKGROUND) is None:
+                    break  # the job queue is full or the server is shutting down
+
+
 @endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -5,7 +5,7 @@
 import json
 from functools import partial
 from importlib import import_module
-from threading import Lock
+from threading import Lock, Thread
 
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
@@ -39,8 +39,8 @@ def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
-        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, **kw):
+        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data, **kw)
 
     def job_status(self, job_id):
         return self.jobs_manager.job_status(job_id)
@@ -217,6 +217,18 @@ def set_log(self, log):
 
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
+        if self.router.ctx.opts.prerender_recent_books > 0:
+            t = Thread(name='PrerenderBooks', target=self.prerender_recent_books)
+            t.daemon = True
+            t.start()
+
+    def prerender_recent_books(self):
+        from calibre.srv.books import prerender_recent_books
+        try:
+            prerender_recent_books(self.router.ctx)
+        except Exception:
+            import traceback
+            traceback.print_exc()
 
     def close(self):
         self.router.ctx.library_broker.close()
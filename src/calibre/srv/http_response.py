@@ -7,6 +7,7 @@
 import errno
 import hashlib
 import os
+import stat
 import struct
 import time
 import uuid
@@ -35,13 +36,19 @@
 import zlib
 from itertools import zip_longest
 
+sendfile_unsupported_errors = frozenset(getattr(errno, x) for x in ('EINVAL', 'ENOSYS', 'EOPNOTSUPP', 'ENOTSUP') if hasattr(errno, x))
+
 
 def file_metadata(fileobj):
     try:
         fd = fileobj.fileno()
-        return os.fstat(fd)
+        ans = os.fstat(fd)
     except Exception:
-        pass
+        return
+    # Only regular files have a meaningful size and can be used with
+    # sendfile(), pipes, sockets, etc. are read in userspace
+    if stat.S_ISREG(ans.st_mode):
+        return ans
 
 
 def header_list_to_file(buf):  # {{{
@@ -391,6 +398,11 @@ def write(self, buf, end=None):
                     return False
                 if e.errno in (errno.EAGAIN, errno.EINTR):
                     return False
+                if e.errno in sendfile_unsupported_errors:
+                    # The filesystem the file lives on does not support
+                    # sendfile(), copy the data in userspace instead
+                    self.use_sendfile = False
+                    return self.write(buf, end=end)
                 raise
             finally:
                 self.last_activity = monotonic()
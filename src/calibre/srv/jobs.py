@@ -2,37 +2,135 @@
 # License: GPLv3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import heapq
 import os
+import subprocess
 import time
-from collections import deque, namedtuple
+from collections import namedtuple
 from functools import partial
+from importlib import import_module
 from itertools import count
+from multiprocessing.connection import Pipe
 from threading import Event, RLock, Thread
 
 from calibre import detect_ncpus, force_unicode
-from calibre.utils.ipc.simple_worker import WorkerError, fork_job
+from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.ipc.pool import Job as PoolJob
+from calibre.utils.ipc.simple_worker import WorkerError, fork_job, start_pipe_worker
 from calibre.utils.monotonic import monotonic
+from calibre.utils.serialize import pickle_dumps, pickle_loads
 from polyglot.builtins import iteritems, itervalues
 from polyglot.queue import Empty, Queue
 
-StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
+StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data priority use_warm_worker queued_at')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
 
+# Waiting jobs with a lower priority value are started first
+INTERACTIVE, BACKGROUND = 0, 1
+
+
+class WarmWorker:
+
+    ''' A long lived worker process that runs jobs one after another. Modules
+    imported by a job stay imported for subsequent jobs, avoiding the process
+    startup and import costs for every job.
+
+    The output of the worker goes to a log file that is emptied before every
+    job, so that, as for jobs run by fork_job(), the output of a failed job
+    can be reported. '''
+
+    def __init__(self):
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile('_srv_warm_worker.log') as f:
+            self.log_path = f.name
+        # Opened for appending, so that the worker writes to the start of the
+        # file after it is truncated
+        self.log_file = open(self.log_path, 'ab')
+        a, b = Pipe()
+        with a:
+            cmd = f'from calibre.utils.ipc.pool import run_main, worker_main; run_main({a.fileno()!r}, worker_main)'
+            self.process = start_pipe_worker(
+                cmd, env={'PYTHONUNBUFFERED': '1'}, pass_fds=(a.fileno(),), stdout=self.log_file, stderr=subprocess.STDOUT)
+        self.process.stdin.close()
+        self.conn = b
+        self.num_jobs = 0
+
+    @property
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def __call__(self, module, func, args=(), kwargs=None, abort=None):
+        ' Run the job, returning a calibre.utils.ipc.pool.Result or None if aborted '
+        self.num_jobs += 1
+        self.log_file.truncate(0)
+        try:
+            eintr_retry_call(self.conn.send_bytes, pickle_dumps(PoolJob(self.num_jobs, module, func, args, kwargs or {})))
+            while not self.conn.poll(0.1):
+                if abort is not None and abort.is_set():
+                    self.close()
+                    return
+                if not self.is_alive:
+                    break
+            # poll() returns True at EOF as well, when the worker has died
+            return pickle_loads(eintr_retry_call(self.conn.recv_bytes))
+        except (EOFError, OSError):
+            try:
+                self.process.wait(1)
+            except Exception:
+                pass
+            raise WorkerError(f'The worker process crashed with return code: {self.process.returncode}', log_path=self.copy_log())
+
+    def copy_log(self):
+        ' Return the path to a copy of the output of the last job, the copy must be removed by the caller '
+        import shutil
+
+        from calibre.ptempfile import PersistentTemporaryFile
+        with open(self.log_path, 'rb') as src, PersistentTemporaryFile('_srv_job.log') as dest:
+            shutil.copyfileobj(src, dest)
+        return dest.name
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        if self.is_alive:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        try:
+            self.process.wait()
+        except Exception:
+            pass
+        self.log_file.close()
+        try:
+            os.remove(self.log_path)
+        except OSError:
+            pass
+
+
+def warm_up(*modules):
+    for module in modules:
+        import_module(module)
+
 
 class Job(Thread):
 
     daemon = True
 
-    def __init__(self, start_event, events_queue):
+    def __init__(self, start_event, events_queue, run_in_warm_worker=None):
         Thread.__init__(self, name=f'JobsMonitor{start_event.job_id}')
         self.abort_event = Event()
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        runner = fork_job if run_in_warm_worker is None else run_in_warm_worker
+        self.func = partial(runner, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
+        self.queued_at = start_event.queued_at
         self.start_time = monotonic()
         self.end_time = self.log_path = None
         self.wait_for_end = Event()
@@ -46,12 +144,18 @@ def run(self):
             import traceback
             self.traceback = err.orig_tb or traceback.format_exc()
             self.log_path = getattr(err, 'log_path', None)
+        except BaseException:
+            import traceback
+            self.traceback = traceback.format_exc()
         else:
             self.result, self.log_path = result['result'], result['stdout_stderr']
-        self.done = True
-        self.end_time = monotonic()
-        self.wait_for_end.set()
-        self.events_queue.put(DoneEvent(self.job_id))
+        finally:
+            # Always report the end of the job, otherwise it would hold its
+            # slot forever
+            self.done = True
+            self.end_time = monotonic()
+            self.wait_for_end.set()
+            self.events_queue.put(DoneEvent(self.job_id))
 
     @property
     def was_aborted(self):
@@ -84,6 +188,11 @@ def read_log(self):
 
 class JobsManager:
 
+    # Background jobs are refused when this many jobs are already waiting
+    MAX_WAITING_BACKGROUND_JOBS = 100
+    # Warm workers are replaced after this many jobs to limit memory growth
+    MAX_JOBS_PER_WARM_WORKER = 50
+
     def __init__(self, opts, log):
         mj = opts.max_jobs
         if mj < 1:
@@ -97,24 +206,87 @@ def __init__(self, opts, log):
         self.events = Queue()
         self.job_id = count()
         self.waiting_job_ids = set()
-        self.waiting_jobs = deque()
+        self.waiting_jobs = []
+        self.warm_workers = []
+        self.metrics = {'finished_jobs': 0, 'total_wait_time': 0., 'max_wait_time': 0., 'total_run_time': 0.}
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+    def start_job(
+        self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None,
+        priority=INTERACTIVE, use_warm_worker=False
+    ):
+        '''
+        Run the specified function in a worker process. Jobs with
+        priority=BACKGROUND are refused, returning None, if too many jobs are
+        already waiting. With use_warm_worker=True the job is run in a long
+        lived worker process that is re-used across jobs. Such jobs must not
+        leave behind global state that could affect subsequent jobs.
+        '''
         with self.lock:
             if self.shutting_down:
                 return None
+            if priority >= BACKGROUND and len(self.waiting_job_ids) >= self.MAX_WAITING_BACKGROUND_JOBS:
+                return None
             if self.event_loop is None:
                 self.event_loop = t = Thread(name='JobsEventLoop', target=self.run)
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
-            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
+            self.events.put(StartEvent(
+                job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data, priority, use_warm_worker, monotonic()))
             self.waiting_job_ids.add(job_id)
             return job_id
 
+    def stats(self):
+        ' Return counts of jobs and the time finished jobs spent waiting to start vs. running '
+        with self.lock:
+            ans = self.metrics.copy()
+            ans.update({'waiting_jobs': len(self.waiting_job_ids), 'running_jobs': len(self.jobs), 'warm_workers': len(self.warm_workers)})
+        return ans
+
+    def prewarm(self, *modules):
+        ' Start a warm worker in the background that has the specified modules imported '
+        def do_prewarm():
+            try:
+                w = WarmWorker()
+                w('calibre.srv.jobs', 'warm_up', modules)
+            except Exception:
+                import traceback
+                self.log.error(f'Failed to start warm worker process:\n{traceback.format_exc()}')
+            else:
+                self.release_warm_worker(w)
+        t = Thread(name='PrewarmWorker', target=do_prewarm)
+        t.daemon = True
+        t.start()
+
+    def run_in_warm_worker(self, module, func, args=(), kwargs=None, abort=None):
+        with self.lock:
+            w = self.warm_workers.pop() if self.warm_workers else None
+        if w is None:
+            w = WarmWorker()
+        try:
+            result = w(module, func, args, kwargs, abort=abort)
+        except BaseException:
+            w.close()
+            raise
+        if result is None:  # aborted
+            return {'result': None, 'stdout_stderr': None}
+        # Copy the log before the worker is released to run another job
+        log_path = None if result.err is None else w.copy_log()
+        self.release_warm_worker(w)
+        if result.err is not None:
+            raise WorkerError(result.err, result.traceback, log_path)
+        return {'result': result.value, 'stdout_stderr': None}
+
+    def release_warm_worker(self, w):
+        with self.lock:
+            if w.is_alive and w.num_jobs < self.MAX_JOBS_PER_WARM_WORKER and not self.shutting_down:
+                self.warm_workers.append(w)
+                return
+        w.close()
+
     def job_status(self, job_id):
         with self.lock:
             if not self.shutting_down:
@@ -148,6 +320,9 @@ def shutdown(self, timeout=5.0):
             for job in itervalues(self.jobs):
                 job.abort_event.set()
             self.events.put(False)
+            warm_workers, self.warm_workers = self.warm_workers, []
+        for w in warm_workers:
+            w.close()
 
     def wait_for_shutdown(self, wait_till):
         for job in itervalues(self.jobs):
@@ -175,7 +350,7 @@ def run(self):
             if ev is None:
                 self.abort_hanging_jobs()
             elif isinstance(ev, StartEvent):
-                self.waiting_jobs.append(ev)
+                heapq.heappush(self.waiting_jobs, (ev.priority, ev.job_id, ev))
                 self.start_waiting_jobs()
             elif isinstance(ev, DoneEvent):
                 self.job_finished(ev.job_id)
@@ -185,8 +360,8 @@ def run(self):
     def start_waiting_jobs(self):
         with self.lock:
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
-                ev = self.waiting_jobs.popleft()
-                self.jobs[ev.job_id] = Job(ev, self.events)
+                ev = heapq.heappop(self.waiting_jobs)[-1]
+                self.jobs[ev.job_id] = Job(ev, self.events, self.run_in_warm_worker if ev.use_warm_worker else None)
                 self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
@@ -221,6 +396,12 @@ def abort_hanging_jobs(self):
     def job_finished(self, job_id):
         with self.lock:
             self.finished_jobs[job_id] = job = self.jobs.pop(job_id)
+            m = self.metrics
+            wait_time = job.start_time - job.queued_at
+            m['finished_jobs'] += 1
+            m['total_wait_time'] += wait_time
+            m['max_wait_time'] = max(m['max_wait_time'], wait_time)
+            m['total_run_time'] += job.end_time - job.start_time
             if job.callback is not None:
                 try:
                     job.callback(job)
@@ -253,3 +434,12 @@ def sleep_test(x):
 
 def error_test():
     raise Exception('a testing error')
+
+
+def output_error_test():
+    print('output of a failed job')
+    raise Exception('a testing error')
+
+
+def pid_test():
+    return os.getpid()
@@ -7,6 +7,7 @@
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
@@ -43,6 +44,9 @@
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
+SELECTOR_EVENTS = {
+    READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE,
+    RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0}
 
 
 class ReadBuffer:  # {{{
@@ -172,6 +176,9 @@ def is_local_address(addr: ipaddress.IPv4Address | ipaddress.IPv6Address | None)
 
 class Connection:  # {{{
 
+    # The events this connection is registered for, when using a selector
+    selector_events = 0
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -437,6 +444,9 @@ def __init__(
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
+        self.selector = None
+        self.pending_reads = set()
+        self.last_timeout_check = 0
         self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
         self.plugin_pool = PluginPool(self, plugins)
 
@@ -535,6 +545,12 @@ def serve(self):
             addr = format_addr_for_url(str(ba[0]))
             ba_str = f'{addr}:{ba[1]}'
         self.pool.start()
+        tick = self.tick
+        if self.opts.event_loop == 'selectors':
+            tick = self.selector_tick
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+            self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         with TemporaryDirectory(prefix='srv-') as tdir:
             self.tdir = tdir
             if self.LISTENING_MSG:
@@ -544,7 +560,7 @@ def serve(self):
 
             while self.ready:
                 try:
-                    self.tick()
+                    tick()
                 except SystemExit:
                     self.shutdown()
                     raise
@@ -642,7 +658,83 @@ def tick(self):
 
         if not self.ready:
             return
+        self.handle_events(readable, writable)
+
+    def selector_tick(self):
+        # An alternative to tick() that uses the most efficient mechanism
+        # provided by the OS (epoll, kqueue, etc.) to wait for events. Unlike
+        # select() its cost does not grow with the number of idle connections,
+        # since connections are only re-registered when their state changes.
+        now = monotonic()
+        if now - self.last_timeout_check >= 1:
+            self.last_timeout_check = now
+            for s, conn in tuple(iteritems(self.connection_map)):
+                if now - conn.last_activity > self.opts.timeout:
+                    if conn.handle_timeout():
+                        conn.last_activity = now
+                        self.selector_sync(s, conn)
+                    else:
+                        self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                        self.close(s, conn)
+
+        try:
+            events = self.selector.select(0 if self.pending_reads else self.opts.timeout)
+        except (ValueError, KeyError):  # self.socket.fileno() == -1
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        except OSError as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
+                return
+            raise
+        if not self.ready:
+            return
+
+        # Connections with buffered data are readable without waiting
+        cmap = self.connection_map
+        readable = {s: None for s in self.pending_reads if s in cmap and cmap[s].wait_for in (READ, RDWR)}
+        self.pending_reads.clear()
+        writable = []
+        for key, mask in events:
+            s = key.fd
+            conn = cmap.get(s)
+            if conn is None:  # the listening socket or the control connection
+                readable[s] = None
+                continue
+            mask &= SELECTOR_EVENTS[conn.wait_for]
+            if not mask:
+                # Connections waiting for a job are unregistered lazily, as
+                # usually no events arrive for them before the job is done
+                conn.selector_events = 0
+                self.selector.unregister(s)
+            if mask & selectors.EVENT_READ:
+                readable[s] = None
+            if mask & selectors.EVENT_WRITE:
+                writable.append(s)
+        self.handle_events(tuple(readable), writable)
+
+    def selector_sync(self, s, conn):
+        # Register the connection for the events it is waiting for
+        wf = conn.wait_for
+        if wf is READ or wf is RDWR:
+            if not conn.read_buffer.has_data and self.ssl_context is not None:
+                # The SSL layer can have data buffered that the selector does
+                # not know about
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    return
+            if conn.read_buffer.has_data:
+                self.pending_reads.add(s)
+        events = SELECTOR_EVENTS[wf]
+        if events and events != conn.selector_events:
+            if conn.selector_events:
+                self.selector.modify(s, events)
+            else:
+                self.selector.register(s, events)
+            conn.selector_events = events
 
+    def handle_events(self, readable, writable):
         ignore = set()
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
@@ -680,6 +772,8 @@ def tick(self):
                     else:
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
+            if self.selector is not None and self.connection_map.get(s) is conn:
+                self.selector_sync(s, conn)
 
     def write_to_control(self, what):
         if iswindows:
@@ -706,6 +800,11 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.pending_reads.discard(s)
+        if conn.selector_events:
+            conn.selector_events = 0
+            with suppress(KeyError, ValueError, OSError):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -721,6 +820,8 @@ def get_actions(self, readable, writable):
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
+                        elif self.selector is not None:
+                            self.selector_sync(s, conn)
             elif s == control:
                 f = self.control_out.recv if iswindows else self.control_out.read
                 try:
@@ -734,7 +835,11 @@ def get_actions(self, readable, writable):
                     for s, conn, event in self.dispatch_job_results():
                         yield s, conn, event
                 elif c == WAKEUP:
-                    pass
+                    if self.selector is not None:
+                        # Connections can change state in other threads, for
+                        # example when sending websocket messages
+                        for s, conn in tuple(iteritems(self.connection_map)):
+                            self.selector_sync(s, conn)
                 elif not c:
                     if not self.ready:
                         return
@@ -769,6 +874,10 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.selector is not None:
+            with suppress(Exception):
+                self.selector.close()
+            self.selector = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
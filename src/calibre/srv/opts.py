@@ -70,6 +70,13 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Mechanism used to wait for network activity'),
+    'event_loop', Choices('select', 'selectors'),
+    _('The default, "select", works everywhere but becomes slow with thousands of'
+      ' simultaneous connections. "selectors" uses the most efficient mechanism'
+      ' available on the operating system, such as epoll on Linux, and scales'
+      ' to large numbers of mostly idle connections.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -82,6 +89,18 @@ def __new__(cls, *args):
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Maximum size of the cache of books prepared for reading (in MB)'),
+    'book_render_cache_size', 2000,
+    _('Books are prepared for reading in the browser by rendering them into a cache.'
+      ' When the cache grows larger than this size, the least recently read books'
+      ' are removed from it. Set to zero for no limit.'),
+
+    _('Number of recently added books to prepare for reading in advance'),
+    'prerender_recent_books', 0,
+    _('When the server starts, prepare this many of the most recently added books'
+      ' in the default library for reading in the browser, in the background,'
+      ' so that they open instantly for the first reader.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
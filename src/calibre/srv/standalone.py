@@ -81,6 +81,8 @@ def __init__(self, libraries, opts):
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
+        # Have a worker process ready for preparing books for reading
+        self.loop.jobs_manager.prewarm('calibre.srv.render_book')
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+# Measure the throughput and latency of the server event loops with many
+# simultaneous keep-alive connections. Run with:
+# calibre-debug -c "from calibre.srv.tests.benchmark import main; main()"
+# The clients run in a separate process using a single thread.
+
+import json
+import selectors
+import socket
+import time
+
+from calibre.srv.tests.base import TestServer
+
+
+def raise_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return needed  # windows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+class Client:
+
+    def __init__(self, address, pipeline):
+        self.socket = socket.create_connection(address)
+        self.socket.setblocking(False)
+        self.request = b'GET /test HTTP/1.1\r\nHost: localhost\r\nAccept-Language: en\r\n\r\n' * pipeline
+        self.pipeline = pipeline
+        self.buf = b''
+        self.outstanding = []
+
+    def send(self, now):
+        self.socket.sendall(self.request)
+        self.outstanding = [now] * self.pipeline
+
+    def recv(self, now, latencies):
+        data = self.socket.recv(65536)
+        if not data:
+            raise OSError('Connection closed by server')
+        self.buf += data
+        while self.outstanding:
+            hend = self.buf.find(b'\r\n\r\n')
+            if hend < 0:
+                break
+            headers = self.buf[:hend].lower()
+            cl = headers.find(b'content-length:')
+            length = int(headers[cl+15:headers.find(b'\r\n', cl)]) if cl > -1 else 0
+            end = hend + 4 + length
+            if len(self.buf) < end:
+                break
+            self.buf = self.buf[end:]
+            latencies.append(now - self.outstanding.pop())
+        return not self.outstanding
+
+
+def client(address, num_connections, active, duration, pipeline):
+    # Runs in a worker process, prints the number of requests per second and
+    # the p99 latency. Only the first active connections make requests, the
+    # rest stay idle, as is typical for a server with many connected clients.
+    raise_fd_limit(num_connections + 100)
+    sel = selectors.DefaultSelector()
+    clients = []
+    for i in range(num_connections):
+        c = Client(address, pipeline)
+        clients.append(c)
+        sel.register(c.socket, selectors.EVENT_READ, c)
+    latencies = []
+    start = now = time.monotonic()
+    for c in clients[:active]:
+        c.send(now)
+    while now - start < duration:
+        for key, mask in sel.select(1):
+            now = time.monotonic()
+            c = key.data
+            if c.recv(now, latencies):
+                c.send(now)
+        now = time.monotonic()
+    elapsed = now - start
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else float('nan')
+    print(json.dumps([len(latencies) / elapsed, p99]))
+
+
+def run(event_loop, num_connections, active=50, duration=5, pipeline=2):
+    from calibre.utils.ipc.simple_worker import start_pipe_worker
+
+    def handler(data):
+        return 'x' * 100
+
+    with TestServer(handler, timeout=3600, event_loop=event_loop, worker_count=10) as server:
+        p = start_pipe_worker(
+            f'from calibre.srv.tests.benchmark import client; client({server.address!r}, {num_connections}, {active}, {duration}, {pipeline})')
+        stdout = p.communicate()[0]
+        if p.returncode != 0:
+            if not server.loop.ready:
+                # select() cannot handle file descriptors larger than FD_SETSIZE
+                raise Exception('the server event loop stopped, see the log for details')
+            raise Exception(f'the client process failed with return code: {p.returncode}')
+    return json.loads(stdout.splitlines()[-1])
+
+
+def main(connection_counts=(100, 1000, 10000), event_loops=('select', 'selectors'), active=50, duration=5, pipeline=2):
+    limit = raise_fd_limit(max(connection_counts) + 100)
+    for num_connections in connection_counts:
+        if num_connections + 100 > limit:
+            print(f'Skipping {num_connections} connections as the open file limit is only {limit}')
+            continue
+        for event_loop in event_loops:
+            try:
+                rps, p99 = run(event_loop, num_connections, active=min(active, num_connections), duration=duration, pipeline=pipeline)
+            except Exception as e:
+                print(f'{event_loop:>9} with {num_connections:>5} connections: failed with error: {e}')
+                continue
+            print(f'{event_loop:>9} with {num_connections:>5} connections: {rps:8.0f} requests/sec p99 latency: {p99 * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
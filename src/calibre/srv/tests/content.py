@@ -282,3 +282,41 @@ def test_last_read_cache(self):  # {{{
             lrc.add_last_read_position('lib', book_id, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
     # }}}
+
+    def test_render_cache(self):  # {{{
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.books import RenderCache
+
+        def render(tdir, bhash, size):
+            os.makedirs(os.path.join(tdir, 'f', bhash))
+            with open(os.path.join(tdir, 'f', bhash, 'calibre-book-manifest.json'), 'wb') as f:
+                f.write(b'x' * size)
+
+        with TemporaryDirectory() as tdir:
+            os.mkdir(os.path.join(tdir, 'f'))
+            rc = RenderCache(tdir)
+            for bhash in 'abc':
+                render(tdir, bhash, 100)
+                rc.miss()
+                rc.add(bhash, 100, max_size=250)
+            # The least recently used book is removed when over budget
+            self.ae(list(rc.entries), ['b', 'c'])
+            self.ae(rc.total_bytes, 200)
+            self.assertFalse(os.path.exists(os.path.join(tdir, 'f', 'a')))
+            rc.touch('b')
+            render(tdir, 'd', 100)
+            rc.add('d', 100, max_size=250)
+            self.ae(list(rc.entries), ['b', 'd'])
+            # The most recently added book is kept even if it is over budget
+            render(tdir, 'e', 500)
+            rc.add('e', 500, max_size=250)
+            self.ae(list(rc.entries), ['e'])
+            self.ae(rc.stats(), {'hits': 1, 'misses': 3, 'total_bytes': 500, 'num_books': 1})
+            # The index is persisted and renders not in it are picked up
+            render(tdir, 'f', 10)
+            os.mkdir(os.path.join(tdir, 'f', 'incomplete'))
+            rc = RenderCache(tdir)
+            self.ae(list(rc.entries), ['e', 'f'])
+            self.ae(rc.stats(), {'hits': 1, 'misses': 3, 'total_bytes': 510, 'num_books': 2})
+            self.assertFalse(os.path.exists(os.path.join(tdir, 'f', 'incomplete')))
+    # }}}
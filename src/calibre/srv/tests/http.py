@@ -4,6 +4,7 @@
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import errno
 import hashlib
 import os
 import string
@@ -11,6 +12,7 @@
 import zlib
 from io import BytesIO
 from tempfile import NamedTemporaryFile
+from unittest.mock import patch
 
 from calibre import guess_type
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -425,6 +427,26 @@ def edfunc():
                 time_taken = monotonic() - start_time
                 self.assertLess(time_taken, 1, 'Large file transfer took too long')
 
+            # Test that sendfile() is used for full and single range responses
+            # and that we fallback to userspace copies when it is unsupported
+            if hasattr(os, 'sendfile'):
+                server.change_handler(lambda conn: f)
+                server.loop.opts.use_sendfile = True
+
+                def unsupported_sendfile(*a):
+                    raise OSError(errno.EINVAL, 'sendfile() not supported')
+
+                for side_effect in (None, unsupported_sendfile):
+                    with patch('os.sendfile', side_effect=side_effect, wraps=os.sendfile) as sendfile:
+                        conn = server.connect()
+                        conn.request('GET', '/test')
+                        r = conn.getresponse()
+                        self.ae(r.status, http_client.OK), self.ae(r.read(), fdata)
+                        conn.request('GET', '/test', headers={'Range':'bytes=2-25'})
+                        r = conn.getresponse()
+                        self.ae(r.status, http_client.PARTIAL_CONTENT), self.ae(r.read(), fdata[2:26])
+                        self.ae(sendfile.call_count, 2)
+
     # }}}
 
     def test_static_generation(self):  # {{{
@@ -5,6 +5,7 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os
+import signal
 import socket
 import ssl
 import time
@@ -101,6 +102,37 @@ def test_workers(self):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_event_loops(self):
+        ' Test the select and selectors based event loops '
+        for event_loop in ('select', 'selectors'):
+            with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), event_loop=event_loop, timeout=0.5) as server:
+                # Pipelined keep-alive requests
+                s = socket.create_connection(server.address)
+                s.sendall(b''.join(b'GET /p%d HTTP/1.1\r\nHost: x\r\n\r\n' % i for i in range(5)))
+                s.settimeout(5)
+                data = b''
+                while data.count(b'HTTP/1.1 200') < 5:
+                    d = s.recv(65536)
+                    if not d:
+                        break
+                    data += d
+                self.ae(data.count(b'HTTP/1.1 200'), 5, event_loop)
+                for i in range(5):
+                    self.assertIn(b'\r\n\r\np%d' % i, data)
+                conns = [server.connect() for i in range(10)]
+                for i, conn in enumerate(conns):
+                    conn.request('GET', f'/c{i}', 'body')
+                for i, conn in enumerate(conns):
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), f'c{i}body'.encode())
+                # Idle connections are closed
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 5:
+                    time.sleep(0.1)
+                self.ae(server.loop.num_active_connections, 0, event_loop)
+                s.close()
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         with TestServer(lambda data:(data.path[0] + data.read()), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -302,6 +334,77 @@ def job_status(jid):
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+    def test_warm_workers(self):
+        'Test running jobs in warm worker processes with priorities'
+        from calibre.srv.jobs import BACKGROUND, JobsManager
+        O = namedtuple('O', 'max_jobs max_job_time')
+
+        class FakeLog(list):
+
+            def error(self, *args):
+                self.append(' '.join(args))
+        jm = JobsManager(O(1, 5), FakeLog())
+        jm.MAX_WAITING_BACKGROUND_JOBS = 2
+
+        def wait(job_id):
+            while jm.job_status(job_id)[0] in ('waiting', 'running'):
+                time.sleep(0.01)
+            return jm.job_status(job_id)
+
+        def start(func, *args, **kw):
+            return jm.start_job(func, 'calibre.srv.jobs', func, args=args, use_warm_worker=True, **kw)
+
+        job_id = start('sleep_test', 0.5)
+        while jm.job_status(job_id)[0] == 'waiting':
+            time.sleep(0.01)
+        bg1, bg2 = start('pid_test', priority=BACKGROUND), start('pid_test', priority=BACKGROUND)
+        self.assertIsNone(start('pid_test', priority=BACKGROUND), 'background job accepted into a full queue')
+        fg = start('pid_test')
+        self.assertEqual(wait(job_id)[1], 0.5)
+        pids = {wait(x)[1] for x in (bg1, bg2, fg)}
+        # Interactive jobs are started before background jobs
+        self.assertLess(jm.finished_jobs[fg].start_time, jm.finished_jobs[bg1].start_time)
+        # All jobs run in the same worker process
+        self.assertEqual(len(pids), 1)
+        pid = next(iter(pids))
+        self.assertNotEqual(pid, os.getpid())
+        status, result, tb, was_aborted = wait(start('error_test'))
+        self.assertIn('a testing error', tb)
+        self.assertEqual(wait(start('pid_test'))[1], pid)
+        # The output of failed jobs is logged
+        del jm.log[:]
+        status, result, tb, was_aborted = wait(start('output_error_test'))
+        self.assertIn('a testing error', tb)
+        self.assertEqual(len(jm.log), 1)
+        self.assertIn('output of a failed job', jm.log[0])
+        self.assertEqual(wait(start('pid_test'))[1], pid)
+        # Aborting a job kills the worker process
+        job_id = start('sleep_test', 3)
+        while jm.job_status(job_id)[0] == 'waiting':
+            time.sleep(0.01)
+        jm.abort_job(job_id)
+        self.assertTrue(wait(job_id)[3])
+        new_pid = wait(start('pid_test'))[1]
+        self.assertNotEqual(new_pid, pid)
+        pid = new_pid
+        # A worker process that dies during a job fails the job and frees its slot
+        job_id = start('sleep_test', 3)
+        while jm.job_status(job_id)[0] == 'waiting':
+            time.sleep(0.01)
+        os.kill(pid, signal.SIGTERM)
+        status, result, tb, was_aborted = wait(job_id)
+        self.assertEqual(status, 'finished')
+        self.assertIn('crashed', tb)
+        self.assertFalse(was_aborted)
+        self.assertNotEqual(wait(start('pid_test'))[1], pid)
+        stats = jm.stats()
+        self.assertEqual(stats['finished_jobs'], 12)
+        self.assertEqual(stats['running_jobs'], 0)
+        self.assertEqual(stats['warm_workers'], 1)
+        self.assertGreater(stats['total_wait_time'], 0)
+        jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+        self.assertFalse(jm.warm_workers)
+
 
 def find_tests():
     import unittest
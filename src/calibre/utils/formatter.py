@@ -976,8 +976,7 @@ def error(self, message, line_number):
         m = _('Interpreter: {0} - line number {1}').format(message, line_number)
         raise ValueError(m)
 
-    def program(self, funcs, parent, prog, val, is_call=False, args=None,
-                global_vars=None, break_reporter=None):
+    def initialize(self, funcs, parent, val, global_vars=None, break_reporter=None):
         self.parent = parent
         self.parent_kwargs = parent.kwargs
         self.parent_book = parent.book
@@ -992,6 +991,9 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
         else:
             self.break_reporter = None
 
+    def program(self, funcs, parent, prog, val, is_call=False, args=None,
+                global_vars=None, break_reporter=None):
+        self.initialize(funcs, parent, val, global_vars=global_vars, break_reporter=break_reporter)
         try:
             if is_call:
                 # prog is an instance of the function definition class
@@ -1002,6 +1004,15 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             ret = e.get_value()
         return ret
 
+    def run_compiled(self, funcs, parent, compiled, val, global_vars=None):
+        # Run a program produced by _Compiler
+        self.initialize(funcs, parent, val, global_vars=global_vars)
+        try:
+            ret = compiled(self)
+        except ReturnExecuted as e:
+            ret = e.get_value()
+        return ret
+
     def call_break_reporter(self, txt, val, line_number):
         self.real_break_reporter(txt, val, self.locals,
                                  self.override_line_number if self.override_line_number
@@ -1624,6 +1635,585 @@ def expr(self, prog):
                        prog.line_number)
 
 
+class _Compiler:
+    '''
+    Turns the parse tree of a General Program Mode template into a tree of
+    closures. Evaluating the closures gives the same results as running the
+    tree through :class:`_Interpreter` but avoids dispatching on the node type
+    and looking up the node attributes for every node on every evaluation. The
+    closures take the interpreter as their only argument, it holds the state
+    for the evaluation (locals, globals, the book, etc.). Compiled templates do
+    not support the break reporter, templates being debugged are interpreted.
+    '''
+
+    # Node types whose evaluation can raise arbitrary exceptions. The
+    # interpreter converts these into errors with the line number of the node.
+    GUARDED_NODES = frozenset((
+        Node.NODE_FUNC, Node.NODE_CALL_STORED_TEMPLATE, Node.NODE_LOCAL_FUNCTION_CALL,
+        Node.NODE_SWITCH, Node.NODE_CONTAINS, Node.NODE_STRCAT, Node.NODE_LIST_COUNT_FIELD,
+        Node.NODE_PRINT,
+    ))
+
+    def __init__(self):
+        self.stored_templates = {}
+
+    def compile_program(self, tree):
+        return self.expression_list(tree)
+
+    def expr(self, node):
+        if isinstance(node, list):
+            return self.expression_list(node)
+        f = self.NODE_COMPILERS[node.node_type](self, node)
+        if node.node_type in self.GUARDED_NODES:
+            f = self.guard(f, node.line_number)
+        return f
+
+    def guard(self, f, line_number):
+        def guarded(ip):
+            try:
+                return f(ip)
+            except (ValueError, ExecutionBase, StopException):
+                raise
+            except Exception as e:
+                if DEBUG:
+                    traceback.print_exc()
+                ip.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+        return guarded
+
+    def interpreted(self, node):
+        return lambda ip: ip.expr(node)
+
+    def expression_list(self, nodes):
+        fns = tuple(self.expr(n) for n in nodes)
+        if not fns:
+            return lambda ip: ''
+
+        def expression_list(ip):
+            val = ''
+            try:
+                for f in fns:
+                    val = f(ip)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return expression_list
+
+    def do_node_if(self, node):
+        condition = self.expr(node.condition)
+        then_part = self.expression_list(node.then_part)
+        else_part = self.expression_list(node.else_part) if node.else_part else None
+
+        def do_if(ip):
+            if condition(ip):
+                return then_part(ip)
+            if else_part is not None:
+                return else_part(ip)
+            return ''
+        return do_if
+
+    def do_node_for(self, node):
+        line_number, v = node.line_number, node.variable
+        separator_expr = None if node.separator is None else self.expr(node.separator)
+        list_field_expr = self.expr(node.list_field_expr)
+        block = self.expression_list(node.block)
+
+        def do_for(ip):
+            try:
+                separator = ',' if separator_expr is None else separator_expr(ip)
+                f = list_field_expr(ip)
+                res = getattr(ip.parent_book, f, f)
+                if res is not None:
+                    if isinstance(res, str):
+                        res = [r.strip() for r in res.split(separator) if r.strip()]
+                    ret = ''
+                    try:
+                        for x in res:
+                            try:
+                                ip.locals[v] = x
+                                ret = block(ip)
+                            except ContinueExecuted as e:
+                                ret = e.get_value()
+                    except BreakExecuted as e:
+                        ret = e.get_value()
+                return ret
+            except (StopException, ValueError, ReturnExecuted) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+        return do_for
+
+    def do_node_range(self, node):
+        line_number, var = node.line_number, node.variable
+        start_expr, stop_expr, step_expr = self.expr(node.start_expr), self.expr(node.stop_expr), self.expr(node.step_expr)
+        limit_expr = None if node.limit_expr is None else self.expr(node.limit_expr)
+        block = self.expression_list(node.block)
+
+        def do_range(ip):
+            try:
+                try:
+                    start_val = int(ip.float_deal_with_none(start_expr(ip)))
+                except ValueError:
+                    ip.error(_('{0}: {1} must be an integer').format('for', 'start'), line_number)
+                try:
+                    stop_val = int(ip.float_deal_with_none(stop_expr(ip)))
+                except ValueError:
+                    ip.error(_('{0}: {1} must be an integer').format('for', 'stop'), line_number)
+                try:
+                    step_val = int(ip.float_deal_with_none(step_expr(ip)))
+                except ValueError:
+                    ip.error(_('{0}: {1} must be an integer').format('for', 'step'), line_number)
+                try:
+                    limit_val = 1000 if limit_expr is None else int(ip.float_deal_with_none(limit_expr(ip)))
+                except ValueError:
+                    ip.error(_('{0}: {1} must be an integer').format('for', 'limit'), line_number)
+                ret = ''
+                try:
+                    range_gen = range(start_val, stop_val, step_val)
+                    if len(range_gen) > limit_val:
+                        ip.error(
+                            _('{0}: the range length ({1}) is larger than the limit ({2})').format(
+                                'for', str(len(range_gen)), str(limit_val)), line_number)
+                    for x in range_gen:
+                        try:
+                            ip.locals[var] = str(x)
+                            ret = block(ip)
+                        except ContinueExecuted as e:
+                            ret = e.get_value()
+                except BreakExecuted as e:
+                    ret = e.get_value()
+                return ret
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+        return do_range
+
+    def do_node_rvalue(self, node):
+        name, line_number = node.name, node.line_number
+
+        def do_rvalue(ip):
+            try:
+                return ip.locals[name]
+            except Exception:
+                ip.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return do_rvalue
+
+    def do_node_func(self, node):
+        name = node.name.strip()
+        args = tuple(self.expr(arg) for arg in node.expression_list)
+
+        def do_func(ip):
+            vals = [a(ip) for a in args]
+            return ip.funcs[name].eval_(ip.parent, ip.parent_kwargs, ip.parent_book, ip.locals, *vals)
+        return do_func
+
+    def stored_template(self, function):
+        # Compile the body of a stored template once, even if it is called
+        # from many places. Fall back to the interpreter for recursive calls.
+        key = id(function)
+        if key in self.stored_templates:
+            body = self.stored_templates[key]
+            if body is None:
+                tree = function.cached_compiled_text
+                return lambda ip: ip.expression_list(tree)
+            return body
+        self.stored_templates[key] = None
+        body = self.expression_list(function.cached_compiled_text)
+        self.stored_templates[key] = body
+        return body
+
+    def do_node_stored_template_call(self, node):
+        function = node.function
+        args = tuple(self.expr(arg) for arg in node.expression_list)
+        if function_object_type(function.program_text) is StoredObjectType.StoredGPMTemplate:
+            body = self.stored_template(function)
+        else:
+            body = None
+
+        def do_stored_template_call(ip):
+            vals = [a(ip) for a in args]
+            saved_locals, saved_local_functions = ip.locals, ip.local_functions
+            ip.locals = {'*arg_' + str(dex): v for dex, v in enumerate(vals)}
+            ip.local_functions = {}
+            try:
+                if body is None:
+                    val = ip.parent._run_python_template(function.cached_compiled_text, vals)
+                else:
+                    val = body(ip)
+            except ReturnExecuted as e:
+                val = e.get_value()
+            ip.locals, ip.local_functions = saved_locals, saved_local_functions
+            return val
+        return do_stored_template_call
+
+    def do_node_local_function_define(self, node):
+        name = node.name
+        line_number, argument_list, block = node.attributes_to_tuple()
+        function = (line_number, tuple((arg.left, self.expr(arg.right)) for arg in argument_list), self.expr(block))
+
+        def do_local_function_define(ip):
+            ip.local_functions[name] = function
+            return ''
+        return do_local_function_define
+
+    def do_node_local_function_call(self, node):
+        name, line_number = node.name, node.line_number
+        arguments = tuple(self.expr(arg) for arg in node.arguments)
+
+        def do_local_function_call(ip):
+            argument_list, block = ip.local_functions[name][1:]
+            if len(arguments) > len(argument_list):
+                ip.error(_('Function {0}: argument count mismatch -- '
+                           '{1} given, at most {2} required').format(name, len(arguments), len(argument_list)),
+                         line_number)
+            new_locals = {}
+            for i, (left, default) in enumerate(argument_list):
+                new_locals[left] = arguments[i](ip) if len(arguments) > i else default(ip)
+            saved_locals = ip.locals
+            ip.locals = new_locals
+            try:
+                val = block(ip)
+            except ReturnExecuted as e:
+                val = e.get_value()
+            finally:
+                ip.locals = saved_locals
+            return val
+        return do_local_function_call
+
+    def do_node_arguments(self, node):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in node.expression_list)
+
+        def do_arguments(ip):
+            for dex, (left, right) in enumerate(args):
+                ip.locals[left] = ip.locals.get('*arg_' + str(dex), right(ip))
+            return ''
+        return do_arguments
+
+    def do_node_globals(self, node):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in node.expression_list)
+
+        def do_globals(ip):
+            res = ''
+            for left, right in args:
+                res = ip.locals[left] = ip.global_vars.get(left, right(ip))
+            return res
+        return do_globals
+
+    def do_node_set_globals(self, node):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in node.expression_list)
+
+        def do_set_globals(ip):
+            res = ''
+            for left, right in args:
+                res = ip.global_vars[left] = ip.locals.get(left, right(ip))
+            return res
+        return do_set_globals
+
+    def do_node_constant(self, node):
+        value = node.value
+        return lambda ip: value
+
+    def do_node_field(self, node):
+        expression, line_number = self.expr(node.expression), node.line_number
+
+        def do_field(ip):
+            try:
+                name = expression(ip)
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return do_field
+
+    def do_node_raw_field(self, node):
+        expression, line_number = self.expr(node.expression), node.line_number
+        default = None if node.default is None else self.expr(node.default)
+
+        def do_raw_field(ip):
+            try:
+                name = field_metadata.search_term_to_field_key(expression(ip))
+                res = getattr(ip.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ip)
+                if res is not None and isinstance(res, list):
+                    fm = ip.parent_book.metadata_for_field(name)
+                    if fm is None:
+                        return ', '.join(res)
+                    return fm['is_multiple']['list_to_ui'].join(res)
+                return str(res)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return do_raw_field
+
+    def do_node_assign(self, node):
+        left, right = node.left, self.expr(node.right)
+
+        def do_assign(ip):
+            ip.locals[left] = t = right(ip)
+            return t
+        return do_assign
+
+    def do_node_first_non_empty(self, node):
+        exprs = tuple(self.expr(e) for e in node.expression_list)
+
+        def do_first_non_empty(ip):
+            for e in exprs:
+                v = e(ip)
+                if v:
+                    return v
+            return ''
+        return do_first_non_empty
+
+    def do_node_switch(self, node):
+        exprs = tuple(self.expr(e) for e in node.expression_list)
+        value_expr, default_expr = exprs[0], exprs[-1]
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(1, len(exprs)-1, 2))
+
+        def do_switch(ip):
+            val = value_expr(ip)
+            for pat, res in cases:
+                if re.search(pat(ip), val, flags=re.I):
+                    return res(ip)
+            return default_expr(ip)
+        return do_switch
+
+    def do_node_switch_if(self, node):
+        exprs = tuple(self.expr(e) for e in node.expression_list)
+        default_expr = exprs[-1]
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(0, len(exprs)-1, 2))
+
+        def do_switch_if(ip):
+            for tst, res in cases:
+                if tst(ip):
+                    return res(ip)
+            return default_expr(ip)
+        return do_switch_if
+
+    def do_node_strcat(self, node):
+        exprs = tuple(self.expr(e) for e in node.expression_list)
+        return lambda ip: ''.join([e(ip) for e in exprs])
+
+    def do_node_list_count_field(self, node):
+        expression, line_number = self.expr(node.expression), node.line_number
+
+        def do_list_count_field(ip):
+            name = field_metadata.search_term_to_field_key(expression(ip))
+            res = getattr(ip.parent_book, name, None)
+            if res is None or not isinstance(res, (list, tuple, set, dict)):
+                ip.error(_("Field '{0}' is either not a field or not a list").format(name), line_number)
+            return str(len(res))
+        return do_list_count_field
+
+    def do_node_break(self, node):
+        def do_break(ip):
+            raise BreakExecuted()
+        return do_break
+
+    def do_node_continue(self, node):
+        def do_continue(ip):
+            raise ContinueExecuted()
+        return do_continue
+
+    def do_node_return(self, node):
+        expr = self.expr(node.expr)
+
+        def do_return(ip):
+            e = ReturnExecuted()
+            e.set_value(expr(ip))
+            raise e
+        return do_return
+
+    def do_node_contains(self, node):
+        value_expr, test_expr = self.expr(node.value_expression), self.expr(node.test_expression)
+        match_expr, not_match_expr = self.expr(node.match_expression), self.expr(node.not_match_expression)
+
+        def do_contains(ip):
+            v = value_expr(ip)
+            if re.search(test_expr(ip), v, flags=re.I):
+                return match_expr(ip)
+            return not_match_expr(ip)
+        return do_contains
+
+    def do_node_string_infix(self, node):
+        operator, line_number = node.operator, node.line_number
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(operator)
+        if op is None and operator != 'inlist_field':
+            return self.interpreted(node)
+        left, right = self.expr(node.left), self.expr(node.right)
+
+        def do_string_infix(ip):
+            try:
+                lv, rv = left(ip), right(ip)
+                if op is None:
+                    return ip.do_inlist_field(lv, rv, node)
+                return '1' if op(lv, rv) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during string comparison: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_string_infix
+
+    def do_node_numeric_infix(self, node):
+        operator, line_number = node.operator, node.line_number
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS[operator]
+        left, right = self.expr(node.left), self.expr(node.right)
+
+        def do_numeric_infix(ip):
+            try:
+                return '1' if op(ip.float_deal_with_none(left(ip)), ip.float_deal_with_none(right(ip))) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Value used in comparison is not a number: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_numeric_infix
+
+    def do_node_logop(self, node):
+        operator, line_number = node.operator, node.line_number
+        left, right = self.expr(node.left), self.expr(node.right)
+        is_and = operator == 'and'
+
+        def do_logop(ip):
+            try:
+                if is_and:
+                    return '1' if left(ip) and right(ip) else ''
+                return '1' if left(ip) or right(ip) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_logop
+
+    def do_node_logop_unary(self, node):
+        operator, line_number = node.operator, node.line_number
+        op = _Interpreter.LOGICAL_UNARY_OPS[operator]
+        expr = self.expr(node.expr)
+
+        def do_logop_unary(ip):
+            try:
+                return '1' if op(expr(ip)) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_logop_unary
+
+    def do_node_binary_arithop(self, node):
+        operator, line_number = node.operator, node.line_number
+        op = _Interpreter.ARITHMETIC_BINARY_OPS[operator]
+        left, right = self.expr(node.left), self.expr(node.right)
+
+        def do_binary_arithop(ip):
+            try:
+                answer = op(ip.float_deal_with_none(left(ip)), ip.float_deal_with_none(right(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_binary_arithop
+
+    def do_node_unary_arithop(self, node):
+        operator, line_number = node.operator, node.line_number
+        op = _Interpreter.ARITHMETIC_UNARY_OPS[operator]
+        expr = self.expr(node.expr)
+
+        def do_unary_arithop(ip):
+            try:
+                answer = op(float(expr(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_unary_arithop
+
+    def do_node_stringops(self, node):
+        operator, line_number = node.operator, node.line_number
+        left, right = self.expr(node.left), self.expr(node.right)
+
+        def do_stringops(ip):
+            try:
+                return left(ip) + right(ip)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: "
+                           "operator '{0}'").format(operator), line_number)
+        return do_stringops
+
+    def do_node_character(self, node):
+        expression, line_number = self.expr(node.expression), node.line_number
+
+        def do_character(ip):
+            key = expression(ip)
+            ret = _Interpreter.characters.get(key, None)
+            if ret is None:
+                ip.error(_("Function {0}: invalid character name '{1}")
+                         .format('character', key), line_number)
+            return ret
+        return do_character
+
+    def do_node_print(self, node):
+        args = tuple(self.expr(arg) for arg in node.arguments)
+
+        def do_print(ip):
+            res = [a(ip) for a in args]
+            print(res)
+            return res[0] if res else ''
+        return do_print
+
+    NODE_COMPILERS = {
+        Node.NODE_IF:                    do_node_if,
+        Node.NODE_ASSIGN:                do_node_assign,
+        Node.NODE_CONSTANT:              do_node_constant,
+        Node.NODE_RVALUE:                do_node_rvalue,
+        Node.NODE_FUNC:                  do_node_func,
+        Node.NODE_FIELD:                 do_node_field,
+        Node.NODE_RAW_FIELD:             do_node_raw_field,
+        Node.NODE_COMPARE_STRING:        do_node_string_infix,
+        Node.NODE_COMPARE_NUMERIC:       do_node_numeric_infix,
+        Node.NODE_ARGUMENTS:             do_node_arguments,
+        Node.NODE_CALL_STORED_TEMPLATE:  do_node_stored_template_call,
+        Node.NODE_FIRST_NON_EMPTY:       do_node_first_non_empty,
+        Node.NODE_SWITCH:                do_node_switch,
+        Node.NODE_SWITCH_IF:             do_node_switch_if,
+        Node.NODE_FOR:                   do_node_for,
+        Node.NODE_RANGE:                 do_node_range,
+        Node.NODE_GLOBALS:               do_node_globals,
+        Node.NODE_SET_GLOBALS:           do_node_set_globals,
+        Node.NODE_CONTAINS:              do_node_contains,
+        Node.NODE_BINARY_LOGOP:          do_node_logop,
+        Node.NODE_UNARY_LOGOP:           do_node_logop_unary,
+        Node.NODE_BINARY_ARITHOP:        do_node_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:         do_node_unary_arithop,
+        Node.NODE_PRINT:                 do_node_print,
+        Node.NODE_BREAK:                 do_node_break,
+        Node.NODE_CONTINUE:              do_node_continue,
+        Node.NODE_RETURN:                do_node_return,
+        Node.NODE_CHARACTER:             do_node_character,
+        Node.NODE_STRCAT:                do_node_strcat,
+        Node.NODE_BINARY_STRINGOP:       do_node_stringops,
+        Node.NODE_LOCAL_FUNCTION_DEFINE: do_node_local_function_define,
+        Node.NODE_LOCAL_FUNCTION_CALL:   do_node_local_function_call,
+        Node.NODE_LIST_COUNT_FIELD:      do_node_list_count_field,
+        }
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -1719,7 +2309,29 @@ def _explode_format_string(self, fmt):
             (r'\s',                      lambda x,t: _Parser.LEX_NEWLINE if t == '\n' else None),
         ], flags=re.DOTALL)
 
+    # General Program Mode templates compiled by _Compiler, keyed by the
+    # template text. Shared by all formatters.
+    compiled_programs = {}
+    MAX_COMPILED_PROGRAMS = 1024
+    # If False, always use the interpreter. Useful for comparing the two.
+    use_compiled_programs = True
+
+    def compiled_program(self, prog):
+        generation = formatter_functions().generation
+        ans = self.compiled_programs.get(prog)
+        if ans is not None and ans[0] is self.funcs and ans[1] == generation:
+            return ans[2]
+        tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+        compiled = _Compiler().compile_program(tree)
+        if len(self.compiled_programs) >= self.MAX_COMPILED_PROGRAMS:
+            self.compiled_programs.clear()
+        self.compiled_programs[prog] = (self.funcs, generation, compiled)
+        return compiled
+
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
+        if break_reporter is None and self.use_compiled_programs:
+            return self.gpm_interpreter.run_compiled(
+                self.funcs, self, self.compiled_program(prog), val, global_vars=global_vars)
         if column_name is not None and self.template_cache is not None:
             tree = self.template_cache.get(column_name, None)
             if not tree:
@@ -2060,3 +2672,206 @@ def get_value(self, key, args, kwargs):
 
 # DEPRECATED. This is not thread safe. Do not use.
 eval_formatter = EvalFormatter()
+
+
+# Finding the fields a template reads {{{
+
+# Formatter functions whose value depends only on their arguments, not on the
+# book the template is evaluated for
+PURE_FUNCTIONS = frozenset((
+    'add', 'and', 'capitalize', 'ceiling', 'character', 'cmp', 'current_library_name',
+    'current_library_path', 'date_arithmetic', 'days_between', 'divide', 'encode_for_url',
+    'finish_formatting', 'first_matching_cmp', 'first_non_empty', 'floor', 'format_date',
+    'format_duration', 'format_number', 'fractional_part', 'human_readable',
+    'identifier_in_list', 'ifempty', 'is_dark_mode', 'language_codes', 'language_strings',
+    'list_contains', 'list_count', 'list_count_matching', 'list_difference', 'list_equals',
+    'list_intersection', 'list_item', 'list_join', 'list_re', 'list_re_group',
+    'list_remove_duplicates', 'list_sort', 'list_split', 'list_union', 'lowercase',
+    'make_url', 'make_url_extended', 'mod', 'multiply', 'not', 'or', 'query_string',
+    'range', 'rating_to_stars', 're', 're_group', 'round', 'select', 'shorten',
+    'str_in_list', 'strcat', 'strcat_max', 'strcmp', 'strcmpcase', 'strlen', 'sublist',
+    'subitems', 'substr', 'subtract', 'swap_around_articles', 'swap_around_comma',
+    'titlecase', 'to_hex', 'today', 'transliterate', 'uppercase', 'urls_from_identifiers',
+))
+
+# Formatter functions whose first argument is the name of a field they read
+FIELD_NAME_FUNCTIONS = frozenset((
+    'check_yes_no', 'field', 'field_exists', 'format_date_field', 'list_count_field',
+    'raw_field', 'raw_list',
+))
+
+# Formatter functions that read fields that are not named in the template
+IMPLICIT_FIELD_FUNCTIONS = {
+    'approximate_formats': ('formats',),
+    'author_sorts': ('authors',),
+    'booksize': ('size',),
+    'formats_modtimes': ('formats',),
+    'formats_path_segments': ('formats', 'path'),
+    'formats_paths': ('formats', 'path'),
+    'formats_sizes': ('formats',),
+    'has_cover': ('cover',),
+    'ondevice': ('ondevice',),
+    'series_sort': ('series', 'languages'),
+}
+
+
+class UnknownReferences(Exception):
+    pass
+
+
+def _constant_name(expr):
+    if isinstance(expr, list) and len(expr) == 1:
+        expr = expr[0]
+    if isinstance(expr, Node) and expr.node_type == Node.NODE_CONSTANT:
+        return expr.value
+    raise UnknownReferences()
+
+
+def _gpm_references(tree, names, possible_names, seen):
+    if isinstance(tree, (list, tuple)):
+        for node in tree:
+            _gpm_references(node, names, possible_names, seen)
+        return
+    if not isinstance(tree, Node):
+        return
+    nt = tree.node_type
+    if nt in (Node.NODE_FIELD, Node.NODE_RAW_FIELD, Node.NODE_LIST_COUNT_FIELD):
+        names.add(_constant_name(tree.expression))
+    elif nt == Node.NODE_FUNC:
+        if tree.name in FIELD_NAME_FUNCTIONS:
+            names.add(_constant_name(tree.expression_list[0] if tree.expression_list else None))
+        elif tree.name in IMPLICIT_FIELD_FUNCTIONS:
+            names.update(IMPLICIT_FIELD_FUNCTIONS[tree.name])
+        elif tree.name not in PURE_FUNCTIONS:
+            raise UnknownReferences()
+    elif nt == Node.NODE_CALL_STORED_TEMPLATE:
+        compiled = tree.function.cached_compiled_text
+        if not isinstance(compiled, list):  # python templates compile to functions
+            raise UnknownReferences()
+        if id(compiled) not in seen:
+            seen.add(id(compiled))
+            _gpm_references(compiled, names, possible_names, seen)
+    elif nt == Node.NODE_FOR:
+        # The list expression is the name of a field or a list of values
+        try:
+            possible_names.add(_constant_name(tree.list_field_expr))
+        except UnknownReferences:
+            pass
+    elif nt == Node.NODE_COMPARE_STRING and tree.operator == 'inlist_field':
+        names.add(_constant_name(tree.right))
+    for val in vars(tree).values():
+        if isinstance(val, (Node, list, tuple)):
+            _gpm_references(val, names, possible_names, seen)
+
+
+def template_references(template, funcs=None):
+    '''
+    Return the names of the fields that the template reads, as a pair of sets
+    (names, possible_names), where possible_names are read only if they turn
+    out to be the name of a field. Returns None if this cannot be determined
+    without evaluating the template, for example, because it computes the
+    names of the fields it reads, calls functions that read from the database
+    or is a python template. The names are as used in the template, they are
+    not converted to field keys.
+    '''
+    formatter = TemplateFormatter()
+    if funcs is not None:
+        formatter.funcs = funcs
+    names, possible_names = set(), set()
+
+    def gpm(prog):
+        tree = formatter.gpm_parser.program(formatter, formatter.funcs, formatter.lex_scanner.scan(prog))
+        _gpm_references(tree, names, possible_names, set())
+
+    try:
+        if template.startswith('program:'):
+            gpm(template[len('program:'):])
+        elif template.startswith('python:'):
+            return None
+        else:
+            for literal, key, fmt, conversion in formatter.parse(template):
+                if key:
+                    names.add(key)
+                if not fmt:
+                    continue
+                if '{' in fmt:
+                    # Format specs can contain replacement fields
+                    return None
+                # Mirror the handling of format specs in format_field()
+                fmt = formatter._explode_format_string(fmt)[0]
+                if fmt.startswith("'"):
+                    p = 0
+                else:
+                    p = fmt.find(":'")
+                    if p >= 0:
+                        p += 1
+                if p >= 0 and fmt[-1] == "'":
+                    gpm(fmt[p+1:-1])
+                else:
+                    p = fmt.find('(')
+                    if p >= 0 and fmt[-1] == ')':
+                        fname = fmt[fmt[:p].find(':') + 1:p].strip()
+                        if fname in IMPLICIT_FIELD_FUNCTIONS:
+                            names.update(IMPLICIT_FIELD_FUNCTIONS[fname])
+                        elif fname not in PURE_FUNCTIONS:
+                            return None
+    except (UnknownReferences, ValueError):
+        return None
+    return names, possible_names
+# }}}
+
+
+# Benchmark {{{
+
+BENCHMARK_TEMPLATES = (
+    # Column coloring
+    "program: if $publisher == 'Tor' && $rating >=# 4 then 'green' elif $tags inlist 'news' then 'red' else '' fi",
+    # Icon rules
+    ("program: first_non_empty(switch($series, 'Foundation', 'foundation.png', 'Dune', 'dune.png', ''), "
+     "contains($tags, 'fiction', 'book.png', 'other.png'))"),
+    # Composite column summarising lists
+    ("program: res = ''; for t in 'tags': if t != 'news' then res = list_union(res, uppercase(t), ',') fi rof; "
+     "strcat(res, ' (', list_count_field('tags'), ')')"),
+    # Save to disk path
+    ("program: a = sublist($authors, 0, 1, '&'); s = test($series, strcat($series, '/', format_number($series_index, '{:02d}'), ' - '), ''); "
+     "strcat(re(a, '([^,]+), (.+)', '\\2 \\1'), '/', s, shorten($title, 20, '-', 20))"),
+    # Arithmetic and local functions
+    'program: def f(x, y=2): return x * y + 1 fed; total = 0; for i in range(1, 20): total = total + f(i) rof; total',
+)
+
+
+def benchmark(num_books=2000):
+    '''
+    Compare the time taken to evaluate some representative General Program Mode
+    templates with the interpreter and with the compiler. Run with:
+    calibre-debug -c "from calibre.utils.formatter import benchmark; benchmark()"
+    '''
+    import time
+
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    formatter = SafeFormat()
+    books = []
+    for i in range(num_books):
+        mi = Metadata(f'The title of book number {i}', [f'Author{i % 17}, First', 'Other Author'])
+        mi.tags = ['News', 'Fiction', f'tag{i % 11}'][:1 + i % 3]
+        mi.series, mi.series_index = ('Foundation', 'Dune', None)[i % 3], 1 + i % 7
+        mi.rating = i % 11
+        books.append(mi)
+
+    def run(template, column_name):
+        template_cache = {}
+        return [formatter.safe_format(template, mi, 'ERROR', mi, column_name=column_name,
+                                      template_cache=template_cache) for mi in books]
+
+    for i, template in enumerate(BENCHMARK_TEMPLATES):
+        timings, results = [], []
+        for use_compiled_programs in (False, True):
+            formatter.use_compiled_programs = use_compiled_programs
+            st = time.monotonic()
+            results.append(run(template, f'benchmark{i}'))
+            timings.append(time.monotonic() - st)
+        if results[0] != results[1]:
+            raise AssertionError(f'Compiled template gave different results: {template}')
+        print(f'Template {i}: interpreted: {timings[0]:.3f}s compiled: {timings[1]:.3f}s speedup: {timings[0]/timings[1]:.2f}x')
+# }}}
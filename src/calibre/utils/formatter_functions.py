@@ -111,6 +111,9 @@ def __init__(self):
         self._builtins = {}
         self._functions = {}
         self._functions_from_library = {}
+        # Incremented whenever the set of functions changes, used to invalidate
+        # compiled templates
+        self.generation = 0
 
     def register_builtin(self, func_class):
         if not isinstance(func_class, FormatterFunction):
@@ -130,6 +133,7 @@ def _register_function(self, func_class, replace=False):
         if not replace and name in self._functions:
             raise ValueError(f'Name {name} already used')
         self._functions[name] = func_class
+        self.generation += 1
 
     def register_functions(self, library_uuid, funcs):
         self._functions_from_library[library_uuid] = funcs
@@ -161,6 +165,7 @@ def unregister_functions(self, library_uuid):
             for cls in self._functions_from_library[library_uuid]:
                 self._functions.pop(cls.name, None)
             self._functions_from_library.pop(library_uuid)
+            self.generation += 1
             self._register_functions()
 
     def get_builtins(self):
@@ -179,6 +184,7 @@ def get_functions(self):
 
     def reset_to_builtins(self):
         self._functions = {}
+        self.generation += 1
         for n,c in self._builtins.items():
             self._functions[n] = c
             for a in c.aliases:
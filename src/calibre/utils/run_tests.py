@@ -278,6 +278,8 @@ def ok(x):
         a(find_tests())
         from calibre.ebooks.html_entities import find_tests
         a(find_tests())
+        from calibre.ebooks.oeb.transforms.flatcss import find_tests
+        a(find_tests())
         from calibre.spell.dictionary import find_tests
         a(find_tests())
     if ok('misc'):
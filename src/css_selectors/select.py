@@ -10,18 +10,22 @@
 from collections import OrderedDict, defaultdict
 from functools import wraps
 from itertools import chain
+from threading import Lock
 
 from lxml import etree
 
-from css_selectors.errors import ExpressionError
+from css_selectors.errors import ExpressionError, SelectorError
 from css_selectors.ordered_set import OrderedSet
-from css_selectors.parser import Element, FunctionalPseudoElement, ascii_lower, parse
+from css_selectors.parser import Class, CombinedSelector, Element, FunctionalPseudoElement, Hash, Pseudo, ascii_lower, parse
 from polyglot.builtins import iteritems, itervalues
 
 PARSE_CACHE_SIZE = 200
 parse_cache = OrderedDict()
 XPATH_CACHE_SIZE = 30
 xpath_cache = OrderedDict()
+COMPILE_CACHE_SIZE = 2000
+compile_cache = OrderedDict()
+compile_cache_lock = Lock()
 
 # Test that the string is not empty and does not contain whitespace
 is_non_whitespace = re.compile(r'^[^ \t\r\n\f]+$').match
@@ -167,11 +171,13 @@ def invalidate_caches(self):
         self._attrib_map = None
         self._attrib_space_map = None
         self._lang_map = None
-        self.map_tag_name = ascii_lower
+        self._lang_matches = {}
+        self._compile_cache = OrderedDict()
+        self.map_tag_name = self.map_attrib_name = ascii_lower
         if '{' in self.root.tag:
             def map_tag_name(x):
                 return ascii_lower(x.rpartition('}')[2])
-            self.map_tag_name = map_tag_name
+            self.map_tag_name = self.map_attrib_name = map_tag_name
 
     def __call__(self, selector, root=None):
         ''' Return an iterator over all matching tags, in document order.
@@ -193,8 +199,126 @@ def has_matches(self, selector, root=None):
         for elem in self(selector, root=root):
             return True
         return False
+
+    def matches(self, elem, selector):
+        ''' Return True iff elem, which must be a tag in the tree, matches
+        selector. Only elem and the tags around it are examined, so this is
+        much faster than :meth:`__call__` when testing many selectors against
+        a few tags. '''
+        for matcher, key, required in self.compiled_selector(selector):
+            if matcher(self, elem):
+                return True
+        return False
+
+    def select_many(self, selectors, errors=None):
+        ''' Return a dict mapping each of selectors to the list of tags it
+        matches, in document order. All the selectors are matched in a single
+        pass over the tree, each tag being tested only against the selectors
+        whose rightmost id, class or tag name it has, so this is much faster
+        than calling :meth:`__call__` for every selector when there are many
+        selectors. If errors is a dict, selectors that cannot be parsed or are
+        not supported are added to it, mapped to their error, instead of
+        raising an exception. '''
+        ans = {}
+        buckets = {'id': defaultdict(list), 'class': defaultdict(list), 'tag': defaultdict(list)}
+        universal = []
+        present = {'id': self.id_map, 'class': self.class_map, 'tag': self.element_map}
+        for selector in selectors:
+            if selector in ans:
+                continue
+            try:
+                compiled = self.compiled_selector(selector)
+            except SelectorError as err:
+                if errors is None:
+                    raise
+                errors[selector] = err
+                continue
+            matched = ans[selector] = []
+            for matcher, key, required in compiled:
+                # Skip selectors needing an id, class or tag that is not in the tree
+                for kind, name in required:
+                    if not present[kind].get(name):
+                        break
+                else:
+                    entry = matcher, matched
+                    if key is None:
+                        universal.append(entry)
+                    else:
+                        buckets[key[0]][key[1]].append(entry)
+        by_id, by_class, by_tag = buckets['id'], buckets['class'], buckets['tag']
+        for elem in self.itertag():
+            candidates = universal + by_tag.get(self.map_tag_name(elem.tag), [])
+            if by_id:
+                elem_id = elem.get('id')
+                if elem_id is not None:
+                    candidates.extend(by_id.get(ascii_lower(elem_id), ()))
+            if by_class:
+                classes = elem.get('class')
+                if classes:
+                    for cls in set(ascii_lower(classes).split()):
+                        candidates.extend(by_class.get(cls, ()))
+            for matcher, matched in candidates:
+                # A selector group can match a tag more than once
+                if (not matched or matched[-1] is not elem) and matcher(self, elem):
+                    matched.append(elem)
+        return ans
     # }}}
 
+    def compiled_selector(self, selector):
+        ''' Return a tuple of (matcher, key, required) for every selector in
+        the selector group, selector, where matcher is a function f(select,
+        elem) that returns True iff elem matches and key and required are as
+        returned by :func:`index_keys`. Compiled selectors are cached and shared between
+        Select objects. Raises SelectorError for invalid or unsupported
+        selectors. '''
+        return self.cached_compile(selector, lambda: tuple(
+            (compile_parsed_selector(self, ps),) + index_keys(ps) for ps in get_parsed_selector(selector)))
+
+    def cached_compile(self, key, create):
+        if self.dispatch_map is default_dispatch_map:
+            cache, ckey = compile_cache, (key, self.ignore_inappropriate_pseudo_classes)
+        else:
+            cache, ckey = self._compile_cache, key
+        # The module level cache is shared by Select objects in all threads.
+        # Compile outside the lock, at worst a selector is compiled twice.
+        with compile_cache_lock:
+            ans = cache.get(ckey)
+            if ans is not None:
+                cache.move_to_end(ckey)
+                return ans
+        ans = create()
+        with compile_cache_lock:
+            cache[ckey] = ans
+            if len(cache) > COMPILE_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+        return ans
+
+    def compile_parsed_selector(self, parsed_selector):
+        ''' Return a function f(select, elem) that returns True iff elem
+        matches parsed_selector. The function can be used with any Select
+        object that has the same dispatch map and settings as this one.
+        Raises ExpressionError if parsed_selector uses something that is not
+        supported. '''
+        return compile_parsed_selector(self, parsed_selector)
+
+    def check_parsed_selector(self, parsed_selector):
+        ''' Raise ExpressionError if parsed_selector uses something that is
+        not supported. '''
+        compile_parsed_selector(self, parsed_selector)
+
+    def match_parsed_selector(self, elem, parsed_selector):
+        # Parsed selectors are cached by their repr, which describes the
+        # whole selector
+        matcher = self.cached_compile(('parsed', repr(parsed_selector)), lambda: compile_parsed_selector(self, parsed_selector))
+        return matcher(self, elem)
+
+    def lang_matches(self, function):
+        try:
+            return self._lang_matches[function]
+        except KeyError:
+            ans = self._lang_matches[function] = frozenset(select_lang(self, function))
+            return ans
+
     def iterparsedselector(self, parsed_selector):
         type_name = type(parsed_selector).__name__
         try:
@@ -235,10 +359,7 @@ def class_map(self):
     def attrib_map(self):
         if self._attrib_map is None:
             self._attrib_map = am = defaultdict(lambda : defaultdict(OrderedSet))
-            map_attrib_name = ascii_lower
-            if '{' in self.root.tag:
-                def map_attrib_name(x):
-                    return ascii_lower(x.rpartition('}')[2])
+            map_attrib_name = self.map_attrib_name
             for tag in self.itertag():
                 for attr, val in iteritems(tag.attrib):
                     am[map_attrib_name(attr)][val].add(tag)
@@ -248,10 +369,7 @@ def map_attrib_name(x):
     def attrib_space_map(self):
         if self._attrib_space_map is None:
             self._attrib_space_map = am = defaultdict(lambda : defaultdict(OrderedSet))
-            map_attrib_name = ascii_lower
-            if '{' in self.root.tag:
-                def map_attrib_name(x):
-                    return ascii_lower(x.rpartition('}')[2])
+            map_attrib_name = self.map_attrib_name
             for tag in self.itertag():
                 for attr, val in iteritems(tag.attrib):
                     for v in val.split():
@@ -290,6 +408,13 @@ def iterchildren(self, tag=None):
     def itersiblings(self, tag=None, preceding=False):
         return (self.root if tag is None else tag).itersiblings('*', preceding=preceding)
 
+    def iterancestors(self, tag):
+        if tag is not self.root:
+            for ancestor in tag.iterancestors('*'):
+                yield ancestor
+                if ancestor is self.root:
+                    break
+
     def iteridtags(self):
         return get_compiled_xpath('//*[@id]')(self.root)
 
@@ -685,6 +810,228 @@ def select_empty(cache, elem):
 
 default_dispatch_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('select_') and callable(obj)}
 
+# Compiled matchers {{{
+# A parsed selector is compiled into a function, taking a Select object and a
+# tag, that tests the tag with the same semantics as the select_* functions
+# above, working from right to left. Compiled functions only use the Select
+# object passed to them when called, so they are cached and shared by all
+# Select objects with the same dispatch map.
+
+
+def match_all(cache, elem):
+    return True
+
+
+def compile_parsed_selector(cache, parsed_selector):
+    ''' Compile parsed_selector into a function f(cache, elem) that returns
+    True iff elem matches. The pseudo-classes are looked up in the dispatch
+    map of cache. Raises ExpressionError if parsed_selector uses something
+    that is not supported. '''
+    type_name = ascii_lower(type(parsed_selector).__name__)
+    try:
+        compiler = compile_dispatch_map[type_name]
+    except KeyError:
+        raise ExpressionError('%s is not supported' % type_name)
+    return compiler(cache, parsed_selector)
+
+
+def compile_selector(cache, selector):
+    inner = compile_parsed_selector(cache, selector.parsed_tree)
+    pe = selector.pseudo_element
+    if pe is None:
+        return inner
+    if isinstance(pe, FunctionalPseudoElement):
+        raise ExpressionError(
+            "The pseudo-element ::%s is not supported" % pe.name)
+    func = get_func_for_pseudo(cache, pe)
+    if func is allow_all:
+        return inner
+
+    def matcher(cache, elem):
+        return inner(cache, elem) and func(cache, elem)
+    return matcher
+
+
+def compile_combinedselector(cache, combined):
+    left = compile_parsed_selector(cache, combined.selector)
+    right = compile_parsed_selector(cache, combined.subselector)
+    combinator = combined.combinator
+    if combinator == ' ':
+        def matcher(cache, elem):
+            if right(cache, elem):
+                for ancestor in cache.iterancestors(elem):
+                    if left(cache, ancestor):
+                        return True
+            return False
+    elif combinator == '>':
+        def matcher(cache, elem):
+            if right(cache, elem):
+                for parent in cache.iterancestors(elem):
+                    return left(cache, parent)
+            return False
+    elif combinator == '+':
+        def matcher(cache, elem):
+            if right(cache, elem):
+                for sibling in cache.itersiblings(elem, preceding=True):
+                    return left(cache, sibling)
+            return False
+    elif combinator == '~':
+        def matcher(cache, elem):
+            if right(cache, elem):
+                for sibling in cache.itersiblings(elem, preceding=True):
+                    if left(cache, sibling):
+                        return True
+            return False
+    else:
+        raise ExpressionError('Unknown combinator: %r' % combinator)
+    return matcher
+
+
+def compile_element(cache, selector):
+    element = selector.element
+    if not element or element == '*':
+        return match_all
+    element = ascii_lower(element)
+
+    def matcher(cache, elem):
+        return cache.map_tag_name(elem.tag) == element
+    return matcher
+
+
+def compile_hash(cache, selector):
+    inner = compile_parsed_selector(cache, selector.selector)
+    elem_id = ascii_lower(selector.id)
+
+    def matcher(cache, elem):
+        val = elem.get('id')
+        return val is not None and ascii_lower(val) == elem_id and inner(cache, elem)
+    return matcher
+
+
+def compile_class(cache, selector):
+    inner = compile_parsed_selector(cache, selector.selector)
+    class_name = ascii_lower(selector.class_name)
+
+    def matcher(cache, elem):
+        classes = elem.get('class')
+        return bool(classes) and class_name in ascii_lower(classes).split() and inner(cache, elem)
+    return matcher
+
+
+def compile_negation(cache, selector):
+    inner = compile_parsed_selector(cache, selector.selector)
+    exclude = compile_parsed_selector(cache, selector.subselector)
+
+    def matcher(cache, elem):
+        return inner(cache, elem) and not exclude(cache, elem)
+    return matcher
+
+
+attrib_value_tests = {
+    'exists': lambda val, value: True,
+    '=': lambda val, value: val == value,
+    '~=': lambda val, value: is_non_whitespace(value) and value in val.split(),
+    '|=': lambda val, value: value and (val == value or val.startswith(value + '-')),
+    '^=': lambda val, value: value and val.startswith(value),
+    '$=': lambda val, value: value and val.endswith(value),
+    '*=': lambda val, value: value and value in val,
+}
+
+
+def compile_attrib(cache, selector):
+    inner = compile_parsed_selector(cache, selector.selector)
+    attrib = ascii_lower(selector.attrib)
+    test = attrib_value_tests[selector.operator]
+    value = selector.value
+
+    def matcher(cache, elem):
+        map_attrib_name = cache.map_attrib_name
+        for attr, val in iteritems(elem.attrib):
+            if map_attrib_name(attr) == attrib and test(val, value):
+                return inner(cache, elem)
+        return False
+    return matcher
+
+
+def compile_function(cache, function):
+    inner = compile_parsed_selector(cache, function.selector)
+    fname = function.name.replace('-', '_')
+    try:
+        func = cache.dispatch_map[fname]
+    except KeyError:
+        raise ExpressionError(
+            "The pseudo-class :%s() is unknown" % function.name)
+    if fname == 'lang':
+        if function.argument_types() not in (['STRING'], ['IDENT']):
+            raise ExpressionError("Expected a single string or ident for :lang(), got %r" % function.arguments)
+
+        def matcher(cache, elem):
+            return elem in cache.lang_matches(function) and inner(cache, elem)
+    else:
+        function.parsed_arguments
+
+        def matcher(cache, elem):
+            return func(cache, function, elem) and inner(cache, elem)
+    return matcher
+
+
+def compile_pseudo(cache, pseudo):
+    func = get_func_for_pseudo(cache, pseudo.ident)
+    if func is select_root:
+        def matcher(cache, elem):
+            return elem is cache.root
+        return matcher
+    inner = compile_parsed_selector(cache, pseudo.selector)
+    if func is allow_all:
+        return inner
+
+    def matcher(cache, elem):
+        return func(cache, elem) and inner(cache, elem)
+    return matcher
+
+
+compile_dispatch_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('compile_') and callable(obj)}
+del compile_dispatch_map['parsed_selector']
+
+
+def index_keys(parsed_selector):
+    ''' Return the key used to bucket parsed_selector, taken from its
+    rightmost compound selector, preferring an id over a class over a tag
+    name, or None for the universal bucket. Also return the keys that must all
+    be present somewhere in a tree for the selector to match anything in it. '''
+    keys, required = [], []
+    # Compound selectors are visited from right to left
+    stack = [parsed_selector.parsed_tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, CombinedSelector):
+            stack.append(node.selector)
+            stack.append(node.subselector)
+            continue
+        key = None
+        while not isinstance(node, Element):
+            if isinstance(node, Pseudo) and node.ident == 'root':
+                # :root matches the root regardless of the rest of the compound selector
+                break
+            if isinstance(node, Hash):
+                key = 'id', ascii_lower(node.id)
+                required.append(key)
+            elif isinstance(node, Class):
+                k = 'class', ascii_lower(node.class_name)
+                required.append(k)
+                if key is None:
+                    key = k
+            node = node.selector
+        else:
+            if node.element and node.element != '*':
+                k = 'tag', ascii_lower(node.element)
+                required.append(k)
+                if key is None:
+                    key = k
+        keys.append(key)
+    return keys[0], tuple(required)
+# }}}
+
 if __name__ == '__main__':
     from pprint import pprint
     root = etree.fromstring(
@@ -13,7 +13,7 @@
 
 from css_selectors.errors import ExpressionError, SelectorSyntaxError
 from css_selectors.parser import parse, tokenize
-from css_selectors.select import Select
+from css_selectors.select import Select, compile_cache
 
 
 class TestCSSSelectors(unittest.TestCase):
@@ -655,10 +655,20 @@ def select_ids(selector):
             for elem in select(selector):
                 yield elem.get('id')
 
+        def matched_ids(selector):
+            for elem in select.itertag():
+                if select.matches(elem, selector):
+                    yield elem.get('id')
+
+        checked = {}
+
         def pcss(main, *selectors, **kwargs):
             result = list(select_ids(main))
-            for selector in selectors:
-                self.ae(list(select_ids(selector)), result)
+            for selector in (main,) + selectors:
+                if selector is not main:
+                    self.ae(list(select_ids(selector)), result)
+                self.ae(list(matched_ids(selector)), result, f'matches() gives a different result for: {selector}')
+                checked[selector] = result
             return result
         all_ids = pcss('*')
         self.ae(all_ids[:6], [
@@ -740,15 +750,41 @@ def pcss(main, *selectors, **kwargs):
         self.ae(pcss(r'[h\a0 ref]', r'[h\]ref]'), [])
 
         self.assertRaises(ExpressionError, lambda : tuple(select('body:nth-child')))
+        self.assertRaises(ExpressionError, lambda : select.matches(document, 'body:nth-child'))
+        self.assertRaises(ExpressionError, lambda : select.matches(document, 'p:hover'))
+
+        # Matching many selectors in a single pass
+        self.ae({k:[e.get('id') for e in v] for k, v in select.select_many(checked).items()}, checked)
+        errors = {}
+        self.ae(list(select.select_many(('body:nth-child', 'p:hover', 'div'), errors)), ['div'])
+        self.ae(set(errors), {'body:nth-child', 'p:hover'})
+        self.assertRaises(ExpressionError, select.select_many, ('div', 'p:hover'))
 
         select = Select(document, ignore_inappropriate_pseudo_classes=True)
         self.assertGreater(len(tuple(select('p:hover'))), 0)
+        self.ae(select.select_many(['p:hover'])['p:hover'], list(select('p:hover')))
+        # Compiled selectors are shared between Select objects with the same settings
+        self.assertIs(select.compiled_selector('div p'), Select(document, ignore_inappropriate_pseudo_classes=True).compiled_selector('div p'))
+        self.assertIsNot(select.compiled_selector('div p'), Select(document).compiled_selector('div p'))
+        # Matching parsed selectors goes through the same cache
+        from css_selectors.select import compile_cache, get_parsed_selector
+        ps = get_parsed_selector('div p')[0]
+        p = next(select('div p'))
+        self.assertTrue(select.match_parsed_selector(p, ps))
+        before = len(compile_cache)
+        self.assertTrue(Select(document, ignore_inappropriate_pseudo_classes=True).match_parsed_selector(p, ps))
+        self.assertFalse(select.match_parsed_selector(p.getparent(), ps))
+        self.ae(len(compile_cache), before)
 
     def test_select_shakespeare(self):
         document = html.document_fromstring(self.HTML_SHAKESPEARE)
         select = Select(document)
+        counted = {}
         def count(s):
-            return sum(1 for r in select(s))
+            ans = sum(1 for r in select(s))
+            self.ae(ans, sum(1 for elem in select.itertag() if select.matches(elem, s)), f'matches() gives a different count for: {s}')
+            counted[s] = list(select(s))
+            return ans
 
         # Data borrowed from http://mootools.net/slickspeed/
 
@@ -797,10 +833,46 @@ def count(s):
         assert count('div[class*=sce]') == 1
         assert count('div[class|=dialog]') == 50  # ? Seems right
         assert count('div[class~=dialog]') == 51  # ? Seems right
+        self.ae({k:set(v) for k, v in Select(document).select_many(counted).items()}, {k:set(v) for k, v in counted.items()})
 
     # }}}
 
 
+def benchmark(repeat=3):
+    ''' Compare the speed of running many selectors against a large
+    document, one at a time and in a single pass. Run with:
+    python -c "from css_selectors.tests import benchmark; benchmark()" '''
+    import time
+    body = []
+    for i in range(500):
+        body.append(f'<div class="chapter c{i % 50}" id="d{i}"><h2 class="title">Heading {i}</h2>')
+        for j in range(10):
+            body.append(f'<p class="para p{j}" lang="en">Some <span class="s{j}">text</span> <a href="#d{j}">link</a></p>')
+        body.append('</div>')
+    raw = '<html><head><title>Benchmark</title></head><body>{}</body></html>'.format(''.join(body))
+    selectors = []
+    for i in range(100):
+        selectors.extend((
+            f'.c{i}', f'div.c{i} > h2', f'.c{i} p.p{i % 10}', f'#d{i * 7}', f'p.p{i % 10} + p', f'span.s{i % 10}:first-child',
+            f'div.c{i} a[href^="#d{i}"]', f'.nonexistent{i} p', f'p:nth-child({i % 10 + 1})', f'h2 ~ .p{i % 10}',
+        ))
+    for r in range(repeat):
+        document = html.document_fromstring(raw)
+        compile_cache.clear()
+        st = time.monotonic()
+        select = Select(document)
+        one_at_a_time = {s:list(select(s)) for s in selectors}
+        t1 = time.monotonic() - st
+        results = []
+        for label in ('compiling', 'cached'):
+            st = time.monotonic()
+            ans = Select(document).select_many(selectors)
+            results.append((label, time.monotonic() - st))
+            assert ans == one_at_a_time
+        print(f'{len(selectors)} selectors against {sum(1 for x in document.iter("*"))} tags:',
+              f'one at a time: {t1:.2f}s,', ', '.join(f'single pass {label}: {t:.2f}s' for label, t in results))
+
+
 # Run tests {{{
 def find_tests():
     return unittest.defaultTestLoader.loadTestsFromTestCase(TestCSSSelectors)